@@ -4,14 +4,35 @@ import uuid
 import subprocess
 import tempfile
 import shutil
-from flask import Flask, render_template, request, jsonify, send_from_directory, make_response
-from PIL import Image
+import hashlib
+import base64
+import json
+import re
+import zipfile
+import unicodedata
+from urllib.parse import quote
+from array import array
+import collections
+import io
+import threading
+import signal
+import atexit
+import multiprocessing
+import time
+import math
+import bisect
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, CancelledError
+from concurrent.futures.process import BrokenProcessPool
+from flask import Flask, render_template, request, jsonify, send_from_directory, send_file, make_response, redirect, url_for, stream_with_context, g
+from werkzeug.exceptions import RequestEntityTooLarge
+from PIL import Image, features
+import numpy as np
 from reportlab.lib.pagesizes import A4
 from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Image as RLImage, Table, TableStyle
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.lib.units import inch
 from reportlab.lib import colors
-from io import BytesIO
+from reportlab import rl_config
 
 # パス設定
 if getattr(sys, 'frozen', False):
@@ -32,6 +53,12 @@ os.makedirs(SCENES_FOLDER, exist_ok=True)
 app = Flask(__name__, template_folder=template_folder, static_folder=static_folder)
 app.secret_key = 'your-secret-key-here'
 
+# シーン検出で書き出す最大フレーム数（超えた分は結果APIから /frame で表示時にデコードする）
+MAX_SCENES = int(os.environ.get('MAX_SCENES', 500))
+# 結果APIの1ページあたりのシーン数（既定値と上限）
+SCENES_PAGE_SIZE = 60
+SCENES_PAGE_MAX = 1000
+
 @app.route('/', methods=['GET', 'POST'])
 def index():
     if request.method == 'POST':
@@ -43,261 +70,4205 @@ def index():
             if file.filename == '':
                 return render_template('index.html', error='動画ファイルを選択してください')
             
-            # ファイル保存
-            original_filename = file.filename
-            filename = str(uuid.uuid4()) + os.path.splitext(file.filename)[1]
-            filepath = os.path.join(UPLOAD_FOLDER, filename)
-            file.save(filepath)
-            
             # 処理モードを取得
-            mode = request.form.get('mode', 'interval')
-            interval = int(request.form.get('interval', 5))
-            
-            print(f"Processing mode: {mode}, interval: {interval}s")
-            
-            # フレーム抽出
-            filename_no_ext = os.path.splitext(filename)[0]
-            scene_dir = os.path.join(SCENES_FOLDER, filename_no_ext)
+            try:
+                mode, interval, sensitivity = parse_extraction_params(request.form)
+                dedupe = parse_dedupe_param(request.form)
+            except ValueError as e:
+                return render_template('index.html', error=f'処理の設定が正しくありません: {e}'), 400
             
-            if mode == 'scene':
-                frame_data = extract_scenes_with_ffmpeg(filepath, scene_dir)
-            else:
-                frame_data = extract_frames_simple(filepath, scene_dir, interval)
+            # ファイル保存（内容のハッシュをファイル名にする）
+            original_filename = file.filename
+            filename, filepath, digest = save_upload(file)
             
-            # シーンデータを構築
-            scenes = []
-            if frame_data:
-                for frame_info in frame_data:
-                    # 実際のタイムスタンプを使用
-                    timestamp_seconds = frame_info['timestamp']
-                    hours = int(timestamp_seconds // 3600)
-                    minutes = int((timestamp_seconds % 3600) // 60)
-                    secs = int(timestamp_seconds % 60)
-                    millisecs = int((timestamp_seconds % 1) * 1000)
-                    time_str = f"{hours:02d}:{minutes:02d}:{secs:02d}.{millisecs:03d}"
-                    
-                    scenes.append({
-                        'image': f"{filename_no_ext}/{frame_info['filename']}",
-                        'start': time_str
-                    })
+            print(f"Processing mode: {mode}, interval: {interval}s")
             
-            return render_template('index.html', 
-                                 video=filename, 
-                                 original_filename=original_filename,
-                                 scenes=scenes, 
-                                 selected_mode=mode, 
-                                 interval=interval)
+            # フレーム抽出はワーカープロセスで実行し、結果ページへリダイレクト
+            job_id = submit_job(filepath, filename, digest, original_filename, mode, interval, sensitivity,
+                                dedupe=dedupe)
+            return redirect(url_for('index', job=job_id))
             
+        except RequestEntityTooLarge:
+            raise
         except Exception as e:
             print(f"Error processing video: {e}")
             return render_template('index.html', error=f'動画処理中にエラーが発生しました: {str(e)}')
     
-    return render_template('index.html')
+    job_id = request.args.get('job')
+    if job_id:
+        job = get_job(job_id)
+        if job is None:
+            return render_template('index.html', error='処理ジョブが見つかりません')
+        
+        if job['status'] == 'error':
+            return render_template('index.html', error=f'動画処理中にエラーが発生しました: {job["error"]}')
+        
+        if job['status'] == 'cancelled':
+            return render_template('index.html', error='動画処理は中断されました')
+        
+        if job['status'] != 'done':
+            # 処理中：ページ側でステータスをポーリングする
+            return render_template('index.html',
+                                 job_id=job_id,
+                                 selected_mode=job['mode'],
+                                 interval=job['interval'])
+        
+        return render_result_page(job['result_id'], job['original_filename'])
+    
+    result_id = request.args.get('result')
+    if result_id:
+        # ジョブ履歴に残っていない結果もマニフェストから表示できる
+        return render_result_page(result_id, request.args.get('original_filename'))
+    
+    return render_template('index.html')
+
+def render_result_page(result_id, original_filename=None):
+    """マニフェストから結果ページを表示"""
+    manifest = load_cached_result(result_id)
+    if manifest is None:
+        return render_template('index.html', error='解析結果が見つかりません')
+    
+    # 最初のページだけを埋め込み、続きはページ側で結果APIから読み込む
+    scenes = list_result_scenes(result_id)['scenes']
+    next_url = None
+    if len(scenes) > SCENES_PAGE_SIZE:
+        next_url = url_for('result_scenes', result_id=result_id, cursor=encode_cursor(SCENES_PAGE_SIZE))
+    
+    return render_template('index.html', 
+                         video=manifest['video'], 
+                         result_id=result_id,
+                         original_filename=original_filename or manifest['video'],
+                         scenes=scenes[:SCENES_PAGE_SIZE], 
+                         scene_count=len(scenes),
+                         scenes_next_url=next_url,
+                         sprites_url=url_for('result_sprites', result_id=result_id),
+                         selected_mode=manifest['mode'], 
+                         interval=manifest['interval'],
+                         sensitivity=manifest['sensitivity'],
+                         dedupe=manifest.get('dedupe'),
+                         dedupe_available=bool(manifest.get('candidates')))
+
+@app.route('/health')
+def health():
+    queue = queue_status()
+    response = jsonify({'status': 'OK', 'message': 'Application is running', 'queue': queue})
+    response.headers['X-Queue-Depth'] = str(queue['depth'])
+    return response
+
+@app.route('/ready')
+def ready():
+    """ロードバランサー向け：ジョブの待ち行列が満杯の間は 503 を返して振り分け先から外してもらう"""
+    queue = queue_status()
+    response = jsonify({'status': 'ready' if queue['accepting'] else 'busy', 'queue': queue})
+    response.headers['X-Queue-Depth'] = str(queue['depth'])
+    if not queue['accepting']:
+        response.status_code = 503
+        response.headers['Retry-After'] = str(ADMISSION_RETRY_AFTER)
+    return response
+
+
+@app.route('/upload', methods=['POST'])
+def upload():
+    try:
+        if 'video' not in request.files:
+            return jsonify({'error': 'No video file uploaded'}), 400
+        
+        file = request.files['video']
+        if file.filename == '':
+            return jsonify({'error': 'No video file selected'}), 400
+        
+        # 処理モードを取得
+        try:
+            mode, interval, sensitivity = parse_extraction_params(request.form)
+            dedupe = parse_dedupe_param(request.form)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        # ファイル保存（内容のハッシュをファイル名にする）
+        filename, filepath, digest = save_upload(file)
+        
+        print(f"Processing mode: {mode}, interval: {interval}s, sensitivity: {sensitivity}")
+        
+        # ジョブを登録してすぐに返す（処理結果は /jobs/<job_id> で確認）
+        job_id = submit_job(filepath, filename, digest, file.filename, mode, interval, sensitivity, dedupe=dedupe)
+        job = get_job(job_id)
+        
+        return jsonify({
+            'message': 'Video uploaded and queued for processing',
+            'job_id': job_id,
+            'status': job['status'],
+            'cached': job['cached'],
+            'filename': file.filename,
+            'video_file': filename,
+            'result_id': job['result_id'],
+            'status_url': url_for('job_status', job_id=job_id),
+            'result_url': url_for('job_result', job_id=job_id),
+            'scenes_url': url_for('result_scenes', result_id=job['result_id'])
+        }), 200 if job['cached'] else 202
+    
+    except RequestEntityTooLarge:
+        raise
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/upload_stream', methods=['POST'])
+def upload_stream():
+    """リクエスト本文をそのまま動画として受け取る（multipart を組み立てずに送れる大きな動画向け）"""
+    try:
+        # 本文は動画そのもの、パラメータはクエリ文字列で受け取る
+        original_filename = request.args.get('filename') or request.headers.get('X-Filename') or 'video.mp4'
+        # 本文を読み込む前に検証する
+        try:
+            mode, interval, sensitivity = parse_extraction_params(request.args)
+            dedupe = parse_dedupe_param(request.args)
+        except ValueError as e:
+            response = jsonify({'error': str(e)})
+            response.status_code = 400
+            # 読まずに残した本文が次のリクエストと混ざらないよう接続を閉じる
+            response.headers['Connection'] = 'close'
+            return response
+        
+        print(f"Streaming upload: {original_filename}, mode: {mode}, interval: {interval}s, sensitivity: {sensitivity}")
+        
+        # 本文は一時ファイルへ書き出し、アップロードと同じジョブとして処理する
+        # （待ち行列の上限・スレッドの割り当て・中断・進捗イベントを共通にする）
+        ext = os.path.splitext(original_filename)[1].lower()
+        filename, filepath, digest = save_stream(request.stream, ext)
+        job_id = submit_job(filepath, filename, digest, original_filename, mode, interval, sensitivity,
+                            dedupe=dedupe)
+        job = get_job(job_id)
+        
+        return jsonify({
+            'message': 'Video uploaded and queued for processing',
+            'job_id': job_id,
+            'status': job['status'],
+            'cached': job['cached'],
+            'filename': original_filename,
+            'video_file': filename,
+            'result_id': job['result_id'],
+            'status_url': url_for('job_status', job_id=job_id),
+            'result_url': url_for('job_result', job_id=job_id),
+            'scenes_url': url_for('result_scenes', result_id=job['result_id'])
+        }), 200 if job['cached'] else 202
+    
+    except RequestEntityTooLarge:
+        raise
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    """ジョブの処理状況を返す"""
+    job = get_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    
+    response = {
+        'job_id': job_id,
+        'status': job['status'],
+        'mode': job['mode'],
+        'video_file': job['video'],
+        'result_id': job['result_id'],
+        'cached': job['cached'],
+        'result_url': url_for('job_result', job_id=job_id)
+    }
+    if job['status'] == 'done':
+        response['frames'] = len(job['frames'])
+        response['scenes_url'] = url_for('result_scenes', result_id=job['result_id'])
+    elif job['status'] in ('error', 'cancelled'):
+        response['error'] = job['error']
+    if job['usage'] is not None:
+        response['usage'] = job['usage']
+    
+    return jsonify(response)
+
+@app.route('/jobs/<job_id>/result')
+def job_result(job_id):
+    """完了したジョブの抽出結果を返す"""
+    job = get_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    
+    if job['status'] == 'error':
+        return jsonify({'job_id': job_id, 'status': 'error', 'error': job['error'], 'usage': job['usage']}), 500
+    
+    if job['status'] == 'cancelled':
+        return jsonify({'job_id': job_id, 'status': 'cancelled', 'error': job['error'], 'usage': job['usage']}), 409
+    
+    if job['status'] != 'done':
+        return jsonify({'job_id': job_id, 'status': job['status']}), 202
+    
+    frames = [{
+        'filename': frame_info['filename'],
+        'timestamp': frame_info['timestamp'],
+        'score': frame_info.get('score'),
+        'width': frame_info.get('width'),
+        'height': frame_info.get('height'),
+        'url': f"/static/scenes/{job['result_id']}/{frame_info['filename']}",
+        'thumbnail_url': url_for('serve_thumbnail', result_id=job['result_id'], size='small',
+                                 filename=os.path.splitext(frame_info['filename'])[0] + '.jpg')
+    } for frame_info in job['frames']]
+    
+    if job['mode'] == 'scene':
+        processing_method = 'scene detection'
+    elif job['mode'] == 'fast':
+        processing_method = f"keyframe extraction ({job['interval']}s)"
+    elif job['mode'] == 'fastscene':
+        processing_method = 'keyframe scene detection'
+    elif job['mode'] == 'adaptive':
+        processing_method = f"adaptive sampling ({job['interval']}s)"
+    else:
+        processing_method = f"interval extraction ({job['interval']}s)"
+    
+    return jsonify({
+        'job_id': job_id,
+        'status': 'done',
+        'filename': job['original_filename'],
+        'video_file': job['video'],
+        'result_id': job['result_id'],
+        'cached': job['cached'],
+        'processing_method': processing_method,
+        'usage': job['usage'],
+        'frames': frames,
+        'preview_url': frames[0]['url'] if frames else None,
+        'scenes_url': url_for('result_scenes', result_id=job['result_id']),
+        'page_url': url_for('index', job=job_id)
+    })
+
+@app.route('/jobs/<job_id>/cancel', methods=['POST'])
+def job_cancel(job_id):
+    """待機中または実行中のジョブを中断する"""
+    job = cancel_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    
+    if job['finished_at'] is not None:
+        return jsonify({'job_id': job_id, 'status': job['status'], 'error': 'Job already finished'}), 409
+    
+    return jsonify({'job_id': job_id, 'status': 'cancelling'}), 202
+
+@app.route('/results/<result_id>/scenes')
+def result_scenes(result_id):
+    """シーン一覧をカーソルでページ分割して返す（?format=ndjson で NDJSON）"""
+    entry = list_result_scenes(result_id)
+    if entry is None:
+        return jsonify({'error': 'Result not found'}), 404
+    scenes = entry['scenes']
+    
+    try:
+        offset = decode_cursor(request.args.get('cursor'))
+        limit = int(request.args.get('limit', SCENES_PAGE_SIZE))
+    except ValueError:
+        return jsonify({'error': 'Invalid cursor or limit'}), 400
+    limit = max(1, min(limit, SCENES_PAGE_MAX))
+    
+    ndjson = (request.args.get('format') == 'ndjson' or
+              request.accept_mimetypes.best_match(['application/json', 'application/x-ndjson']) == 'application/x-ndjson')
+    
+    # 結果は作成後に変わらないため、マニフェストの版とページ指定から ETag を決める
+    etag = hashlib.sha1(f"{result_id}:{entry['key']}:{offset}:{limit}:{ndjson}".encode()).hexdigest()[:20]
+    if request.if_none_match.contains(etag):
+        response = make_response('', 304)
+        response.set_etag(etag)
+        return response
+    
+    page = scenes[offset:offset + limit]
+    next_url = None
+    if offset + len(page) < len(scenes):
+        params = {'format': 'ndjson'} if ndjson else {}
+        next_url = url_for('result_scenes', result_id=result_id,
+                           cursor=encode_cursor(offset + len(page)), limit=limit, **params)
+    
+    if ndjson:
+        response = app.response_class(''.join(json.dumps(scene) + '\n' for scene in page),
+                                      mimetype='application/x-ndjson')
+    else:
+        manifest = entry['manifest']
+        response = jsonify({
+            'result_id': result_id,
+            'mode': manifest['mode'],
+            'video_file': manifest['video'],
+            'total': len(scenes),
+            'scenes': page,
+            'next_cursor': encode_cursor(offset + len(page)) if next_url else None,
+            'next_url': next_url
+        })
+    
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Total-Count'] = str(len(scenes))
+    if next_url:
+        response.headers['Link'] = f'<{next_url}>; rel="next"'
+    return response
+
+def encode_cursor(offset):
+    """ページ位置を不透明なカーソル文字列にする"""
+    return base64.urlsafe_b64encode(f'o{offset}'.encode()).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    """カーソル文字列からページ位置を取り出す（不正なら ValueError）"""
+    if not cursor:
+        return 0
+    try:
+        value = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+    except (ValueError, UnicodeDecodeError):
+        raise ValueError('Invalid cursor')
+    if not value.startswith('o') or not value[1:].isdigit():
+        raise ValueError('Invalid cursor')
+    return int(value[1:])
+
+def format_timestamp(timestamp_seconds):
+    """秒数を HH:MM:SS.mmm 形式に変換"""
+    hours = int(timestamp_seconds // 3600)
+    minutes = int((timestamp_seconds % 3600) // 60)
+    secs = int(timestamp_seconds % 60)
+    millisecs = int((timestamp_seconds % 1) * 1000)
+    return f"{hours:02d}:{minutes:02d}:{secs:02d}.{millisecs:03d}"
+
+def build_result_scenes(result_id, manifest):
+    """結果のシーン一覧を構築（結果APIと結果ページで共通）"""
+    sprite_tiles = {}
+    sprites = load_sprite_index(result_id)
+    if sprites:
+        add_sprite_urls(result_id, sprites)
+        for tile in sprites['tiles']:
+            sheet = sprites['sheets'][tile['sheet']]
+            sprite_tiles[tile['filename']] = {
+                'url': sheet['url'],
+                'x': tile['x'],
+                'y': tile['y'],
+                'sheet_width': sheet['width'],
+                'sheet_height': sheet['height'],
+                'tile_width': sprites['tile_width'],
+                'tile_height': sprites['tile_height']
+            }
+    
+    scenes = []
+    for frame_info in manifest['frames']:
+        # グリッドには縮小版を srcset で渡し、ブラウザに表示幅に合ったものを選ばせる
+        stem = os.path.splitext(frame_info['filename'])[0]
+        widths = srcset_widths(frame_info)
+        srcset = {}
+        for ext in THUMBNAIL_FORMATS:
+            if ext == 'webp' and not WEBP_AVAILABLE:
+                continue
+            srcset[ext] = ', '.join(
+                f"{url_for('serve_thumbnail', result_id=result_id, size=size, filename=f'{stem}.{ext}')} {width}w"
+                for size, width in widths.items())
+        
+        # 実際のタイムスタンプを使用
+        scenes.append({
+            'index': len(scenes),
+            'timestamp': frame_info['timestamp'],
+            'time_str': format_timestamp(frame_info['timestamp']),
+            'score': frame_info.get('score'),
+            'width': frame_info.get('width'),
+            'height': frame_info.get('height'),
+            'filename': frame_info['filename'],
+            'url': url_for('serve_scene_file', filename=f"{result_id}/{frame_info['filename']}"),
+            'thumbnail_url': url_for('serve_thumbnail', result_id=result_id, size='small', filename=f'{stem}.jpg'),
+            'srcset': srcset,
+            'sprite': sprite_tiles.get(frame_info['filename'])
+        })
+    
+    if manifest['mode'] == 'scene':
+        # 書き出し上限を超えたシーンは表示時に1枚ずつデコードする
+        scenes += build_lazy_scenes(manifest, len(scenes))
+    return scenes
+
+def build_lazy_scenes(manifest, start_index=0):
+    """書き出されていないシーンを、表示時に /frame でデコードするURLで構築"""
+    digest = manifest['result_id'].split('_')[0]
+    track = load_score_track(score_track_path_for(digest))
+    if track is None or len(track) == 0 or not manifest['frames']:
+        return []
+    
+    extracted = {round(frame_info['timestamp'], 3) for frame_info in manifest['frames']}
+    widths = srcset_widths(manifest['frames'][0])
+    video = manifest['video']
+    
+    scenes = []
+    selected = track[select_scene_indices(track, manifest['sensitivity'])]
+    for timestamp, score in zip(selected['pts'].tolist(), selected['score'].tolist()):
+        if round(timestamp, 3) in extracted:
+            continue
+        scenes.append({
+            'index': start_index + len(scenes),
+            'timestamp': timestamp,
+            'time_str': format_timestamp(timestamp),
+            'score': round(score, 6),
+            'width': manifest['frames'][0].get('width'),
+            'height': manifest['frames'][0].get('height'),
+            'filename': None,
+            'url': frame_url(video, timestamp),
+            'thumbnail_url': frame_url(video, timestamp, 'small'),
+            'srcset': {'jpg': ', '.join(f'{frame_url(video, timestamp, size)} {width}w'
+                                        for size, width in widths.items())},
+            'sprite': None
+        })
+    return scenes
+
+def list_result_scenes(result_id):
+    """シーン一覧をマニフェストのキャッシュと一緒に保持して返す（なければNone）"""
+    entry = load_manifest_entry(result_id)
+    if entry is None:
+        return None
+    
+    if 'scenes' not in entry:
+        entry['scenes'] = build_result_scenes(result_id, entry['manifest'])
+    return entry
+
+def srcset_widths(frame_info):
+    """srcset に載せるサイズと幅（元画像が小さいと同じ幅になるため重複を除く）"""
+    widths = {}
+    for size, width in thumbnail_widths(frame_info).items():
+        if width and width not in widths.values():
+            widths[size] = width
+    return widths
+
+# ---------------------------------------------------------------------------
+# 抽出結果キャッシュ（動画の内容ハッシュと抽出パラメータで管理）
+# ---------------------------------------------------------------------------
+
+MANIFEST_FILENAME = 'manifest.json'
+# フレームごとのスコア・画像サイズ・ファイルサイズを記録する形式
+MANIFEST_VERSION = 2
+# メモリに保持するマニフェストの数（画像配信のたびにJSONを読み直さない）
+MANIFEST_CACHE_SIZE = 256
+# 抽出画像のブラウザキャッシュ期間（秒）
+SCENE_IMAGE_MAX_AGE = int(os.environ.get('SCENE_IMAGE_MAX_AGE', 86400))
+RESULT_ID_PATTERN = re.compile(r'^[0-9a-f]{32}_[a-z]+_[0-9a-z.]+$')
+# 抽出の処理モード
+EXTRACTION_MODES = ('interval', 'scene', 'fast', 'fastscene', 'adaptive')
+# 受け付ける抽出パラメータの範囲（画面の入力欄と同じ）
+INTERVAL_MIN = 1
+INTERVAL_MAX = 60
+SENSITIVITY_MIN = 0.01
+SENSITIVITY_MAX = 0.9
+
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+def save_upload(file):
+    """アップロードをハッシュ計算しながら保存し (ファイル名, パス, ハッシュ) を返す"""
+    return save_stream(file.stream, os.path.splitext(file.filename)[1].lower())
+
+def save_stream(stream, ext):
+    """ストリームをハッシュ計算しながら保存し (ファイル名, パス, ハッシュ) を返す"""
+    tmp_path = os.path.join(UPLOAD_FOLDER, f'.upload-{uuid.uuid4().hex}{ext}')
+    sha256 = hashlib.sha256()
+    
+    try:
+        with MetricTimer('upload_save_seconds'):
+            with open(tmp_path, 'wb') as out:
+                while True:
+                    chunk = stream.read(UPLOAD_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    sha256.update(chunk)
+                    out.write(chunk)
+            inc_metric('bytes_processed_total', os.path.getsize(tmp_path))
+            return finalize_upload(tmp_path, sha256.hexdigest(), ext)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def finalize_upload(tmp_path, digest, ext):
+    """一時ファイルをハッシュ名で確定し (ファイル名, パス, ハッシュ) を返す"""
+    filename = digest + ext
+    filepath = os.path.join(UPLOAD_FOLDER, filename)
+    
+    if os.path.exists(filepath):
+        # 同じ内容の動画は保存済み
+        os.remove(tmp_path)
+    else:
+        os.replace(tmp_path, filepath)
+        # 容量を超えていれば早めに掃除させる
+        storage_wakeup.set()
+    touch_storage(digest)
+    
+    return filename, filepath, digest
+
+def parse_extraction_params(values):
+    """リクエストの処理モード・間隔・感度を取り出す（不正な値は ValueError）"""
+    mode = values.get('mode', 'interval')
+    if mode not in EXTRACTION_MODES:
+        raise ValueError(f"Unknown mode: {mode} (supported: {', '.join(EXTRACTION_MODES)})")
+    try:
+        interval = int(values.get('interval', 5))
+        sensitivity = float(values.get('sensitivity', 0.15))
+    except ValueError:
+        raise ValueError('Invalid interval or sensitivity')
+    
+    if not INTERVAL_MIN <= interval <= INTERVAL_MAX:
+        raise ValueError(f'Interval must be between {INTERVAL_MIN} and {INTERVAL_MAX} seconds')
+    check_sensitivity(sensitivity)
+    return mode, interval, sensitivity
+
+def parse_dedupe_param(values):
+    """リクエストの重複除去のしきい値を取り出す（未指定は None で既定値を使う、不正な値は ValueError）"""
+    value = values.get('dedupe', '')
+    if value == '':
+        return None
+    try:
+        threshold = int(value)
+    except ValueError:
+        raise ValueError('Invalid dedupe threshold')
+    if not 0 <= threshold <= DEDUPE_MAX_THRESHOLD:
+        raise ValueError(f'Dedupe threshold must be between 0 and {DEDUPE_MAX_THRESHOLD}')
+    return threshold
+
+def check_sensitivity(sensitivity):
+    """感度が対応する範囲か確認する（範囲外や NaN は ValueError）"""
+    if not SENSITIVITY_MIN <= sensitivity <= SENSITIVITY_MAX:
+        raise ValueError(f'Sensitivity must be between {SENSITIVITY_MIN} and {SENSITIVITY_MAX}')
+
+def format_result_param(value):
+    """結果IDに埋め込む小数（指数表記にならない固定小数点で、末尾の0は省く）"""
+    return f'{float(value):.6f}'.rstrip('0').rstrip('.')
+
+def make_result_id(digest, mode, interval, sensitivity, dedupe=None):
+    """キャッシュキー (ハッシュ, モード, パラメータ) から結果IDを作成"""
+    if mode in ('scene', 'fastscene'):
+        params = f's{format_result_param(sensitivity)}'
+        if mode == 'scene' and SCENE_DETECTOR == 'numpy':
+            # スコアの尺度が違うため FFmpeg の検出結果とは別の結果にする
+            params += 'n'
+    elif mode == 'fast':
+        params = f'i{int(interval)}'
+    elif mode == 'adaptive':
+        params = f'i{int(interval)}s{format_result_param(sensitivity)}'
+    elif mode == 'interval':
+        params = f'i{int(interval)}'
+    else:
+        # 別のモードの結果と同じIDにならないよう、未対応のモードはIDを作らない
+        raise ValueError(f'Unknown mode: {mode}')
+    
+    # 重複除去のしきい値（無効なら付けないので、既定値の設定によらず同じ結果は同じID）
+    threshold = dedupe_threshold_for(mode, dedupe)
+    if threshold is not None:
+        params += f'd{threshold}'
+    return f'{digest[:32]}_{mode}_{params}'
+
+def is_valid_result_id(result_id):
+    """結果IDの形式を検証（パス操作対策）"""
+    return bool(result_id) and RESULT_ID_PATTERN.match(result_id) is not None
+
+manifest_cache = collections.OrderedDict()
+manifest_cache_lock = threading.Lock()
+
+def load_manifest_entry(result_id):
+    """マニフェストとファイル名の索引をキャッシュ経由で読み込む（なければNone）"""
+    if not is_valid_result_id(result_id):
+        return None
+    
+    touch_storage(result_id)
+    manifest_path = os.path.join(SCENES_FOLDER, result_id, MANIFEST_FILENAME)
+    try:
+        stat = os.stat(manifest_path)
+    except OSError:
+        return None
+    
+    # 削除・再作成されたマニフェストは inode と更新時刻の変化で検出する
+    key = (stat.st_ino, stat.st_mtime_ns)
+    with manifest_cache_lock:
+        entry = manifest_cache.get(result_id)
+        if entry is not None and entry['key'] == key:
+            manifest_cache.move_to_end(result_id)
+            return entry
+    
+    try:
+        with open(manifest_path, encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    
+    entry = {
+        'key': key,
+        'manifest': manifest,
+        'frames': {frame_info['filename']: frame_info for frame_info in manifest['frames']}
+    }
+    with manifest_cache_lock:
+        manifest_cache[result_id] = entry
+        while len(manifest_cache) > MANIFEST_CACHE_SIZE:
+            manifest_cache.popitem(last=False)
+    return entry
+
+def load_cached_result(result_id):
+    """キャッシュ済みの抽出結果を読み込む（なければNone）"""
+    entry = load_manifest_entry(result_id)
+    return entry['manifest'] if entry else None
+
+def load_result_frame(result_id, filename):
+    """マニフェストに記録されたフレームの情報を返す（なければNone）"""
+    entry = load_manifest_entry(result_id)
+    return entry['frames'].get(filename) if entry else None
+
+def describe_frames(output_dir, frame_data, track=None):
+    """フレームごとにシーンスコア・画像サイズ・ファイルサイズを記録する"""
+    if track is not None and len(track) > 0:
+        pts = track['pts']
+    else:
+        track = None
+    
+    frames = []
+    for frame_info in frame_data:
+        path = os.path.join(output_dir, frame_info['filename'])
+        # Image.open はヘッダーだけを読む
+        with Image.open(path) as img:
+            width, height = img.size
+        
+        # 抽出時にスコアが分かっていればそれを使う
+        score = frame_info.get('score')
+        if track is not None:
+            # 同じ pts のフレームのスコア（シーンスコアは全フレーム分ある）
+            i = min(int(np.searchsorted(pts, frame_info['timestamp'])), len(pts) - 1)
+            if i > 0 and abs(pts[i - 1] - frame_info['timestamp']) < abs(pts[i] - frame_info['timestamp']):
+                i -= 1
+            if abs(pts[i] - frame_info['timestamp']) < 0.001:
+                score = round(float(track['score'][i]), 6)
+        
+        frame = {
+            'filename': frame_info['filename'],
+            'timestamp': frame_info['timestamp'],
+            'score': score,
+            'width': width,
+            'height': height,
+            'size': os.path.getsize(path)
+        }
+        # 重複除去した結果はハッシュと畳み込んだフレーム数も記録する
+        for key in ('phash', 'dhash', 'duplicates'):
+            if key in frame_info:
+                frame[key] = frame_info[key]
+        frames.append(frame)
+    return frames
+
+def store_result(work_dir, result_dir, manifest):
+    """作業ディレクトリの抽出結果をキャッシュとして確定し、記録したマニフェストを返す"""
+    digest = manifest['result_id'].split('_')[0]
+    if manifest.get('dedupe') and 'candidates' not in manifest:
+        # 重複を除き、全フレームのハッシュは後からしきい値を変えられるよう残す
+        kept, candidates = dedupe_frames(work_dir, manifest['frames'], manifest['dedupe'])
+        manifest = dict(manifest, frames=kept, candidates=candidates)
+    frames = describe_frames(work_dir, manifest['frames'], load_score_track(score_track_path_for(digest)))
+    manifest = dict(manifest, version=MANIFEST_VERSION, frames=frames)
+    if frames:
+        manifest['width'] = frames[0]['width']
+        manifest['height'] = frames[0]['height']
+    manifest['total_size'] = sum(frame_info['size'] for frame_info in frames)
+    if sprites_enabled(len(frames)):
+        # フレーム数が多い結果は一覧表示用のスプライトシートも作成しておく
+        try:
+            build_sprite_sheets(work_dir, frames)
+        except Exception as e:
+            print(f"Sprite sheet error: {e}")
+    
+    with open(os.path.join(work_dir, MANIFEST_FILENAME), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False)
+    
+    try:
+        os.rename(work_dir, result_dir)
+    except OSError:
+        # 同じ結果が並行して作成済みの場合はそちらを使う
+        shutil.rmtree(work_dir, ignore_errors=True)
+        return load_cached_result(os.path.basename(result_dir)) or manifest
+    return manifest
+
+def evict_cached_result(result_id):
+    """キャッシュ済みの抽出結果を削除"""
+    if not is_valid_result_id(result_id):
+        return False
+    
+    result_dir = os.path.join(SCENES_FOLDER, result_id)
+    if not os.path.isdir(result_dir):
+        return False
+    
+    # 削除中のディレクトリが参照されないよう先に名前を変える
+    trash_dir = os.path.join(SCENES_FOLDER, f'.evict-{uuid.uuid4().hex}')
+    os.rename(result_dir, trash_dir)
+    shutil.rmtree(trash_dir, ignore_errors=True)
+    evict_thumbnails(result_id)
+    return True
+
+@app.route('/cache/<result_id>', methods=['DELETE'])
+def evict_cache(result_id):
+    """抽出結果キャッシュを削除"""
+    if not is_valid_result_id(result_id):
+        return jsonify({'error': 'Invalid result id'}), 400
+    
+    with jobs_lock:
+        busy = any(job['result_id'] == result_id and job['finished_at'] is None for job in jobs.values())
+    if busy:
+        return jsonify({'error': 'Result is being processed'}), 409
+    
+    if not evict_cached_result(result_id):
+        return jsonify({'error': 'Result not found'}), 404
+    return jsonify({'result_id': result_id, 'evicted': True})
+
+# ---------------------------------------------------------------------------
+# ストレージ容量の管理（動画ごとに最終アクセスを記録し、古いものから削除）
+# ---------------------------------------------------------------------------
+
+# uploads/ と static/scenes/ の合計の上限（0で無制限）
+STORAGE_QUOTA_BYTES = int(os.environ.get('STORAGE_QUOTA_BYTES', 20 * 1024 * 1024 * 1024))
+# 最後のアクセスからこの秒数が過ぎた動画は容量に関係なく削除（0で無期限）
+STORAGE_TTL_SECONDS = int(os.environ.get('STORAGE_TTL_SECONDS', 7 * 24 * 3600))
+STORAGE_SWEEP_INTERVAL = int(os.environ.get('STORAGE_SWEEP_INTERVAL', 600))
+# アップロード直後など、アクセスから間もない動画は削除しない
+STORAGE_MIN_IDLE_SECONDS = 300
+# 最終アクセスの記録は同じ動画につきこの間隔で1回まで
+STORAGE_TOUCH_INTERVAL = 60
+# 処理中の印がこれより古ければ異常終了の残骸とみなす
+INFLIGHT_MAX_AGE = 24 * 3600
+STORAGE_LOCK_FILENAME = '.storage-lock'
+# 動画ごとの最終アクセス時刻を更新時刻として持つ印のディレクトリ
+# （atime は relatime や掃除時の走査で書き換わるため使わない）
+ACCESS_MARKER_DIRNAME = '.access'
+# 内容ハッシュで始まる名前（拡張子の有無や種類は問わない）
+DIGEST_PREFIX_PATTERN = re.compile(r'^([0-9a-f]{32})[0-9a-f_.]')
+
+try:
+    import fcntl
+except ImportError:
+    # Windows では複数プロセスの掃除の排他を行わない
+    fcntl = None
+
+# flock を掛けたまま開いているファイル（fork した子プロセスに引き継がれると、
+# 親が閉じても子が終了するまでロックが外れないため、子では閉じる）
+held_lock_files = set()
+
+def close_inherited_lock_files():
+    for handle in list(held_lock_files):
+        handle.close()
+    held_lock_files.clear()
+
+os.register_at_fork(after_in_child=close_inherited_lock_files)
+
+storage_lock = threading.Lock()
+storage_touched = {}
+storage_sweeper = None
+storage_wakeup = threading.Event()
+
+def access_marker_path(digest):
+    """動画の最終アクセス時刻を記録する印のパス"""
+    return os.path.join(SCENES_FOLDER, ACCESS_MARKER_DIRNAME, digest[:32])
+
+def touch_storage(digest):
+    """動画（内容ハッシュ）の最終アクセス時刻を印の更新時刻として記録する"""
+    digest = digest[:32]
+    now = time.time()
+    with storage_lock:
+        if now - storage_touched.get(digest, 0) < STORAGE_TOUCH_INTERVAL:
+            return
+        if len(storage_touched) > 10000:
+            storage_touched.clear()
+        storage_touched[digest] = now
+    
+    path = access_marker_path(digest)
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            open(path, 'a').close()
+        except OSError:
+            pass
+    except OSError:
+        pass
+
+def inflight_marker_path(result_id, job_id):
+    """処理中の動画を削除対象から外すための印（ワーカーが別プロセスでも共有される）"""
+    return os.path.join(SCENES_FOLDER, f".inflight-{result_id.split('_')[0]}-{job_id}")
+
+def collect_storage_groups():
+    """動画（内容ハッシュ）ごとに関連ファイル・合計サイズ・最終アクセス時刻をまとめる"""
+    groups = {}
+    
+    def add(digest, path, stat, size=None):
+        group = groups.setdefault(digest, {'paths': [], 'results': [], 'size': 0, 'accessed': 0.0})
+        group['paths'].append(path)
+        group['size'] += stat.st_size if size is None else size
+        # 印がなければ作成（更新）時刻を最終アクセスとみなす
+        group['accessed'] = max(group['accessed'], stat.st_mtime)
+        return group
+    
+    # 保存途中の一時ファイル（.upload-）や印（.access など）は内容ハッシュで始まらない
+    with os.scandir(UPLOAD_FOLDER) as entries:
+        for entry in entries:
+            match = DIGEST_PREFIX_PATTERN.match(entry.name)
+            if match and entry.is_file(follow_symlinks=False):
+                add(match.group(1), entry.path, entry.stat())
+    
+    with os.scandir(SCENES_FOLDER) as entries:
+        for entry in entries:
+            match = DIGEST_PREFIX_PATTERN.match(entry.name)
+            if not match:
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                group = add(match.group(1), entry.path, entry.stat(), directory_size(entry.path))
+                group['results'].append(entry.name)
+            else:
+                # シーンスコアとキーフレーム索引
+                add(match.group(1), entry.path, entry.stat())
+    
+    for digest, group in groups.items():
+        try:
+            group['accessed'] = max(group['accessed'], os.stat(access_marker_path(digest)).st_mtime)
+        except OSError:
+            pass
+    return groups
+
+def directory_size(path):
+    """ディレクトリ以下のファイルサイズの合計"""
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.stat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return total
+
+def pinned_digests():
+    """処理中のジョブの動画（古すぎる印は削除する）"""
+    pinned = set()
+    now = time.time()
+    with os.scandir(SCENES_FOLDER) as entries:
+        for entry in entries:
+            if not entry.name.startswith('.inflight-'):
+                continue
+            try:
+                if now - entry.stat().st_mtime > INFLIGHT_MAX_AGE:
+                    os.remove(entry.path)
+                    continue
+            except OSError:
+                continue
+            pinned.add(entry.name.split('-')[1])
+    
+    with jobs_lock:
+        for job in jobs.values():
+            if job['finished_at'] is None:
+                pinned.add(job['result_id'].split('_')[0])
+    return pinned
+
+def evict_storage_group(digest, group):
+    """動画と、その抽出結果・スコア・フレームキャッシュをまとめて削除"""
+    for result_id in group['results']:
+        evict_cached_result(result_id)
+    for path in group['paths'] + [access_marker_path(digest)]:
+        try:
+            if os.path.isdir(path):
+                # 結果IDの形式に合わないディレクトリも削除する
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                os.remove(path)
+        except OSError:
+            pass
+    shutil.rmtree(os.path.join(FRAME_FOLDER, digest), ignore_errors=True)
+    print(f"Storage: evicted {digest} ({group['size']} bytes)")
+
+def remove_stale_temporary_files(groups):
+    """異常終了で残った作業ディレクトリ・保存途中のアップロード・ジョブのイベントと、動画のない印を削除"""
+    now = time.time()
+    marker_dir = os.path.join(SCENES_FOLDER, ACCESS_MARKER_DIRNAME)
+    if os.path.isdir(marker_dir):
+        with os.scandir(marker_dir) as entries:
+            for entry in entries:
+                try:
+                    if entry.name not in groups and now - entry.stat().st_mtime > STORAGE_MIN_IDLE_SECONDS:
+                        os.remove(entry.path)
+                except OSError:
+                    pass
+    
+    # イベントと中断フラグは別プロセスや再起動前のジョブの分が prune_finished_jobs で消えずに残る
+    scene_prefixes = ('.work-', '.evict-', '.events-', '.cancel-')
+    for folder, prefixes in ((SCENES_FOLDER, scene_prefixes), (UPLOAD_FOLDER, ('.upload-',))):
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                if not entry.name.startswith(prefixes):
+                    continue
+                try:
+                    if now - entry.stat(follow_symlinks=False).st_mtime <= INFLIGHT_MAX_AGE:
+                        continue
+                    if entry.is_dir(follow_symlinks=False):
+                        shutil.rmtree(entry.path, ignore_errors=True)
+                    else:
+                        os.remove(entry.path)
+                except OSError:
+                    pass
+
+def sweep_storage():
+    """期限切れの動画と、上限を超えた分を最終アクセスの古い順に削除する"""
+    groups = collect_storage_groups()
+    remove_stale_temporary_files(groups)
+    pinned = pinned_digests()
+    now = time.time()
+    total = sum(group['size'] for group in groups.values())
+    
+    evictable = sorted(
+        ((group['accessed'], digest) for digest, group in groups.items()
+         if digest not in pinned and now - group['accessed'] > STORAGE_MIN_IDLE_SECONDS),
+        reverse=True)
+    
+    evicted = 0
+    while evictable:
+        accessed, digest = evictable[-1]
+        expired = STORAGE_TTL_SECONDS and now - accessed > STORAGE_TTL_SECONDS
+        # 上限を超えたら9割まで減らす
+        over_quota = STORAGE_QUOTA_BYTES and total > STORAGE_QUOTA_BYTES * (0.9 if evicted else 1.0)
+        if not expired and not over_quota:
+            break
+        evictable.pop()
+        evict_storage_group(digest, groups[digest])
+        total -= groups[digest]['size']
+        evicted += 1
+        # 削除が他のリクエストのI/Oを妨げないよう少し間を空ける
+        time.sleep(0.05)
+    return {'total_bytes': total, 'evicted': evicted}
+
+def run_storage_sweeper():
+    """定期的に（アップロード時は早めに）容量を確認する"""
+    lock_path = os.path.join(SCENES_FOLDER, STORAGE_LOCK_FILENAME)
+    while True:
+        storage_wakeup.wait(STORAGE_SWEEP_INTERVAL)
+        storage_wakeup.clear()
+        try:
+            with open(lock_path, 'a') as lock_file:
+                if fcntl is not None:
+                    # 複数のワーカープロセスのうち1つだけが掃除する
+                    try:
+                        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except OSError:
+                        continue
+                held_lock_files.add(lock_file)
+                try:
+                    sweep_storage()
+                finally:
+                    held_lock_files.discard(lock_file)
+        except Exception as e:
+            print(f"Storage sweep error: {e}")
+
+@app.before_request
+def start_storage_sweeper():
+    """最初のリクエストで掃除スレッドを起動する"""
+    global storage_sweeper
+    if storage_sweeper is not None or not (STORAGE_QUOTA_BYTES or STORAGE_TTL_SECONDS):
+        return
+    with storage_lock:
+        if storage_sweeper is None:
+            storage_sweeper = threading.Thread(target=run_storage_sweeper, daemon=True)
+            storage_sweeper.start()
+
+# ---------------------------------------------------------------------------
+# ジョブ処理（リクエストハンドラからFFmpeg処理を切り離す）
+# ---------------------------------------------------------------------------
+
+# 同時に実行する抽出処理の最大数
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', max(1, (os.cpu_count() or 2) // 2)))
+# メモリに保持する完了済みジョブの最大数
+JOB_HISTORY_LIMIT = int(os.environ.get('JOB_HISTORY_LIMIT', 200))
+# ワーカープロセスの起動方法
+JOB_START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+
+# イベントファイルの先頭に記録するジョブ情報
+JOB_RECORD_FIELDS = ('video', 'original_filename', 'result_id', 'cached', 'mode', 'interval', 'sensitivity',
+                     'created_at')
+# ジョブの終わりを表すイベント
+TERMINAL_EVENTS = ('done', 'error', 'cancelled')
+JOB_ID_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+
+jobs = {}
+jobs_lock = threading.Lock()
+job_executor = None
+
+def get_job_executor():
+    """ワーカープロセスプールを取得（gunicornのfork後に遅延生成）
+    
+    スレッドのあるプロセスを fork すると他のスレッドが持っていたロックが子に残るため、
+    ワーカーは forkserver（使えなければ spawn）で起動する。
+    """
+    global job_executor
+    with jobs_lock:
+        if job_executor is None:
+            context = multiprocessing.get_context(JOB_START_METHOD)
+            if JOB_START_METHOD == 'forkserver':
+                # import を済ませたサーバーから fork してワーカーの起動を速くする
+                context.set_forkserver_preload([__name__])
+            job_executor = ProcessPoolExecutor(max_workers=JOB_WORKERS, mp_context=context)
+        return job_executor
+
+def run_job(job_id, filepath, result_id, task, task_args):
+    """ワーカープロセスで実行されるジョブ（task(作業ディレクトリ, 結果ID, *task_args) が保存したフレームを返す）"""
+    # 途中経過がキャッシュとして見えないよう作業ディレクトリに書き出す
+    work_dir = os.path.join(SCENES_FOLDER, f'.work-{uuid.uuid4().hex}')
+    job_context['cancel_path'] = cancel_flag_path(job_id)
+    # FFmpegの資源使用量をジョブ単位で集計する
+    job_context['usage'] = usage = new_job_usage()
+    started = time.monotonic()
+    
+    try:
+        if job_cancel_requested():
+            raise JobCancelled('Job cancelled')
+        
+        events_path = job_events_path(job_id)
+        append_job_event(events_path, {'type': 'status', 'status': 'running'})
+        job_context['progress'] = JobProgress(events_path, probe_duration(filepath))
+        
+        return {'frames': task(work_dir, result_id, *task_args), 'usage': usage}
+    except Exception as e:
+        # 失敗・中断したジョブの使用量も例外と一緒に親プロセスへ返す
+        e.resource_usage = usage
+        raise
+    finally:
+        usage['elapsed_seconds'] = time.monotonic() - started
+        print(f"Job {job_id} resources: {format_job_usage(usage)}")
+        job_context['cancel_path'] = None
+        job_context['progress'] = None
+        job_context['usage'] = None
+        shutil.rmtree(work_dir, ignore_errors=True)
+        # ワーカープロセスは終了時に書き出す機会がないためジョブごとに書き出す
+        flush_metrics()
+
+def extract_job_frames(work_dir, result_id, filepath, mode, interval, sensitivity, dedupe=None):
+    """動画からフレームを抽出して結果を保存する"""
+    digest = result_id.split('_')[0]
+    score_track_path = score_track_path_for(digest)
+    track = load_score_track(score_track_path) if mode == 'scene' else None
+    
+    with MetricTimer('detection_seconds', mode=mode):
+        if mode in ('fast', 'fastscene'):
+            # キーフレームのみの高速抽出
+            frame_data = extract_keyframes_fast(filepath, work_dir, interval,
+                                                sensitivity if mode == 'fastscene' else None)
+        elif mode == 'adaptive':
+            # 粗い標本から変化のある区間だけを詰める
+            frame_data = extract_adaptive(filepath, work_dir, interval, sensitivity)
+        elif track is not None and len(track) > 0:
+            # 同じ動画のシーンスコアがあれば再デコードせずに閾値だけ掛け直す
+            frame_data = extract_scenes_from_score_track(filepath, work_dir, sensitivity, track,
+                                                         find_reusable_frames(digest))
+        else:
+            frame_data = extract_parallel(filepath, work_dir, mode, interval, sensitivity,
+                                          score_track_path=score_track_path)
+    
+    # 抽出処理は FFmpeg の中断をエラーとして扱うため、ここで中断を区別する
+    if job_cancel_requested():
+        raise JobCancelled('Job cancelled')
+    
+    if not frame_data:
+        return frame_data
+    frame_data = store_result(work_dir, os.path.join(SCENES_FOLDER, result_id), {
+        'result_id': result_id,
+        'video': os.path.basename(filepath),
+        'mode': mode,
+        'interval': interval,
+        'sensitivity': sensitivity,
+        'dedupe': dedupe_threshold_for(mode, dedupe),
+        'frames': frame_data,
+        'created_at': time.time()
+    })['frames']
+    inc_metric('frames_produced_total', len(frame_data), mode=mode)
+    return frame_data
+
+def submit_job(filepath, filename, digest, original_filename, mode, interval, sensitivity,
+               dedupe=None, result_id=None, task=None):
+    """ジョブを登録してジョブIDを返す（キャッシュ済みなら即完了）
+    
+    task は (関数, 引数) で、省略時は動画からのフレーム抽出（run_job を参照）。
+    """
+    global job_executor
+    
+    if result_id is None:
+        result_id = make_result_id(digest, mode, interval, sensitivity, dedupe)
+    if task is None:
+        task = (extract_job_frames, (filepath, mode, interval, sensitivity, dedupe))
+    cached = load_cached_result(result_id)
+    
+    if cached:
+        print(f"Cache hit: {result_id}")
+        inc_metric('cache_hits_total', cache='result')
+        return add_job(filename, original_filename, result_id, mode, interval, sensitivity,
+                       frames=cached['frames'], cached=True)
+    
+    with jobs_lock:
+        # 同じ結果を作成中のジョブがあればそれを共有する
+        for other_id, other in jobs.items():
+            if (other['result_id'] == result_id and other['finished_at'] is None
+                    and not other['cancel_requested']):
+                return other_id
+    
+    inc_metric('cache_misses_total', cache='result')
+    job_id = add_job(filename, original_filename, result_id, mode, interval, sensitivity)
+    # 処理中は動画と結果を容量管理の削除対象から外す
+    open(inflight_marker_path(result_id, job_id), 'w').close()
+    
+    args = (job_id, filepath, result_id) + task
+    try:
+        future = get_job_executor().submit(run_job, *args)
+    except BrokenProcessPool:
+        # ワーカーが異常終了していた場合はプールを作り直す
+        with jobs_lock:
+            job_executor = None
+        future = get_job_executor().submit(run_job, *args)
+    
+    with jobs_lock:
+        jobs[job_id]['future'] = future
+    future.add_done_callback(lambda f: finish_job(job_id, f))
+    
+    return job_id
+
+def add_job(filename, original_filename, result_id, mode, interval, sensitivity, frames=None, cached=False):
+    """ジョブ情報を登録（frames を渡すと完了済みとして登録）"""
+    job_id = uuid.uuid4().hex
+    now = time.time()
+    job = {
+        'status': 'done' if frames else 'queued',
+        'video': filename,
+        'original_filename': original_filename,
+        'result_id': result_id,
+        'cached': cached,
+        'mode': mode,
+        'interval': interval,
+        'sensitivity': sensitivity,
+        'frames': frames,
+        'error': None,
+        'cancel_requested': False,
+        'usage': None,
+        'created_at': now,
+        'finished_at': now if frames else None,
+        'future': None
+    }
+    
+    # 別プロセス（gunicorn の他のワーカー）からも参照できるようイベントファイルの先頭に記録する
+    record = {key: job[key] for key in JOB_RECORD_FIELDS}
+    events = [{'type': 'job', 'job': dict(record, status='queued')}]
+    if frames:
+        # 完了済みのジョブはシーンと完了をまとめて書いておく
+        events += [{'type': 'scene', 'timestamp': frame_info['timestamp']} for frame_info in frames]
+        events.append(terminal_event(job))
+    with open(job_events_path(job_id), 'w', encoding='utf-8') as f:
+        f.write(''.join(json.dumps(event) + '\n' for event in events))
+    
+    with jobs_lock:
+        prune_finished_jobs()
+        jobs[job_id] = job
+    
+    return job_id
+
+def terminal_event(job):
+    """完了・失敗・中断を表すイベント"""
+    event = {'type': job['status'], 'error': job['error'], 'usage': job['usage'], 'finished_at': job['finished_at']}
+    if job['status'] == 'done':
+        event['frames'] = len(job['frames'])
+        event['result_id'] = job['result_id']
+    return event
+
+def finish_job(job_id, future):
+    """ジョブ完了時に結果を記録"""
+    try:
+        os.remove(cancel_flag_path(job_id))
+    except OSError:
+        pass
+    
+    usage = None
+    try:
+        result = future.result()
+        usage = result['usage']
+        if result['frames']:
+            status, frames, error = 'done', result['frames'], None
+        else:
+            status, frames, error = 'error', None, 'Video processing failed'
+    except (CancelledError, JobCancelled) as e:
+        usage = getattr(e, 'resource_usage', None)
+        status, frames, error = 'cancelled', None, 'Job cancelled'
+    except Exception as e:
+        print(f"Job {job_id} failed: {e}")
+        usage = getattr(e, 'resource_usage', None)
+        status, frames, error = 'error', None, str(e)
+    
+    with jobs_lock:
+        job = jobs.get(job_id)
+        if job is None:
+            return
+        
+        try:
+            os.remove(inflight_marker_path(job['result_id'], job_id))
+        except OSError:
+            pass
+        
+        job.update(status=status, frames=frames, error=error, usage=usage,
+                   finished_at=time.time(), future=None)
+        event = terminal_event(job)
+    
+    append_job_event(job_events_path(job_id), event)
+
+def cancel_job(job_id):
+    """ジョブの中断を要求（待機中なら取り消し、実行中ならFFmpegを停止させる）"""
+    with jobs_lock:
+        job = jobs.get(job_id)
+        if job is not None:
+            if job['finished_at'] is not None:
+                return job
+            job['cancel_requested'] = True
+            future = job['future']
+    
+    if job is None:
+        # 別プロセスのジョブはフラグファイルだけで伝える
+        job = load_job_from_events(job_id)
+        if job is None or job['finished_at'] is not None:
+            return job
+        future = None
+    
+    if future is None or not future.cancel():
+        # ワーカープロセスへはフラグファイルで伝える
+        with open(cancel_flag_path(job_id), 'w'):
+            pass
+    return job
+
+def get_job(job_id):
+    """ジョブ情報のスナップショットを取得（このプロセスに無ければイベントファイルから読む）"""
+    with jobs_lock:
+        job = jobs.get(job_id)
+        if job is None:
+            snapshot = future = None
+        else:
+            snapshot = {key: value for key, value in job.items() if key != 'future'}
+            future = job['future']
+    
+    if snapshot is None:
+        return load_job_from_events(job_id)
+    if snapshot['status'] == 'queued' and future is not None and future.running():
+        snapshot['status'] = 'running'
+    return snapshot
+
+def load_job_from_events(job_id):
+    """イベントファイルからジョブ情報を復元する（なければNone）"""
+    if not JOB_ID_PATTERN.match(job_id):
+        return None
+    
+    job = None
+    try:
+        with open(job_events_path(job_id), encoding='utf-8') as f:
+            for line in f:
+                if not line.endswith('\n'):
+                    break
+                event = json.loads(line)
+                if event['type'] == 'job':
+                    job = dict(event['job'], frames=None, error=None, usage=None, finished_at=None)
+                elif job is None:
+                    break
+                elif event['type'] == 'status':
+                    job['status'] = event['status']
+                elif event['type'] in TERMINAL_EVENTS:
+                    job.update(status=event['type'], error=event['error'], usage=event['usage'],
+                               finished_at=event['finished_at'])
+    except (OSError, ValueError, KeyError):
+        return None
+    if job is None:
+        return None
+    
+    job['cancel_requested'] = job['finished_at'] is None and os.path.exists(cancel_flag_path(job_id))
+    if job['status'] == 'done':
+        cached = load_cached_result(job['result_id'])
+        if cached is None:
+            # 容量管理で結果が削除された
+            job['status'] = 'error'
+            job['error'] = 'Result is no longer available'
+        else:
+            job['frames'] = cached['frames']
+    return job
+
+def prune_finished_jobs():
+    """古い完了済みジョブを削除（jobs_lock 取得中に呼ぶ）"""
+    finished = [job_id for job_id, job in jobs.items() if job['finished_at'] is not None]
+    if len(finished) <= JOB_HISTORY_LIMIT:
+        return
+    
+    finished.sort(key=lambda job_id: jobs[job_id]['finished_at'])
+    for job_id in finished[:len(finished) - JOB_HISTORY_LIMIT]:
+        del jobs[job_id]
+        try:
+            os.remove(job_events_path(job_id))
+        except OSError:
+            pass
+
+# ---------------------------------------------------------------------------
+# FFmpegプロセスの実行（stderr を一定メモリで1行ずつ読み、ジョブから中断できるようにする）
+# ---------------------------------------------------------------------------
+
+# エラー表示用に保持する stderr の末尾の行数
+STDERR_TAIL_LINES = 20
+# 中断要求とタイムアウトを確認する間隔（秒）
+CANCEL_CHECK_INTERVAL = 0.5
+
+# ワーカープロセスで実行中のジョブ（中断要求の確認と進捗の報告に使う）
+job_context = {'cancel_path': None, 'progress': None, 'usage': None}
+
+class JobCancelled(Exception):
+    """中断要求によりジョブが停止した"""
+
+def cancel_flag_path(job_id):
+    """ワーカープロセスへ中断を伝えるフラグファイルのパス"""
+    return os.path.join(SCENES_FOLDER, f'.cancel-{job_id}')
+
+def job_cancel_requested():
+    """実行中のジョブに中断要求が出ているか"""
+    cancel_path = job_context['cancel_path']
+    return cancel_path is not None and os.path.exists(cancel_path)
+
+class FFmpegProcess:
+    """FFmpeg/ffprobe のサブプロセスのハンドル（stderr は全体を保持せず1行ずつ読む）"""
+    
+    def __init__(self, cmd, timeout=120, stdin=None, stdout=subprocess.DEVNULL, threads=None, parallel=1):
+        # threads 未指定の ffmpeg はスレッド予算から割り当てを受ける（空くまで待つ）
+        self.slots = []
+        if threads is None and FFMPEG_THREAD_BUDGET > 0 and os.path.basename(cmd[0]) == 'ffmpeg':
+            self.slots = acquire_ffmpeg_threads(ffmpeg_thread_share(parallel))
+            threads = len(self.slots)
+        if threads:
+            cmd = with_thread_options(cmd, threads)
+        self.usage = None
+        self.reap_lock = threading.Lock()
+        self.started = time.monotonic()
+        self.wall_seconds = None
+        try:
+            self.process = subprocess.Popen(cmd, stdin=stdin, stdout=stdout, stderr=subprocess.PIPE)
+        except Exception:
+            self.release_threads()
+            raise
+        apply_ffmpeg_rlimits(self.process.pid)
+        # universal newlines により進捗表示の \r も行区切りとして扱う
+        self.stderr = io.TextIOWrapper(self.process.stderr, errors='replace')
+        self.tail = collections.deque(maxlen=STDERR_TAIL_LINES)
+        self.returncode = None
+        self.cancelled = False
+        self.timed_out = False
+        self.timeout = None
+        self.deadline = None
+        self.reader = None
+        self.finished = threading.Event()
+        
+        self.expire_after(timeout)
+        watcher = threading.Thread(target=self._watch, daemon=True)
+        watcher.start()
+    
+    def expire_after(self, timeout):
+        """今から timeout 秒後に強制終了する（None で無効）"""
+        self.timeout = timeout
+        self.deadline = time.monotonic() + timeout if timeout is not None else None
+    
+    def _watch(self):
+        """タイムアウトと中断要求を監視する"""
+        while not self.finished.wait(CANCEL_CHECK_INTERVAL):
+            if self.poll() is not None:
+                break
+            if self.deadline is not None and time.monotonic() >= self.deadline:
+                self.timed_out = True
+                self.kill()
+            elif job_cancel_requested():
+                self.cancel()
+        if self.poll() is not None:
+            self.release_threads()
+    
+    def poll(self):
+        """終了していれば終了コードを返す（回収時に資源使用量も記録する）"""
+        return self._reap(block=False)
+    
+    def _reap(self, block):
+        # Popen.poll/wait で回収すると使用量が取れないため wait4 で回収する
+        with self.reap_lock:
+            if self.process.returncode is not None:
+                return self.process.returncode
+            if not hasattr(os, 'wait4'):
+                return self.process.wait() if block else self.process.poll()
+            try:
+                pid, status, usage = os.wait4(self.process.pid, 0 if block else os.WNOHANG)
+            except ChildProcessError:
+                return self.process.wait() if block else self.process.poll()
+            if pid == 0:
+                return None
+            self.process.returncode = os.waitstatus_to_exitcode(status)
+            self.usage = usage
+            self.wall_seconds = time.monotonic() - self.started
+        record_ffmpeg_usage(self)
+        return self.process.returncode
+    
+    def release_threads(self):
+        """割り当てられたスレッドを予算へ返す"""
+        slots, self.slots = self.slots, []
+        release_slots(slots)
+    
+    def lines(self):
+        """stderr を1行ずつ返す（末尾の行だけエラー表示用に保持）"""
+        for line in self.stderr:
+            self.tail.append(line)
+            yield line
+    
+    def drain_in_background(self):
+        """stdout を読む間も stderr のパイプが詰まらないよう別スレッドで読み捨てる"""
+        def drain():
+            for _ in self.lines():
+                pass
+        
+        self.reader = threading.Thread(target=drain, daemon=True)
+        self.reader.start()
+    
+    @property
+    def stderr_tail(self):
+        return ''.join(self.tail)
+    
+    def cancel(self):
+        """処理を中断する（wait() は JobCancelled を送出する）"""
+        self.cancelled = True
+        self.kill()
+    
+    def kill(self):
+        if self.poll() is None:
+            self.process.kill()
+    
+    def wait(self):
+        """終了を待って終了コードを返す"""
+        try:
+            if self.reader is not None:
+                self.reader.join()
+            else:
+                # 読み残しの stderr を捨てる
+                for _ in self.lines():
+                    pass
+        finally:
+            self.kill()
+            self.returncode = self._reap(block=True)
+            self.release_threads()
+            self.finished.set()
+            self.stderr.close()
+        
+        if self.cancelled:
+            raise JobCancelled('Job cancelled')
+        program = os.path.basename(self.process.args[0])
+        if self.timed_out:
+            inc_metric('ffmpeg_failures_total', program=program, reason='timeout')
+            raise subprocess.TimeoutExpired(self.process.args, self.timeout, stderr=self.stderr_tail)
+        if self.returncode != 0:
+            reason = self.failure_reason()
+            if reason != 'exit':
+                print(f"{program} stopped: {reason} (exit status {self.returncode})")
+            inc_metric('ffmpeg_failures_total', program=program, reason=reason)
+        return self.returncode
+    
+    def failure_reason(self):
+        """異常終了の理由（資源の上限によるものか）"""
+        if -self.returncode in RLIMIT_SIGNALS:
+            return RLIMIT_SIGNALS[-self.returncode]
+        # FFmpeg は SIGXCPU を捕まえて通常のエラー終了をする
+        if (FFMPEG_CPU_LIMIT and self.usage is not None
+                and self.usage.ru_utime + self.usage.ru_stime >= FFMPEG_CPU_LIMIT):
+            return 'cpu_limit'
+        # アドレス空間の上限ではメモリ確保に失敗してシグナルで落ちることが多い
+        if self.returncode < 0:
+            return 'signal'
+        return 'exit'
+
+def run_ffmpeg(cmd, timeout=120, threads=None):
+    """FFmpegを実行して終了を待つ（ログは末尾だけ残る）"""
+    ffmpeg = FFmpegProcess(cmd, timeout, threads=threads)
+    ffmpeg.wait()
+    return ffmpeg
+
+def run_ffprobe(cmd, timeout=30):
+    """出力の短い ffprobe を実行して標準出力を返す"""
+    ffprobe = FFmpegProcess(cmd, timeout, stdout=subprocess.PIPE)
+    ffprobe.drain_in_background()
+    with ffprobe.process.stdout as stdout:
+        output = stdout.read()
+    ffprobe.wait()
+    return output.decode('utf-8', errors='replace')
+
+# ---------------------------------------------------------------------------
+# FFmpegの資源使用量の記録と制限（1つの異常なファイルがサーバー全体を使い切らないようにする）
+# ---------------------------------------------------------------------------
+
+# FFmpeg/ffprobe 1プロセスあたりの上限（0 で無制限）
+# CPU時間（秒）
+FFMPEG_CPU_LIMIT = int(os.environ.get('FFMPEG_CPU_LIMIT', 0))
+# アドレス空間（バイト）
+FFMPEG_MEMORY_LIMIT = int(os.environ.get('FFMPEG_MEMORY_LIMIT', 0))
+# 書き出すファイル1つの大きさ（バイト）
+FFMPEG_FILE_SIZE_LIMIT = int(os.environ.get('FFMPEG_FILE_SIZE_LIMIT', 1024 * 1024 * 1024))
+
+try:
+    import resource
+except ImportError:
+    # Windows では制限を掛けない
+    resource = None
+
+# 上限に達したときに送られるシグナル → 失敗の理由
+RLIMIT_SIGNALS = {}
+if resource is not None:
+    RLIMIT_SIGNALS = {signal.SIGXCPU: 'cpu_limit', signal.SIGXFSZ: 'file_size_limit'}
+
+# ru_maxrss の単位（Linux は KiB、macOS はバイト）
+MAXRSS_UNIT = 1 if sys.platform == 'darwin' else 1024
+
+usage_lock = threading.Lock()
+
+def ffmpeg_rlimits():
+    """子プロセスに掛ける (リソース, (ソフト, ハード)) の一覧"""
+    if resource is None:
+        return []
+    
+    limits = []
+    for name, value in (('RLIMIT_CPU', FFMPEG_CPU_LIMIT), ('RLIMIT_AS', FFMPEG_MEMORY_LIMIT),
+                        ('RLIMIT_FSIZE', FFMPEG_FILE_SIZE_LIMIT)):
+        if value <= 0 or not hasattr(resource, name):
+            continue
+        kind = getattr(resource, name)
+        _, hard = resource.getrlimit(kind)
+        # CPU はソフト上限で SIGXCPU、ハード上限で SIGKILL になるので1秒の猶予を置く
+        soft_value = value
+        hard_value = value + 1 if name == 'RLIMIT_CPU' else value
+        if hard != resource.RLIM_INFINITY:
+            soft_value = min(soft_value, hard)
+            hard_value = min(hard_value, hard)
+        limits.append((kind, (soft_value, hard_value)))
+    return limits
+
+def apply_ffmpeg_rlimits(pid):
+    """起動した子プロセスに上限を設定する
+    
+    preexec_fn はスレッドのあるプロセスで fork すると子がデッドロックし得るため使わず、
+    起動直後に prlimit で外から設定する（CPU時間は起動時からの累計で数えられる）。
+    """
+    if resource is None or not hasattr(resource, 'prlimit'):
+        return
+    for kind, value in ffmpeg_rlimits():
+        try:
+            resource.prlimit(pid, kind, value)
+        except ProcessLookupError:
+            # すでに終了している
+            return
+        except OSError as e:
+            print(f"FFmpeg: could not set resource limit: {e}")
+
+def record_ffmpeg_usage(ffmpeg):
+    """終了したFFmpegの使用量をメトリクスと実行中ジョブの集計に加える"""
+    usage = ffmpeg.usage
+    cpu_seconds = usage.ru_utime + usage.ru_stime
+    peak_rss = usage.ru_maxrss * MAXRSS_UNIT
+    inc_metric('ffmpeg_cpu_seconds_total', cpu_seconds, program=os.path.basename(ffmpeg.process.args[0]))
+    
+    totals = job_context['usage']
+    if totals is None:
+        return
+    with usage_lock:
+        totals['processes'] += 1
+        totals['cpu_seconds'] += cpu_seconds
+        totals['wall_seconds'] += ffmpeg.wall_seconds
+        totals['peak_rss_bytes'] = max(totals['peak_rss_bytes'], peak_rss)
+
+def new_job_usage():
+    """ジョブ1件分のFFmpegの使用量（壁時計時間は各プロセスの合計）"""
+    return {'processes': 0, 'cpu_seconds': 0.0, 'wall_seconds': 0.0, 'peak_rss_bytes': 0}
+
+def format_job_usage(usage):
+    return (f"{usage['processes']} ffmpeg processes, cpu {usage['cpu_seconds']:.1f}s, "
+            f"wall {usage['wall_seconds']:.1f}s, peak rss {usage['peak_rss_bytes'] / (1024 * 1024):.0f}MB, "
+            f"elapsed {usage['elapsed_seconds']:.1f}s")
+
+# ---------------------------------------------------------------------------
+# FFmpegのスレッド予算（同時に動く全プロセスのFFmpegでCPUコア数を分け合う）
+# ---------------------------------------------------------------------------
+
+# 全プロセスのFFmpegで共有するスレッド数（0 で無効: FFmpeg の自動設定のまま）
+FFMPEG_THREAD_BUDGET = int(os.environ.get('FFMPEG_THREAD_BUDGET', os.cpu_count() or 2))
+# 1プロセスに割り当てる最大スレッド数（デコーダーはこれ以上増やしても速くならない）
+FFMPEG_MAX_THREADS = int(os.environ.get('FFMPEG_MAX_THREADS', 16))
+# 予算の1スレッドを1ファイルのロックで表す（プロセスが落ちればロックも外れる）
+FFMPEG_SLOT_DIRNAME = '.ffmpeg-slots'
+# 予算が空くのを待つ間の確認間隔（秒）
+FFMPEG_SLOT_POLL_INTERVAL = 0.1
+
+# 値を取らない FFmpeg のオプション（それ以外のオプションは次の引数を値とし、残りを出力先とみなす）
+FFMPEG_FLAG_OPTIONS = frozenset(('-y', '-n', '-an', '-vn', '-sn', '-dn', '-nostdin', '-hide_banner', '-stats',
+                                 '-nostats', '-copyts', '-re', '-shortest', '-accurate_seek', '-noaccurate_seek'))
+
+# fcntl が無い環境ではプロセス内だけでスロットを管理する
+slot_lock = threading.Lock()
+local_slots = set()
+
+def active_job_count():
+    """実行中のジョブ数（処理中の印から数えるため別プロセスのジョブも含む）"""
+    count = 0
+    now = time.time()
+    try:
+        with os.scandir(SCENES_FOLDER) as entries:
+            for entry in entries:
+                if not entry.name.startswith('.inflight-'):
+                    continue
+                try:
+                    if now - entry.stat().st_mtime <= INFLIGHT_MAX_AGE:
+                        count += 1
+                except OSError:
+                    pass
+    except OSError:
+        pass
+    return count
+
+def ffmpeg_thread_share(parallel=1):
+    """実行中のジョブで予算を等分し、ジョブ内の並列数でさらに割ったスレッド数"""
+    share = FFMPEG_THREAD_BUDGET // max(1, active_job_count()) // max(1, parallel)
+    return max(1, min(share, FFMPEG_MAX_THREADS))
+
+def try_acquire_slots(dirname, capacity, count):
+    """capacity 個のスロットのうち空いているものを最大 count 個確保する（空きが無ければ空リスト）"""
+    if fcntl is None:
+        with slot_lock:
+            slots = [(dirname, i) for i in range(capacity) if (dirname, i) not in local_slots][:count]
+            local_slots.update(slots)
+        return slots
+    
+    slot_dir = os.path.join(SCENES_FOLDER, dirname)
+    os.makedirs(slot_dir, exist_ok=True)
+    slots = []
+    for i in range(capacity):
+        if len(slots) >= count:
+            break
+        # fork 後の子プロセスとロックを共有しないよう、毎回開き直す
+        handle = open(os.path.join(slot_dir, f'{i:03d}'), 'a')
+        try:
+            fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            handle.close()
+            continue
+        held_lock_files.add(handle)
+        slots.append(handle)
+    return slots
+
+def acquire_ffmpeg_threads(count):
+    """予算から最大 count スレッドを確保する（1つも空いていなければ空くまで待つ）"""
+    waiting_since = None
+    while True:
+        slots = try_acquire_slots(FFMPEG_SLOT_DIRNAME, FFMPEG_THREAD_BUDGET, count)
+        if slots:
+            if waiting_since is not None:
+                print(f"FFmpeg: got {len(slots)} threads after {time.monotonic() - waiting_since:.1f}s")
+            return slots
+        if job_cancel_requested():
+            raise JobCancelled('Job cancelled')
+        if waiting_since is None:
+            waiting_since = time.monotonic()
+            print(f"FFmpeg: all {FFMPEG_THREAD_BUDGET} threads of the budget are in use, waiting")
+        time.sleep(FFMPEG_SLOT_POLL_INTERVAL)
+
+def release_slots(slots):
+    """確保したスロットを返す"""
+    for slot in slots:
+        if isinstance(slot, tuple):
+            with slot_lock:
+                local_slots.discard(slot)
+        else:
+            # 閉じるとロックも外れる
+            held_lock_files.discard(slot)
+            slot.close()
+
+def with_thread_options(cmd, threads):
+    """デコーダー・フィルタ・各出力のエンコーダーのスレッド数を明示したコマンド"""
+    count = str(threads)
+    result = [cmd[0], '-filter_threads', count, '-filter_complex_threads', count]
+    i = 1
+    while i < len(cmd):
+        arg = cmd[i]
+        if arg == '-i':
+            # 入力ごとのデコーダー
+            result += ['-threads', count]
+            result += cmd[i:i + 2]
+            i += 2
+        elif arg in FFMPEG_FLAG_OPTIONS:
+            result.append(arg)
+            i += 1
+        elif arg.startswith('-') and arg != '-':
+            result += cmd[i:i + 2]
+            i += 2
+        else:
+            # オプションの値でも入力でもない引数は出力先（出力ごとのエンコーダー）
+            result += ['-threads', count, arg]
+            i += 1
+    return result
+
+# ---------------------------------------------------------------------------
+# 受付制御（混雑時はアップロードの本文を読み込む前に断る）
+# ---------------------------------------------------------------------------
+
+# アップロードの最大サイズ（0 で無制限。超える本文は読み込まずに 413 を返す）
+MAX_UPLOAD_BYTES = int(os.environ.get('MAX_UPLOAD_BYTES', 4 * 1024 * 1024 * 1024))
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_BYTES or None
+# 全プロセスで同時に受信できるアップロード数（0 で無制限。超えたら 429）
+MAX_ACTIVE_UPLOADS = int(os.environ.get('MAX_ACTIVE_UPLOADS', JOB_WORKERS * 2))
+# 完了していないジョブ（実行中と待機中）の上限（0 で無制限。超えたら 503）
+JOB_QUEUE_LIMIT = int(os.environ.get('JOB_QUEUE_LIMIT', JOB_WORKERS * 4))
+# 断ったときに再試行までの目安として返す秒数
+ADMISSION_RETRY_AFTER = int(os.environ.get('ADMISSION_RETRY_AFTER', 10))
+UPLOAD_SLOT_DIRNAME = '.upload-slots'
+UPLOAD_ENDPOINTS = ('index', 'upload', 'upload_stream')
+# アップロードを伴わずにジョブを登録するエンドポイント（待ち行列の上限だけを確認する）
+JOB_ENDPOINTS = ('rethreshold', 'rededupe')
+
+def queue_status():
+    """ジョブの待ち行列の状況（処理中の印から数えるため全プロセスのジョブを含む）"""
+    depth = active_job_count()
+    return {
+        'depth': depth,
+        'limit': JOB_QUEUE_LIMIT,
+        'workers': JOB_WORKERS,
+        'accepting': not JOB_QUEUE_LIMIT or depth < JOB_QUEUE_LIMIT
+    }
+
+def reject_upload(status, message, error, retry_after=None):
+    """アップロードを断る（画面からの送信はページ、APIはJSONで返す）"""
+    if request.endpoint == 'index':
+        response = make_response(render_template('index.html', error=message), status)
+    else:
+        response = jsonify({'error': error, 'retry_after': retry_after, 'queue': queue_status()})
+        response.status_code = status
+    if retry_after is not None:
+        response.headers['Retry-After'] = str(retry_after)
+    # 読まずに残した本文が次のリクエストと混ざらないよう接続を閉じる
+    response.headers['Connection'] = 'close'
+    return response
+
+@app.before_request
+def admit_upload():
+    """アップロードの本文を読む前に、サイズ・ジョブの待ち行列・同時受信数を確認する（ジョブ登録は待ち行列のみ）"""
+    if request.method != 'POST' or request.endpoint not in UPLOAD_ENDPOINTS + JOB_ENDPOINTS:
+        return None
+    
+    uploading = request.endpoint in UPLOAD_ENDPOINTS
+    length = request.content_length
+    if uploading and MAX_UPLOAD_BYTES and length is not None and length > MAX_UPLOAD_BYTES:
+        return reject_upload(413, f'動画ファイルが大きすぎます（上限 {MAX_UPLOAD_BYTES // (1024 * 1024)}MB）',
+                             'Upload too large')
+    
+    if not queue_status()['accepting']:
+        print(f"Admission: job queue is full ({JOB_QUEUE_LIMIT}), rejecting {request.endpoint}")
+        return reject_upload(503, 'サーバーが混雑しています。しばらく待ってから再度お試しください',
+                             'Server busy: job queue is full', ADMISSION_RETRY_AFTER)
+    
+    if uploading and MAX_ACTIVE_UPLOADS:
+        slots = try_acquire_slots(UPLOAD_SLOT_DIRNAME, MAX_ACTIVE_UPLOADS, 1)
+        if not slots:
+            return reject_upload(429, 'アップロードが混み合っています。しばらく待ってから再度お試しください',
+                                 'Too many concurrent uploads', ADMISSION_RETRY_AFTER)
+        g.upload_slots = slots
+    return None
+
+@app.teardown_request
+def release_upload_slot(exc):
+    """受信が終わったらアップロードの枠を返す"""
+    release_slots(g.pop('upload_slots', []))
+
+@app.errorhandler(RequestEntityTooLarge)
+def upload_too_large(error):
+    """Content-Length の無い本文が上限を超えた"""
+    return reject_upload(413, f'動画ファイルが大きすぎます（上限 {MAX_UPLOAD_BYTES // (1024 * 1024)}MB）',
+                         'Upload too large')
+
+# ---------------------------------------------------------------------------
+# メトリクス（処理時間のヒストグラムと件数を集計し、/metrics で Prometheus 形式に出力）
+# ---------------------------------------------------------------------------
+
+# プロセスごとの集計を書き出すディレクトリ（gunicorn の各ワーカーとジョブのワーカーで共有）
+# PID で生死を判定するので、別のインスタンスと共有しない場所にする
+METRICS_FOLDER = os.environ.get('METRICS_DIR') or os.path.join(SCENES_FOLDER, '.metrics')
+# 終了したプロセスの集計をまとめておくファイル
+METRICS_MERGED_FILENAME = 'merged.json'
+METRICS_FILE_PATTERN = re.compile(r'^(\d+)-[0-9a-f]{8}\.json$')
+# 集計をファイルへ書き出す間隔（秒）
+METRICS_FLUSH_INTERVAL = 5
+METRICS_PREFIX = 'video_cut_viewer_'
+# ヒストグラムのバケットの上限（秒）
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+# 名前: (種類, 説明)
+METRICS = {
+    'upload_save_seconds': ('histogram', 'Time to receive, hash and store an uploaded video'),
+    'probe_seconds': ('histogram', 'Time spent in ffprobe'),
+    'detection_seconds': ('histogram', 'Time of the detection / extraction pass of a job'),
+    'frame_extract_seconds': ('histogram', 'Time to extract a single frame by seeking'),
+    'pdf_build_seconds': ('histogram', 'Time to build a PDF report'),
+    'file_serve_seconds': ('histogram', 'Time until a file response is ready'),
+    'bytes_processed_total': ('counter', 'Bytes of uploaded video received'),
+    'frames_produced_total': ('counter', 'Frames stored by extraction'),
+    'cache_hits_total': ('counter', 'Lookups answered from a cache'),
+    'cache_misses_total': ('counter', 'Lookups that had to build the result'),
+    'ffmpeg_failures_total': ('counter', 'ffmpeg processes that exited with an error or timed out'),
+    'ffmpeg_cpu_seconds_total': ('counter', 'CPU seconds used by ffmpeg processes'),
+    'job_queue_depth': ('gauge', 'Unfinished jobs (running and waiting) on this node'),
+}
+# 配信時間を計測するエンドポイント
+METRICS_FILE_ENDPOINTS = ('serve_scene_file', 'serve_uploaded_file', 'frame_at', 'serve_thumbnail',
+                          'serve_sprite_sheet', 'export_pdf', 'export_zip')
+
+metrics_lock = threading.Lock()
+metrics_values = {}
+metrics_state = {'dirty': False, 'flusher': None, 'path': None}
+
+def reset_metrics_after_fork():
+    """fork した子プロセスは親の集計を引き継がない（二重に数えないよう空から始める）"""
+    global metrics_lock
+    metrics_lock = threading.Lock()
+    metrics_values.clear()
+    metrics_state.update({'dirty': False, 'flusher': None, 'path': None})
+
+os.register_at_fork(after_in_child=reset_metrics_after_fork)
+
+def inc_metric(name, amount=1, **labels):
+    """カウンターを増やす"""
+    key = (name, tuple(sorted(labels.items())))
+    with metrics_lock:
+        metrics_values[key] = metrics_values.get(key, 0) + amount
+        mark_metrics_dirty()
+
+def observe_metric(name, value, **labels):
+    """ヒストグラムに値を記録する（累積は出力時に計算する）"""
+    key = (name, tuple(sorted(labels.items())))
+    with metrics_lock:
+        histogram = metrics_values.get(key)
+        if histogram is None:
+            histogram = metrics_values[key] = {'buckets': [0] * len(METRICS_BUCKETS), 'sum': 0.0, 'count': 0}
+        index = bisect.bisect_left(METRICS_BUCKETS, value)
+        if index < len(METRICS_BUCKETS):
+            histogram['buckets'][index] += 1
+        histogram['sum'] += value
+        histogram['count'] += 1
+        mark_metrics_dirty()
+
+class MetricTimer:
+    """with 文の区間の経過時間をヒストグラムに記録する"""
+    
+    def __init__(self, name, **labels):
+        self.name = name
+        self.labels = labels
+        self.start = None
+    
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+    
+    def __exit__(self, *exc_info):
+        observe_metric(self.name, time.monotonic() - self.start, **self.labels)
+        return False
+
+def mark_metrics_dirty():
+    """変更を記録し、初回は書き出しスレッドを起動する（metrics_lock 取得中に呼ぶ）"""
+    metrics_state['dirty'] = True
+    if metrics_state['flusher'] is None:
+        metrics_state['flusher'] = threading.Thread(target=run_metrics_flusher, daemon=True)
+        metrics_state['flusher'].start()
+
+def run_metrics_flusher():
+    while True:
+        time.sleep(METRICS_FLUSH_INTERVAL)
+        flush_metrics()
+
+def flush_metrics():
+    """このプロセスの集計をファイルへ書き出す（変更がなければ何もしない）"""
+    with metrics_lock:
+        if not metrics_state['dirty']:
+            return
+        metrics_state['dirty'] = False
+        data = json.dumps([[name, labels, value] for (name, labels), value in metrics_values.items()])
+        if metrics_state['path'] is None:
+            # 再起動で同じ PID になっても別のファイルにする
+            metrics_state['path'] = os.path.join(METRICS_FOLDER, f'{os.getpid()}-{uuid.uuid4().hex[:8]}.json')
+        path = metrics_state['path']
+    
+    try:
+        os.makedirs(METRICS_FOLDER, exist_ok=True)
+        tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"Metrics flush error: {e}")
+
+atexit.register(flush_metrics)
+
+def process_alive(pid):
+    """このホストでプロセスが動いているか"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        # 権限がないだけなら動いている
+        return True
+    return True
+
+def read_metrics_file(path):
+    """書き出した集計を読む（読めなければ None）"""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def merge_metric_entries(totals, entries):
+    """[名前, ラベル, 値] の並びを totals に足し込む"""
+    for name, labels, value in entries:
+        key = (name, tuple(tuple(pair) for pair in labels))
+        if not isinstance(value, dict):
+            totals[key] = totals.get(key, 0) + value
+            continue
+        # バケットの定義が変わる前のファイルは合算しない
+        if len(value['buckets']) != len(METRICS_BUCKETS):
+            continue
+        total = totals.setdefault(key, {'buckets': [0] * len(METRICS_BUCKETS), 'sum': 0.0, 'count': 0})
+        total['buckets'] = [a + b for a, b in zip(total['buckets'], value['buckets'])]
+        total['sum'] += value['sum']
+        total['count'] += value['count']
+
+def merge_dead_metrics(filenames):
+    """終了したプロセスのファイルを1つにまとめて削除する（カウンターは減らさずファイルだけ増やさない）"""
+    dead = []
+    for filename in filenames:
+        match = METRICS_FILE_PATTERN.match(filename)
+        if match and int(match.group(1)) != os.getpid() and not process_alive(int(match.group(1))):
+            dead.append(filename)
+    if not dead or fcntl is None:
+        return
+    
+    try:
+        with open(os.path.join(METRICS_FOLDER, '.lock'), 'a') as lock_file:
+            # 別のプロセスがまとめている最中なら今回は見送る（二重に足さない）
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return
+            merged_path = os.path.join(METRICS_FOLDER, METRICS_MERGED_FILENAME)
+            totals = {}
+            merge_metric_entries(totals, read_metrics_file(merged_path) or [])
+            merged = []
+            for filename in dead:
+                path = os.path.join(METRICS_FOLDER, filename)
+                entries = read_metrics_file(path)
+                # 待つ間に他のプロセスがまとめて消した
+                if entries is None:
+                    continue
+                merge_metric_entries(totals, entries)
+                merged.append(path)
+            if not merged:
+                return
+            tmp_path = f'{merged_path}.{uuid.uuid4().hex}.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump([[name, labels, value] for (name, labels), value in totals.items()], f)
+            os.replace(tmp_path, merged_path)
+            for path in merged:
+                os.remove(path)
+    except OSError as e:
+        print(f"Metrics merge error: {e}")
+
+def collect_metrics():
+    """全プロセスの集計を合算する"""
+    flush_metrics()
+    totals = {}
+    try:
+        merge_dead_metrics(os.listdir(METRICS_FOLDER))
+        filenames = os.listdir(METRICS_FOLDER)
+    except OSError:
+        filenames = []
+    
+    for filename in filenames:
+        if not filename.endswith('.json'):
+            continue
+        entries = read_metrics_file(os.path.join(METRICS_FOLDER, filename))
+        if entries is not None:
+            merge_metric_entries(totals, entries)
+    
+    totals[('job_queue_depth', ())] = queue_status()['depth']
+    return totals
+
+def format_metric_labels(labels):
+    """ラベルを {key="value",...} の形に整形する"""
+    if not labels:
+        return ''
+    pairs = []
+    for key, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{key}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+def render_metrics(totals):
+    """Prometheus のテキスト形式に整形する"""
+    lines = []
+    for name, (kind, description) in METRICS.items():
+        metric = METRICS_PREFIX + name
+        lines.append(f'# HELP {metric} {description}')
+        lines.append(f'# TYPE {metric} {kind}')
+        for (key_name, labels), value in sorted(totals.items(), key=lambda item: item[0]):
+            if key_name != name:
+                continue
+            if kind != 'histogram':
+                lines.append(f'{metric}{format_metric_labels(labels)} {value}')
+                continue
+            cumulative = 0
+            for bound, count in zip(METRICS_BUCKETS, value['buckets']):
+                cumulative += count
+                lines.append(f'{metric}_bucket{format_metric_labels(labels + (("le", f"{bound:g}"),))} {cumulative}')
+            lines.append(f'{metric}_bucket{format_metric_labels(labels + (("le", "+Inf"),))} {value["count"]}')
+            lines.append(f'{metric}_sum{format_metric_labels(labels)} {value["sum"]}')
+            lines.append(f'{metric}_count{format_metric_labels(labels)} {value["count"]}')
+    return '\n'.join(lines) + '\n'
+
+@app.route('/metrics')
+def metrics():
+    """全プロセスのメトリクスを Prometheus のテキスト形式で返す"""
+    response = make_response(render_metrics(collect_metrics()))
+    response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.monotonic()
+
+@app.after_request
+def observe_file_serving(response):
+    """ファイル配信の応答を返せるまでの時間を記録する"""
+    if request.endpoint in METRICS_FILE_ENDPOINTS and 'request_started' in g:
+        observe_metric('file_serve_seconds', time.monotonic() - g.request_started, endpoint=request.endpoint)
+    return response
+
+# ---------------------------------------------------------------------------
+# ジョブの進捗イベント（ワーカープロセスがファイルへ追記し、/jobs/<id>/events で配信）
+# ---------------------------------------------------------------------------
+
+# 進捗イベントを書き出す最短間隔（秒）
+PROGRESS_EVENT_INTERVAL = 0.5
+# イベント配信で接続維持用のコメントを送る間隔（秒）
+EVENT_KEEPALIVE_SECONDS = 15
+# 1回の接続でイベントを配信する最長時間（秒）。超えたら切り、クライアントに続きから再接続させる
+EVENT_STREAM_MAX_SECONDS = int(os.environ.get('EVENT_STREAM_MAX_SECONDS', 60))
+# 切断後にブラウザが再接続するまでの時間（ミリ秒）
+EVENT_RETRY_MILLISECONDS = 1000
+# 再開位置の直前のイベントを探すために読み戻す長さ（バイト）
+EVENT_LOOKBACK_BYTES = 4096
+FRAME_NUMBER_PATTERN = re.compile(r'^([a-z]+)_(\d+)\.jpg$')
+STATS_PATTERN = re.compile(r'frame=\s*(\d+).*?time=\s*(\d+):(\d+):(\d+(?:\.\d+)?)')
+
+def job_events_path(job_id):
+    """ジョブのイベントを追記する NDJSON ファイルのパス"""
+    return os.path.join(SCENES_FOLDER, f'.events-{job_id}.ndjson')
+
+def previous_job_event(path, offset):
+    """イベントファイルの offset の直前の行のイベント（offset が行の区切りでなければ ValueError）"""
+    if offset == 0:
+        return None
+    start = max(0, offset - EVENT_LOOKBACK_BYTES)
+    with open(path, 'rb') as f:
+        f.seek(start)
+        data = f.read(offset - start)
+    if len(data) != offset - start or not data.endswith(b'\n'):
+        raise ValueError('Offset is not at an event boundary')
+    
+    lines = data[:-1].split(b'\n')
+    if start > 0 and len(lines) == 1:
+        # 直前の行が長すぎて読み切れない（終わりのイベントは短いので該当しない）
+        return None
+    try:
+        return json.loads(lines[-1])
+    except ValueError:
+        return None
+
+def append_job_event(path, event):
+    """イベントを1行のJSONとして追記する"""
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write(json.dumps(event) + '\n')
+
+class JobProgress:
+    """ワーカープロセスでデコード位置と検出したシーンをイベントとして書き出す"""
+    
+    def __init__(self, events_path, duration):
+        self.events_path = events_path
+        self.duration = duration
+        # セグメントごとのデコード済みの長さ（秒）
+        self.positions = {}
+        self.last_percent = None
+        self.last_emit = 0.0
+        self.lock = threading.Lock()
+    
+    def update(self, key, seconds):
+        """key のデコード済みの長さを更新し、一定間隔で進捗率を書き出す"""
+        if not self.duration:
+            return
+        
+        with self.lock:
+            self.positions[key] = max(0.0, seconds)
+            now = time.monotonic()
+            if now - self.last_emit < PROGRESS_EVENT_INTERVAL:
+                return
+            
+            position = sum(self.positions.values())
+            # 100% は完了イベントで通知する
+            percent = round(min(99.0, 100.0 * position / self.duration), 1)
+            if percent == self.last_percent:
+                return
+            self.last_emit = now
+            self.last_percent = percent
+            append_job_event(self.events_path, {
+                'type': 'progress',
+                'percent': percent,
+                'position': round(position, 3),
+                'duration': self.duration
+            })
+    
+    def scene(self, timestamp):
+        """書き出したフレームの時刻を通知"""
+        with self.lock:
+            append_job_event(self.events_path, {'type': 'scene', 'timestamp': round(timestamp, 3)})
+
+def report_progress(key, seconds):
+    """実行中のジョブに進捗を報告（ジョブ外では何もしない）"""
+    progress = job_context['progress']
+    if progress is not None:
+        progress.update(key, seconds)
+
+def report_scene(timestamp):
+    """実行中のジョブに書き出したフレームの時刻を報告（ジョブ外では何もしない）"""
+    progress = job_context['progress']
+    if progress is not None:
+        progress.scene(timestamp)
+
+def parse_stats_line(line):
+    """FFmpeg の進捗表示（frame= ... time=...）から出力フレーム数と時刻を取り出す"""
+    match = STATS_PATTERN.search(line)
+    if match is None:
+        return None
+    hours, minutes, seconds = match.group(2, 3, 4)
+    return int(match.group(1)), int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+def report_interval_progress(lines, interval_sec, first_tick=0.0, segment=None):
+    """定間隔抽出の進捗表示から、デコード位置と書き出したフレームの時刻を報告"""
+    start = segment['start'] if segment else 0.0
+    end = segment['end'] if segment else None
+    reported = 0
+    
+    for line in lines:
+        stats = parse_stats_line(line)
+        if stats is None:
+            continue
+        
+        frames, seconds = stats
+        position = first_tick + seconds
+        if end is not None:
+            position = min(position, end)
+        report_progress(start, position - start)
+        
+        while reported < frames:
+            timestamp = first_tick + reported * interval_sec
+            if end is None or timestamp < end:
+                report_scene(timestamp)
+            reported += 1
+
+@app.route('/jobs/<job_id>/events')
+def job_events(job_id):
+    """ジョブの進捗と検出したシーンを Server-Sent Events（?format=ndjson で NDJSON）で配信
+    
+    接続は EVENT_STREAM_MAX_SECONDS で切り、各イベントの id（イベントファイル内の位置）から再開できる。
+    SSE はブラウザが Last-Event-ID を付けて自動で再接続し、NDJSON は ?offset= で続きを取得する。
+    """
+    job = get_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    
+    ndjson = request.args.get('format') == 'ndjson'
+    video = job['video']
+    events_path = job_events_path(job_id)
+    try:
+        start_offset = max(0, int(request.headers.get('Last-Event-ID') or request.args.get('offset') or 0))
+        # 行の途中からは読まない
+        previous = previous_job_event(events_path, start_offset)
+    except (OSError, ValueError):
+        return jsonify({'error': 'Invalid event offset'}), 400
+    
+    def encode(event, offset=None):
+        if event['type'] == 'scene':
+            # 抽出結果の確定前でも表示できるよう、任意時刻のフレームURLを付ける
+            event['thumbnail_url'] = frame_url(video, event['timestamp'], 'small')
+        elif event['type'] == 'done':
+            event['percent'] = 100
+            event['scenes_url'] = url_for('result_scenes', result_id=event['result_id'])
+            event['page_url'] = url_for('index', job=job_id)
+        if ndjson:
+            if offset is not None:
+                event['offset'] = offset
+            return json.dumps(event) + '\n'
+        event_id = f'id: {offset}\n' if offset is not None else ''
+        return f"{event_id}event: {event['type']}\ndata: {json.dumps(event)}\n\n"
+    
+    def generate():
+        offset = start_offset
+        started = last_sent = time.monotonic()
+        if not ndjson:
+            # 接続を切ったあと再接続するまでの待ち時間
+            yield f'retry: {EVENT_RETRY_MILLISECONDS}\n\n'
+        if previous is not None and previous['type'] in TERMINAL_EVENTS:
+            # 終わりのイベントまで送信済み（終わりのイベントの後には何も追記されない）
+            yield encode(previous, offset)
+            return
+        
+        while True:
+            # ワーカーが追記したイベントを続きから読む
+            try:
+                with open(events_path, encoding='utf-8') as f:
+                    f.seek(offset)
+                    while True:
+                        line = f.readline()
+                        if not line.endswith('\n'):
+                            break
+                        offset += len(line.encode('utf-8'))
+                        try:
+                            event = json.loads(line)
+                        except ValueError:
+                            continue
+                        if event['type'] == 'job':
+                            continue
+                        last_sent = time.monotonic()
+                        yield encode(event, offset)
+                        if event['type'] in TERMINAL_EVENTS:
+                            return
+            except FileNotFoundError:
+                pass
+            
+            # 終わりはイベントファイルだけで判断する（他のプロセスのジョブもファイルに書かれる）
+            now = time.monotonic()
+            if now - started >= EVENT_STREAM_MAX_SECONDS:
+                # ワーカーを長く占有しないよう切る（クライアントは続きから再接続する）
+                return
+            if not ndjson and now - last_sent >= EVENT_KEEPALIVE_SECONDS:
+                last_sent = now
+                yield ': keepalive\n\n'
+            time.sleep(0.2)
+    
+    response = app.response_class(stream_with_context(generate()),
+                                  mimetype='application/x-ndjson' if ndjson else 'text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # プロキシにバッファリングさせない
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+def list_numbered_frames(directory, prefix):
+    """FFmpeg が prefix_%03d.jpg の形で書き出した画像を番号順に返す
+    
+    %03d は1000枚目から4桁になり、名前の順では frame_1000.jpg が frame_101.jpg の前に来るため番号で並べる。
+    """
+    numbered = []
+    for filename in os.listdir(directory):
+        match = FRAME_NUMBER_PATTERN.match(filename)
+        if match and match.group(1) == prefix:
+            numbered.append((int(match.group(2)), filename))
+    return [filename for _, filename in sorted(numbered)]
+
+def build_interval_cmd(input_path, output_dir, interval_sec):
+    """定間隔フレーム抽出のFFmpegコマンド"""
+    output_pattern = os.path.join(output_dir, 'frame_%03d.jpg')
+    return [
+        'ffmpeg', '-i', input_path,
+        '-vf', f'fps=1/{interval_sec}',
+        '-q:v', '2',
+        '-y',  # overwrite
+        output_pattern
+    ]
+
+def collect_interval_frames(output_dir, interval_sec):
+    """書き出された定間隔フレームとタイムスタンプを集める"""
+    files = list_numbered_frames(output_dir, 'frame')
+    print(f"Successfully extracted {len(files)} frames")
+    # 定間隔フレームの場合、タイムスタンプを計算
+    frame_data = []
+    for i, filename in enumerate(files):
+        timestamp = i * interval_sec
+        frame_data.append({
+            'filename': filename,
+            'timestamp': timestamp
+        })
+    return frame_data
+
+def extract_frames_simple(video_path, output_dir, interval_sec=5):
+    """シンプルなフレーム抽出"""
+    os.makedirs(output_dir, exist_ok=True)
+    
+    try:
+        # FFmpegで定間隔フレーム抽出
+        cmd = build_interval_cmd(video_path, output_dir, interval_sec)
+        
+        ffmpeg = FFmpegProcess(cmd)
+        report_interval_progress(ffmpeg.lines(), interval_sec)
+        
+        if ffmpeg.wait() == 0:
+            return collect_interval_frames(output_dir, interval_sec)
+        else:
+            print(f"FFmpeg error: {ffmpeg.stderr_tail}")
+            return []
+        
+    except Exception as e:
+        print(f"Frame extraction error: {e}")
+        return []
+
+def parse_showinfo_pts(line):
+    """showinfoのログ行からpts_timeを取り出す（該当しなければNone）"""
+    if '[Parsed_showinfo_' not in line or 'pts_time:' not in line:
+        return None
+    
+    pts_start = line.find('pts_time:') + 9
+    pts_end = line.find(' ', pts_start)
+    if pts_end == -1:
+        pts_end = len(line)
+    
+    try:
+        return float(line[pts_start:pts_end].strip())
+    except ValueError:
+        return None
+
+def build_scene_filter(sensitivity, include_first=True, limit=None):
+    """シーン検出のフィルタグラフ"""
+    # 1段目の select で全フレームのシーンスコアを計算して metadata でログに出し、
+    # 2段目の select で選ばれたフレームを showinfo でタイムスタンプ付きで記録する
+    select_expr = f'gt(scene\\,{sensitivity})'
+    if include_first:
+        # 先頭フレーム(n=0)は常に含める
+        select_expr = f'max(eq(n\\,0)\\,{select_expr})'
+    if limit is not None:
+        # スコアの記録は最後まで続けるため、書き出し数は selected_n で制限する
+        select_expr = f'{select_expr}*lt(selected_n\\,{limit})'
+    return (f'select=gte(scene\\,0),metadata=print:key=lavfi.scene_score,'
+            f'select={select_expr},showinfo')
+
+def build_scene_cmd(input_path, output_dir, sensitivity):
+    """シーン検出とフレーム書き出しを1回のデコードで行うFFmpegコマンド"""
+    # select で選ばれたフレームをそのままJPEGに書き出す
+    output_pattern = os.path.join(output_dir, 'scene_%03d.jpg')
+    return [
+        'ffmpeg', '-i', input_path,
+        '-vf', build_scene_filter(sensitivity, limit=MAX_SCENES),
+        '-vsync', 'vfr',
+        '-q:v', '2',
+        '-y',
+        output_pattern
+    ]
+
+def parse_scene_log(lines, on_scene=None, on_progress=None):
+    """シーン検出のログから選択フレームの時刻と全フレームのスコアを取り出す
+
+    on_scene には選択フレームの時刻、on_progress にはデコード位置を読み取り次第渡す
+    """
+    timestamps = []
+    score_pts = array('d')
+    scores = array('f')
+    pending_pts = None
+    has_metadata = False
+    
+    for line in lines:
+        timestamp = parse_showinfo_pts(line)
+        if timestamp is not None:
+            timestamps.append(timestamp)
+            if on_scene is not None:
+                on_scene(timestamp)
+            continue
+        
+        if '[Parsed_metadata_' in line:
+            has_metadata = True
+            if 'pts_time:' in line:
+                try:
+                    pending_pts = float(line.split('pts_time:')[1].split()[0])
+                    if on_progress is not None:
+                        on_progress(pending_pts)
+                except (IndexError, ValueError):
+                    pending_pts = None
+            elif 'lavfi.scene_score=' in line and pending_pts is not None:
+                try:
+                    scores.append(float(line.split('lavfi.scene_score=')[1].strip()))
+                    score_pts.append(pending_pts)
+                except ValueError:
+                    pass
+                pending_pts = None
+            continue
+        
+        if on_progress is not None and not has_metadata:
+            # スコアを記録しない処理では進捗表示の時刻を使う
+            stats = parse_stats_line(line)
+            if stats is not None:
+                on_progress(stats[1])
+    
+    return timestamps, make_score_track(score_pts, scores)
+
+def collect_scene_frames(output_dir, timestamps):
+    """書き出されたシーン画像と showinfo のタイムスタンプを対応付ける"""
+    # 出力順のタイムスタンプが scene_001.jpg から順に対応する
+    files = list_numbered_frames(output_dir, 'scene')
+    frame_data = []
+    for output_filename, timestamp in zip(files, timestamps):
+        frame_data.append({
+            'filename': output_filename,
+            'timestamp': timestamp
+        })
+    return frame_data
+
+def extract_scenes_with_ffmpeg(video_path, output_dir, sensitivity=0.15, score_track_path=None, detector=None):
+    """FFmpegベースのシーン検出（1回のデコードで検出とフレーム書き出しを行う）"""
+    if (detector or SCENE_DETECTOR) == 'numpy':
+        return extract_scenes_with_numpy(video_path, output_dir, sensitivity, score_track_path)
+    
+    os.makedirs(output_dir, exist_ok=True)
+    
+    try:
+        scene_cmd = build_scene_cmd(video_path, output_dir, sensitivity)
+        
+        # 出力順のタイムスタンプと全フレームのシーンスコアを、ログを読みながら抽出
+        ffmpeg = FFmpegProcess(scene_cmd)
+        timestamps, score_track = parse_scene_log(ffmpeg.lines(), report_scene,
+                                                  lambda pts: report_progress(0.0, pts))
+        
+        if ffmpeg.wait() != 0:
+            print(f"FFmpeg error: {ffmpeg.stderr_tail}")
+            return []
+        
+        if score_track_path:
+            save_score_track(score_track_path, score_track)
+        
+        frame_data = collect_scene_frames(output_dir, timestamps)
+        
+        if len(frame_data) <= 1:
+            # フォールバック：定間隔
+            for frame_info in frame_data:
+                os.remove(os.path.join(output_dir, frame_info['filename']))
+            return extract_frames_simple(video_path, output_dir, 5)
+        
+        return frame_data
+        
+    except Exception as e:
+        print(f"Scene detection error: {e}")
+        return []
+
+# ---------------------------------------------------------------------------
+# セグメント並列デコード（キーフレーム境界で分割して複数のFFmpegで処理）
+# ---------------------------------------------------------------------------
+
+# 同時に起動するセグメント処理の数（1で並列処理なし）
+SEGMENT_PARALLELISM = int(os.environ.get('SEGMENT_PARALLELISM', os.cpu_count() or 1))
+# これより短いセグメントには分割しない（秒）
+MIN_SEGMENT_SECONDS = float(os.environ.get('MIN_SEGMENT_SECONDS', 60))
+
+def probe_duration(video_path):
+    """動画の長さ（秒）を取得"""
+    cmd = [
+        'ffprobe', '-v', 'error',
+        '-show_entries', 'format=duration',
+        '-of', 'default=noprint_wrappers=1:nokey=1',
+        video_path
+    ]
+    with MetricTimer('probe_seconds', kind='duration'):
+        output = run_ffprobe(cmd)
+    try:
+        return float(output.strip())
+    except ValueError:
+        return None
+
+def probe_keyframes(video_path):
+    """キーフレームのタイムスタンプ一覧を取得（パケット走査のみでデコードしない）"""
+    cmd = [
+        'ffprobe', '-v', 'error',
+        '-select_streams', 'v:0',
+        '-show_entries', 'packet=pts_time,flags:format=start_time',
+        '-of', 'csv=p=0',
+        video_path
+    ]
+    # パケット数に比例する出力を溜め込まないよう1行ずつ読む
+    with MetricTimer('probe_seconds', kind='keyframes'):
+        ffprobe = FFmpegProcess(cmd, stdout=subprocess.PIPE)
+        ffprobe.drain_in_background()
+        
+        keyframes = []
+        start_time = 0.0
+        for line in io.TextIOWrapper(ffprobe.process.stdout, errors='replace'):
+            parts = line.strip().split(',')
+            try:
+                if len(parts) == 1 and parts[0]:
+                    # format セクションの start_time
+                    start_time = float(parts[0])
+                elif len(parts) >= 2 and 'K' in parts[1]:
+                    keyframes.append(float(parts[0]))
+            except ValueError:
+                continue
+        ffprobe.wait()
+    
+    # -ss やフィルタの t と同じく、ファイル先頭からの時刻に揃える
+    return sorted(set(round(k - start_time, 6) for k in keyframes))
+
+def plan_segments(keyframes, duration, count):
+    """キーフレーム境界で動画を count 個程度のセグメントに分割する"""
+    bounds = [0.0]
+    for i in range(1, count):
+        target = duration * i / count
+        # 目標位置に最も近いキーフレームで区切る
+        nearest = min(keyframes, key=lambda k: abs(k - target))
+        if bounds[-1] < nearest < duration:
+            bounds.append(nearest)
+    bounds.append(duration)
+    
+    segments = []
+    for start, end in zip(bounds, bounds[1:]):
+        # シーンスコアの連続性のため、直前のキーフレームから文脈としてデコードする
+        previous = [k for k in keyframes if k < start]
+        context_start = previous[-1] if previous else start
+        segments.append({'start': start, 'end': end, 'context_start': context_start})
+    return segments
+
+def run_interval_segment(video_path, segment_dir, segment, interval_sec, parallel=1):
+    """1セグメント分の定間隔フレーム抽出（全体の時刻グリッドに揃える）"""
+    os.makedirs(segment_dir, exist_ok=True)
+    
+    first_tick = math.ceil(segment['start'] / interval_sec) * interval_sec
+    if first_tick >= segment['end']:
+        return []
+    
+    # fps フィルタは次の時刻付近のフレームを見るまで出力を確定しないため、
+    # 1間隔分だけ先までデコードし、担当範囲外の時刻は捨てる
+    output_pattern = os.path.join(segment_dir, 'frame_%03d.jpg')
+    cmd = [
+        'ffmpeg', '-ss', str(first_tick), '-i', video_path,
+        '-t', str(segment['end'] + interval_sec - first_tick),
+        '-vf', f'fps=1/{interval_sec}',
+        '-q:v', '2',
+        '-y',
+        output_pattern
+    ]
+    ffmpeg = FFmpegProcess(cmd, parallel=parallel)
+    report_interval_progress(ffmpeg.lines(), interval_sec, first_tick, segment)
+    if ffmpeg.wait() != 0:
+        raise RuntimeError(f"FFmpeg error: {ffmpeg.stderr_tail}")
+    
+    frames = []
+    files = list_numbered_frames(segment_dir, 'frame')
+    for i, filename in enumerate(files):
+        timestamp = first_tick + i * interval_sec
+        if timestamp < segment['end']:
+            frames.append({'path': os.path.join(segment_dir, filename), 'timestamp': timestamp})
+    return frames
+
+def run_scene_segment(video_path, segment_dir, segment, sensitivity, include_first, parallel=1):
+    """1セグメント分のシーン検出とフレーム書き出し"""
+    os.makedirs(segment_dir, exist_ok=True)
+    
+    offset = segment['context_start']
+    output_pattern = os.path.join(segment_dir, 'scene_%03d.jpg')
+    cmd = [
+        'ffmpeg', '-ss', str(offset), '-i', video_path,
+        '-t', str(segment['end'] - offset),
+        '-vf', build_scene_filter(sensitivity, include_first),
+        '-vsync', 'vfr',
+        '-q:v', '2',
+        '-y',
+        output_pattern
+    ]
+    def on_scene(timestamp):
+        # 文脈としてデコードした区間の検出結果は前のセグメントの担当
+        if segment['start'] <= timestamp + offset < segment['end']:
+            report_scene(timestamp + offset)
+    
+    def on_progress(pts):
+        report_progress(segment['start'], min(pts + offset, segment['end']) - segment['start'])
+    
+    ffmpeg = FFmpegProcess(cmd, parallel=parallel)
+    timestamps, score_track = parse_scene_log(ffmpeg.lines(), on_scene, on_progress)
+    if ffmpeg.wait() != 0:
+        raise RuntimeError(f"FFmpeg error: {ffmpeg.stderr_tail}")
+    
+    frames = []
+    files = list_numbered_frames(segment_dir, 'scene')
+    for filename, timestamp in zip(files, timestamps):
+        # セグメント先頭からの時刻を動画全体の時刻に戻す
+        timestamp += offset
+        # 文脈としてデコードした区間の検出結果は前のセグメントの担当
+        if segment['start'] <= timestamp < segment['end']:
+            frames.append({'path': os.path.join(segment_dir, filename), 'timestamp': timestamp})
+    
+    score_track['pts'] += offset
+    in_segment = (score_track['pts'] >= segment['start']) & (score_track['pts'] < segment['end'])
+    return {'frames': frames, 'scores': score_track[in_segment]}
+
+def merge_segment_frames(output_dir, segment_results, prefix, limit=None):
+    """セグメントごとの結果を時刻順に並べ、通し番号のファイル名で出力先へ移動"""
+    merged = sorted((frame for frames in segment_results for frame in frames),
+                    key=lambda frame: frame['timestamp'])
+    if limit is not None:
+        merged = merged[:limit]
+    
+    frame_data = []
+    for i, frame in enumerate(merged):
+        output_filename = f'{prefix}_{i+1:03d}.jpg'
+        os.replace(frame['path'], os.path.join(output_dir, output_filename))
+        frame_data.append({
+            'filename': output_filename,
+            'timestamp': frame['timestamp']
+        })
+    return frame_data
+
+def extract_parallel(video_path, output_dir, mode, interval_sec=5, sensitivity=0.15, parallelism=None,
+                     score_track_path=None):
+    """動画をキーフレーム境界で分割し、セグメントを並列に処理して結果を統合する"""
+    parallelism = parallelism or SEGMENT_PARALLELISM
+    
+    def extract_single():
+        if mode == 'scene':
+            return extract_scenes_with_ffmpeg(video_path, output_dir, sensitivity, score_track_path)
+        return extract_frames_simple(video_path, output_dir, interval_sec)
+    
+    try:
+        duration = probe_duration(video_path)
+        count = min(parallelism, int(duration // MIN_SEGMENT_SECONDS)) if duration else 1
+        keyframes = load_keyframe_index(video_path) if count > 1 else []
+    except Exception as e:
+        print(f"Segment planning error: {e}")
+        count = 1
+    
+    if count <= 1 or len(keyframes) < 2:
+        return extract_single()
+    
+    if mode == 'scene' and SCENE_DETECTOR == 'numpy':
+        # NumPy検出器は低解像度の1パスで処理する
+        return extract_single()
+    
+    segments = plan_segments(keyframes, duration, count)
+    if len(segments) <= 1:
+        return extract_single()
+    
+    print(f"Parallel extraction: {len(segments)} segments, mode: {mode}")
+    os.makedirs(output_dir, exist_ok=True)
+    segments_root = os.path.join(output_dir, '.segments')
+    
+    try:
+        # 各セグメントは独立したFFmpegプロセスで処理する（スレッド予算はセグメントで等分）
+        with ThreadPoolExecutor(max_workers=len(segments)) as pool:
+            futures = []
+            for i, segment in enumerate(segments):
+                segment_dir = os.path.join(segments_root, f'{i:03d}')
+                if mode == 'scene':
+                    futures.append(pool.submit(run_scene_segment, video_path, segment_dir,
+                                               segment, sensitivity, i == 0, len(segments)))
+                else:
+                    futures.append(pool.submit(run_interval_segment, video_path, segment_dir,
+                                               segment, interval_sec, len(segments)))
+            segment_results = [future.result() for future in futures]
+        
+        if mode == 'scene':
+            if score_track_path:
+                save_score_track(score_track_path, np.sort(
+                    np.concatenate([result['scores'] for result in segment_results]), order='pts'))
+            frame_data = merge_segment_frames(output_dir, [result['frames'] for result in segment_results],
+                                              'scene', MAX_SCENES)
+            if len(frame_data) <= 1:
+                # フォールバック：定間隔
+                for frame_info in frame_data:
+                    os.remove(os.path.join(output_dir, frame_info['filename']))
+                return extract_parallel(video_path, output_dir, 'interval', 5, parallelism=parallelism)
+            return frame_data
+        
+        frame_data = merge_segment_frames(output_dir, segment_results, 'frame')
+        print(f"Successfully extracted {len(frame_data)} frames")
+        return frame_data
+        
+    except Exception as e:
+        print(f"Parallel extraction error: {e}")
+        return []
+    finally:
+        shutil.rmtree(segments_root, ignore_errors=True)
+
+# ---------------------------------------------------------------------------
+# キーフレームのみをデコードする高速抽出
+# ---------------------------------------------------------------------------
+
+def pick_nearest_keyframes(keyframes, duration, interval_sec):
+    """各間隔の時刻に最も近いキーフレームを選ぶ（重複は除く）"""
+    keyframes = np.asarray(keyframes)
+    ticks = np.arange(0, duration, interval_sec)
+    
+    right = np.clip(np.searchsorted(keyframes, ticks), 0, len(keyframes) - 1)
+    left = np.clip(right - 1, 0, len(keyframes) - 1)
+    nearest = np.where(np.abs(keyframes[left] - ticks) <= np.abs(keyframes[right] - ticks), left, right)
+    return keyframes[np.unique(nearest)].tolist()
+
+def extract_keyframes_fast(video_path, output_dir, interval_sec=5, sensitivity=None):
+    """キーフレームのみをデコードする高速抽出（sensitivity 指定時はキーフレーム間のシーン検出）"""
+    os.makedirs(output_dir, exist_ok=True)
+    
+    try:
+        if sensitivity is not None:
+            # 連続するキーフレーム同士のシーンスコアで候補を選ぶ
+            filter_graph = build_scene_filter(sensitivity, limit=MAX_SCENES)
+        else:
+            keyframes = load_keyframe_index(video_path)
+            duration = probe_duration(video_path)
+            if not keyframes or not duration:
+                return extract_frames_simple(video_path, output_dir, interval_sec)
+            
+            # 間隔ごとの時刻に最も近いキーフレームだけを選んで書き出す
+            targets = pick_nearest_keyframes(keyframes, duration, interval_sec)
+            terms = '+'.join(f'lt(abs(t-{target:.6f})\\,0.001)' for target in targets)
+            filter_graph = f'select={terms},showinfo'
+        
+        # 長い動画では式がコマンドライン引数の上限を超えるためファイルで渡す
+        script_path = os.path.join(output_dir, '.filter_script')
+        with open(script_path, 'w') as f:
+            f.write(filter_graph)
+        
+        output_pattern = os.path.join(output_dir, 'key_%03d.jpg')
+        cmd = [
+            'ffmpeg', '-skip_frame', 'nokey', '-i', video_path,
+            '-filter_script:v', script_path,
+            '-vsync', 'vfr',
+            '-q:v', '2',
+            '-y',
+            output_pattern
+        ]
+        # 実際に書き出したキーフレームの pts を記録する
+        ffmpeg = FFmpegProcess(cmd)
+        timestamps, _ = parse_scene_log(ffmpeg.lines(), report_scene,
+                                        lambda pts: report_progress(0.0, pts))
+        returncode = ffmpeg.wait()
+        os.remove(script_path)
+        
+        if returncode != 0:
+            print(f"FFmpeg error: {ffmpeg.stderr_tail}")
+            return []
+        
+        files = list_numbered_frames(output_dir, 'key')
+        frame_data = [{'filename': filename, 'timestamp': timestamp}
+                      for filename, timestamp in zip(files, timestamps)]
+        
+        if sensitivity is not None and len(frame_data) <= 1:
+            # フォールバック：キーフレームの定間隔
+            for frame_info in frame_data:
+                os.remove(os.path.join(output_dir, frame_info['filename']))
+            return extract_keyframes_fast(video_path, output_dir, 5)
+        
+        print(f"Successfully extracted {len(frame_data)} keyframes")
+        return frame_data
+        
+    except Exception as e:
+        print(f"Keyframe extraction error: {e}")
+        return []
+
+# ---------------------------------------------------------------------------
+# 適応サンプリング（粗い標本の変化量を見て、変化のある区間だけ二分探索で詰める）
+# ---------------------------------------------------------------------------
+
+# フレームレートが分からないときに二分探索を打ち切る区間の長さ（秒）
+ADAPTIVE_MIN_SPAN = 0.2
+# 1回のFFmpegでシークする標本数
+ADAPTIVE_BATCH_SIZE = 16
+
+def sample_gray_frames(video_path, times, on_batch=None):
+    """指定時刻の縮小グレースケールフレームをシークして取得（取得できなかった時刻は None）"""
+    frame_bytes = DETECT_WIDTH * DETECT_HEIGHT
+    frames = [None] * len(times)
+    
+    with tempfile.TemporaryDirectory() as sample_dir:
+        for start in range(0, len(times), ADAPTIVE_BATCH_SIZE):
+            batch = times[start:start + ADAPTIVE_BATCH_SIZE]
+            
+            cmd = ['ffmpeg', '-y']
+            for timestamp in batch:
+                cmd += ['-ss', f'{timestamp:.6f}', '-i', video_path]
+            for i in range(len(batch)):
+                cmd += ['-map', f'{i}:v:0', '-frames:v', '1',
+                        '-vf', f'scale={DETECT_WIDTH}:{DETECT_HEIGHT}:flags=area,format=gray',
+                        '-f', 'rawvideo', '-pix_fmt', 'gray', os.path.join(sample_dir, f'{start + i}.raw')]
+            
+            ffmpeg = run_ffmpeg(cmd)
+            if ffmpeg.returncode != 0:
+                print(f"FFmpeg error: {ffmpeg.stderr_tail}")
+            
+            for i in range(start, start + len(batch)):
+                path = os.path.join(sample_dir, f'{i}.raw')
+                # 終端を越えた時刻などはフレームが書き出されない
+                if os.path.exists(path) and os.path.getsize(path) == frame_bytes:
+                    frames[i] = np.fromfile(path, dtype=np.uint8)
+            if on_batch is not None:
+                on_batch(batch[-1])
+    return frames
+
+def frame_change_scores(before, after):
+    """フレームの組ごとの変化量（画素の平均絶対差とヒストグラム差の平均、0〜1）"""
+    before = np.asarray(before)
+    after = np.asarray(after)
+    count, frame_bytes = before.shape
+    
+    pixel_scores = np.abs(before.astype(np.int16) - after).mean(axis=1) / 255.0
+    
+    # ヒストグラムは全フレーム分を1回の bincount で集計
+    shift = int(math.log2(256 // DETECT_HIST_BINS))
+    offsets = (np.arange(count * 2, dtype=np.int32) * DETECT_HIST_BINS)[:, None]
+    bins = np.right_shift(np.concatenate([before, after]), shift).astype(np.int32) + offsets
+    hist = np.bincount(bins.ravel(), minlength=count * 2 * DETECT_HIST_BINS).reshape(count * 2, DETECT_HIST_BINS)
+    hist_scores = np.abs(hist[:count] - hist[count:]).sum(axis=1) / (2.0 * frame_bytes)
+    
+    return np.clip((pixel_scores + hist_scores) / 2.0, 0.0, 1.0)
+
+def plan_coarse_samples(keyframes, duration, step):
+    """粗い標本の時刻（キーフレームに合わせるとシーク時に他のフレームをデコードしない）"""
+    if keyframes:
+        times = pick_nearest_keyframes(keyframes, duration, step)
+    else:
+        times = np.arange(0, duration, step).tolist()
+    
+    # 最後の標本以降の変化も拾えるよう終端の直前も標本にする
+    end = duration - ADAPTIVE_MIN_SPAN
+    if end - times[-1] > step / 2:
+        times.append(end)
+    return times
+
+def scan_gray_frames(video_path, start, end, fps):
+    """区間のフレームを順にデコードして縮小グレースケールで取得（時刻の配列とフレームの配列）"""
+    frame_bytes = DETECT_WIDTH * DETECT_HEIGHT
+    cmd = [
+        'ffmpeg', '-v', 'error', '-ss', f'{start:.6f}', '-i', video_path,
+        '-t', f'{end - start + 0.5 / fps:.6f}',
+        '-vf', f'scale={DETECT_WIDTH}:{DETECT_HEIGHT}:flags=area,format=gray',
+        '-vsync', 'cfr', '-r', str(fps),
+        '-f', 'rawvideo', '-pix_fmt', 'gray',
+        'pipe:1'
+    ]
+    ffmpeg = FFmpegProcess(cmd, stdout=subprocess.PIPE)
+    ffmpeg.drain_in_background()
+    try:
+        data = ffmpeg.process.stdout.read()
+    finally:
+        ffmpeg.process.stdout.close()
+    
+    if ffmpeg.wait() != 0:
+        print(f"FFmpeg error: {ffmpeg.stderr_tail}")
+        return np.empty(0), np.empty((0, frame_bytes), dtype=np.uint8)
+    
+    count = len(data) // frame_bytes
+    frames = np.frombuffer(data, dtype=np.uint8, count=count * frame_bytes).reshape(count, frame_bytes)
+    first = math.ceil(round(start * fps, 6)) / fps
+    return first + np.arange(count) / fps, frames
+
+def seek_cost(keyframes, timestamp):
+    """その時刻へシークするときにデコードする長さ（直前のキーフレームから、秒）"""
+    if not keyframes:
+        return 0.0
+    i = max(bisect.bisect_right(keyframes, timestamp + 1e-6) - 1, 0)
+    return timestamp - keyframes[i]
+
+def should_scan(keyframes, a, b, min_span):
+    """区間を二分探索するより、順にデコードする方がデコード量が少ないか"""
+    levels = math.ceil(math.log2((b - a) / min_span))
+    return seek_cost(keyframes, a) + (b - a) <= levels * (seek_cost(keyframes, (a + b) / 2) + min_span)
+
+def find_changes_adaptive(video_path, times, sensitivity, fps, keyframes):
+    """粗い標本で変化のある区間を探し、区間を二分して変化の位置を詰める（時刻→変化量を返す）"""
+    # フレーム単位まで詰める
+    min_span = 1.0 / fps if fps else ADAPTIVE_MIN_SPAN
+    stats = {'seeks': len(times), 'scanned': 0}
+    
+    samples = {t: frame for t, frame in zip(times, sample_gray_frames(
+        video_path, times, lambda t: report_progress(0.0, t))) if frame is not None}
+    known = sorted(samples)
+    if len(known) < 2:
+        return {}, stats
+    
+    scores = frame_change_scores([samples[t] for t in known[:-1]], [samples[t] for t in known[1:]])
+    spans = [(a, b, float(score)) for a, b, score in zip(known[:-1], known[1:], scores) if score > sensitivity]
+    
+    # 区間の深さごとに中点をまとめてシークする
+    changes = {}
+    while spans:
+        pending = []
+        for a, b, score in spans:
+            if b - a <= min_span:
+                changes[b] = score
+            elif fps and should_scan(keyframes, a, b, min_span):
+                # キーフレームが遠く、中点へのシークを繰り返すと同じGOPを何度もデコードする区間
+                scan_times, frames = scan_gray_frames(video_path, a, b, fps)
+                stats['scanned'] += len(frames)
+                if len(frames) < 2:
+                    changes[b] = score
+                    continue
+                frame_scores = frame_change_scores(frames[:-1], frames[1:])
+                for timestamp, frame_score in zip(scan_times[1:], frame_scores):
+                    if frame_score > sensitivity:
+                        changes[float(timestamp)] = float(frame_score)
+            else:
+                pending.append((a, b, score))
+        if not pending:
+            break
+        
+        middles = [(a + b) / 2 for a, b, _ in pending]
+        middle_frames = sample_gray_frames(video_path, middles)
+        stats['seeks'] += len(middles)
+        
+        found = [(span, middle, frame) for span, middle, frame in zip(pending, middles, middle_frames)
+                 if frame is not None]
+        for (a, b, score), _, frame in zip(pending, middles, middle_frames):
+            if frame is None:
+                changes[b] = score
+        if not found:
+            break
+        
+        left_scores = frame_change_scores([samples[a] for (a, _, _), _, _ in found],
+                                          [frame for _, _, frame in found])
+        right_scores = frame_change_scores([frame for _, _, frame in found],
+                                           [samples[b] for (_, b, _), _, _ in found])
+        
+        spans = []
+        for ((a, b, _), middle, frame), left, right in zip(found, left_scores, right_scores):
+            samples[middle] = frame
+            # どちらの半分も閾値以下なら動きなどの緩やかな変化として詰めない
+            if left > sensitivity:
+                spans.append((a, middle, float(left)))
+            if right > sensitivity:
+                spans.append((middle, b, float(right)))
+    
+    return changes, stats
+
+def extract_adaptive(video_path, output_dir, interval_sec=5, sensitivity=0.15):
+    """適応サンプリングで変化の直後のフレームだけを書き出す"""
+    os.makedirs(output_dir, exist_ok=True)
+    
+    try:
+        duration = probe_duration(video_path)
+        if not duration:
+            return extract_frames_simple(video_path, output_dir, interval_sec)
+        
+        fps = probe_frame_rate(video_path)
+        keyframes = load_keyframe_index(video_path)
+        times = plan_coarse_samples(keyframes, duration, max(float(interval_sec), 1.0))
+        changes, stats = find_changes_adaptive(video_path, times, sensitivity, fps, keyframes)
+        
+        # 変化量の大きいものから上限数まで（先頭フレームの分を除く）
+        change_times = sorted(changes, key=changes.get, reverse=True)[:MAX_SCENES - 1]
+        targets = [(0.0, None)] + [(t, changes[t]) for t in sorted(change_times)]
+        
+        # シークは指定時刻以降の最初のフレームになるため、記録する時刻もそのフレームに合わせる
+        if fps:
+            snapped = {}
+            for t, score in targets:
+                snapped.setdefault(math.ceil(round(t * fps, 6)) / fps, score)
+            targets = list(snapped.items())
+        
+        filenames = [f'scene_{i + 1:03d}.jpg' for i in range(len(targets))]
+        extract_frames_at(video_path, output_dir,
+                          [(timestamp, filename) for (timestamp, _), filename in zip(targets, filenames)])
+        
+        frame_data = []
+        for (timestamp, score), filename in zip(targets, filenames):
+            if os.path.exists(os.path.join(output_dir, filename)):
+                frame_data.append({'filename': filename, 'timestamp': timestamp,
+                                   'score': None if score is None else round(score, 6)})
+                report_scene(timestamp)
+        
+        print(f"Adaptive sampling: {stats['seeks']} seeks, {stats['scanned']} scanned frames, "
+              f"{len(frame_data)} frames")
+        return frame_data
+        
+    except Exception as e:
+        print(f"Adaptive sampling error: {e}")
+        return []
+
+# ---------------------------------------------------------------------------
+# シーンスコアの保存と閾値の再適用（再デコードせずに感度を変更する）
+# ---------------------------------------------------------------------------
+
+SCORE_TRACK_DTYPE = np.dtype([('pts', '<f8'), ('score', '<f4')])
+
+def make_score_track(score_pts, scores):
+    """フレームごとの (pts, シーンスコア) 配列を作成"""
+    track = np.empty(len(scores), dtype=SCORE_TRACK_DTYPE)
+    track['pts'] = score_pts
+    track['score'] = scores
+    return track
+
+def score_track_path_for(digest, detector=None):
+    """動画ごとのシーンスコア保存先（感度に依存しないためハッシュ単位）
+    
+    検出器ごとにスコアの尺度が違うため、閾値の掛け直しで混ざらないよう別のファイルにする。
+    """
+    if (detector or SCENE_DETECTOR) == 'numpy':
+        return os.path.join(SCENES_FOLDER, f'{digest[:32]}_scores-numpy.npy')
+    return os.path.join(SCENES_FOLDER, f'{digest[:32]}_scores.npy')
+
+def save_score_track(path, track):
+    """シーンスコアを .npy 形式で保存"""
+    if len(track) == 0:
+        return
+    
+    tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.save(f, track)
+    os.replace(tmp_path, path)
+
+def load_score_track(path):
+    """保存済みのシーンスコアを読み込む（なければNone）"""
+    try:
+        return np.load(path)
+    except (OSError, ValueError):
+        return None
+
+def select_scene_indices(track, sensitivity):
+    """シーンスコアに閾値を適用して選ばれるフレームのマスクを返す"""
+    # FFmpeg の select と同じく先頭フレームは常に含める
+    selected = track['score'] > sensitivity
+    selected[0] = True
+    return selected
+
+def select_scene_times(track, sensitivity, limit=MAX_SCENES):
+    """シーンスコアに閾値を適用して選ばれるフレームの時刻を返す"""
+    return track['pts'][select_scene_indices(track, sensitivity)][:limit].tolist()
+
+def find_reusable_frames(digest):
+    """同じ動画の既存シーン検出結果から 時刻→画像パス の対応を集める"""
+    prefix = f'{digest[:32]}_scene_'
+    frames = {}
+    for entry in os.listdir(SCENES_FOLDER):
+        if not entry.startswith(prefix):
+            continue
+        manifest = load_cached_result(entry)
+        if not manifest:
+            continue
+        for frame_info in manifest['frames']:
+            if frame_info['filename'].startswith('scene_'):
+                frames[round(frame_info['timestamp'], 3)] = os.path.join(SCENES_FOLDER, entry, frame_info['filename'])
+    return frames
+
+def extract_frames_at(video_path, output_dir, targets, batch_size=8):
+    """指定時刻のフレームをシークして書き出す（1プロセスで複数入力をまとめて処理）"""
+    for start in range(0, len(targets), batch_size):
+        batch = targets[start:start + batch_size]
+        
+        cmd = ['ffmpeg', '-y']
+        for timestamp, _ in batch:
+            cmd += ['-ss', str(timestamp), '-i', video_path]
+        for i, (_, filename) in enumerate(batch):
+            cmd += ['-map', f'{i}:v:0', '-frames:v', '1', '-q:v', '2', os.path.join(output_dir, filename)]
+        
+        started = time.monotonic()
+        ffmpeg = run_ffmpeg(cmd)
+        # まとめて処理した分を1フレームあたりに均す
+        per_frame = (time.monotonic() - started) / len(batch)
+        for _ in batch:
+            observe_metric('frame_extract_seconds', per_frame)
+        if ffmpeg.returncode != 0:
+            print(f"FFmpeg error: {ffmpeg.stderr_tail}")
+
+def extract_scenes_from_score_track(video_path, output_dir, sensitivity, track, reusable=None):
+    """保存済みのシーンスコアに閾値を掛け直し、新たに必要なフレームだけ抽出する"""
+    os.makedirs(output_dir, exist_ok=True)
+    
+    timestamps = select_scene_times(track, sensitivity)
+    if len(timestamps) <= 1:
+        # フォールバック：定間隔（通常のシーン検出と同じ扱い）
+        return extract_parallel(video_path, output_dir, 'interval', 5)
+    
+    reusable = reusable or {}
+    targets = []
+    for i, timestamp in enumerate(timestamps):
+        output_filename = f'scene_{i+1:03d}.jpg'
+        existing = reusable.get(round(timestamp, 3))
+        if existing and os.path.exists(existing):
+            # 既に抽出済みのフレームはリンク（不可ならコピー）で再利用
+            try:
+                os.link(existing, os.path.join(output_dir, output_filename))
+            except OSError:
+                shutil.copyfile(existing, os.path.join(output_dir, output_filename))
+        else:
+            targets.append((timestamp, output_filename))
+    
+    # 選ばれるシーンの時刻は抽出前に確定している
+    for timestamp in timestamps:
+        report_scene(timestamp)
+    
+    extract_frames_at(video_path, output_dir, targets)
+    print(f"Re-thresholded {len(timestamps)} scenes, extracted {len(targets)} new frames")
+    
+    frame_data = []
+    for i, timestamp in enumerate(timestamps):
+        output_filename = f'scene_{i+1:03d}.jpg'
+        if os.path.exists(os.path.join(output_dir, output_filename)):
+            frame_data.append({
+                'filename': output_filename,
+                'timestamp': timestamp
+            })
+    return frame_data
+
+@app.route('/results/<result_id>/rethreshold', methods=['POST'])
+def rethreshold(result_id):
+    """保存済みのシーンスコアから別の感度でシーンを選び直すジョブを登録"""
+    manifest = load_cached_result(result_id)
+    if manifest is None:
+        return jsonify({'error': 'Result not found'}), 404
+    
+    try:
+        sensitivity = float(request.values.get('sensitivity', 0.15))
+    except ValueError:
+        return jsonify({'error': 'Invalid sensitivity'}), 400
+    try:
+        check_sensitivity(sensitivity)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    digest = result_id.split('_')[0]
+    if not os.path.exists(score_track_path_for(digest)):
+        return jsonify({'error': 'Scene scores are not available for this video'}), 404
+    
+    # 選ばれたフレームの書き出しはワーカープロセスで行う
+    job_id = submit_job(os.path.join(UPLOAD_FOLDER, manifest['video']), manifest['video'], digest,
+                        request.values.get('original_filename', manifest['video']),
+                        'scene', manifest.get('interval', 5), sensitivity,
+                        task=(rethreshold_job_frames, (manifest['video'], manifest.get('interval', 5), sensitivity)))
+    job = get_job(job_id)
+    
+    return jsonify({
+        'job_id': job_id,
+        'status': job['status'],
+        'cached': job['cached'],
+        'result_id': job['result_id'],
+        'sensitivity': sensitivity,
+        'status_url': url_for('job_status', job_id=job_id),
+        'result_url': url_for('job_result', job_id=job_id),
+        'scenes_url': url_for('result_scenes', result_id=job['result_id']),
+        'page_url': url_for('index', job=job_id)
+    }), 200 if job['status'] == 'done' else 202
+
+def rethreshold_job_frames(work_dir, result_id, video, interval, sensitivity):
+    """保存済みのシーンスコアに閾値を掛け直して結果を保存する（ワーカープロセスで実行）"""
+    digest = result_id.split('_')[0]
+    track = load_score_track(score_track_path_for(digest))
+    if track is None or len(track) == 0:
+        raise RuntimeError('Scene scores are not available for this video')
+    
+    frame_data = extract_scenes_from_score_track(os.path.join(UPLOAD_FOLDER, video), work_dir, sensitivity,
+                                                 track, find_reusable_frames(digest))
+    if job_cancel_requested():
+        raise JobCancelled('Job cancelled')
+    if not frame_data:
+        return frame_data
+    
+    return store_result(work_dir, os.path.join(SCENES_FOLDER, result_id), {
+        'result_id': result_id,
+        'video': video,
+        'mode': 'scene',
+        'interval': interval,
+        'sensitivity': sensitivity,
+        'frames': frame_data,
+        'created_at': time.time()
+    })['frames']
 
-@app.route('/health')
-def health():
-    return jsonify({'status': 'OK', 'message': 'Application is running'})
+# ---------------------------------------------------------------------------
+# NumPyによるシーン検出（低解像度のrawvideoをパイプで受け取って計算）
+# ---------------------------------------------------------------------------
 
+# シーン検出器: 'ffmpeg'（select フィルタ）または 'numpy'
+SCENE_DETECTOR = os.environ.get('SCENE_DETECTOR', 'ffmpeg')
+# 検出用に縮小するフレームサイズ
+DETECT_WIDTH = 64
+DETECT_HEIGHT = 36
+# ヒストグラムのビン数（256の約数）
+DETECT_HIST_BINS = 16
 
-@app.route('/upload', methods=['POST'])
-def upload():
+def probe_frame_rate(video_path):
+    """映像ストリームの平均フレームレートを取得"""
+    cmd = [
+        'ffprobe', '-v', 'error',
+        '-select_streams', 'v:0',
+        '-show_entries', 'stream=avg_frame_rate',
+        '-of', 'csv=p=0',
+        video_path
+    ]
+    with MetricTimer('probe_seconds', kind='frame_rate'):
+        output = run_ffprobe(cmd)
     try:
-        if 'video' not in request.files:
-            return jsonify({'error': 'No video file uploaded'}), 400
+        numerator, denominator = output.strip().split('/')
+        return float(numerator) / float(denominator)
+    except (ValueError, ZeroDivisionError):
+        return None
+
+class NumpySceneDetector:
+    """グレースケールの縮小フレームをまとめて処理し、フレームごとのシーンスコアを計算する"""
+    
+    def __init__(self, width=DETECT_WIDTH, height=DETECT_HEIGHT, batch_size=256):
+        self.frame_bytes = width * height
+        self.batch_size = batch_size
         
-        file = request.files['video']
-        if file.filename == '':
-            return jsonify({'error': 'No video file selected'}), 400
+        # 先頭行は前のバッチの最終フレーム（バッファはすべて使い回す）
+        self.frames = np.empty((batch_size + 1, self.frame_bytes), dtype=np.uint8)
+        self.diff = np.empty((batch_size, self.frame_bytes), dtype=np.int16)
+        self.bins = np.empty((batch_size + 1, self.frame_bytes), dtype=np.uint8)
+        self.hist_index = np.empty((batch_size + 1, self.frame_bytes), dtype=np.int32)
+        self.hist_offsets = (np.arange(batch_size + 1, dtype=np.int32) * DETECT_HIST_BINS)[:, None]
+        self.hist_shift = int(math.log2(256 // DETECT_HIST_BINS))
+        
+        self.has_previous = False
+        self.previous_mafd = 0.0
+    
+    def read_batch(self, stream):
+        """ストリームからバッファへ直接読み込み、読み込めたフレーム数を返す"""
+        view = memoryview(self.frames[1:]).cast('B')
+        filled = 0
+        while filled < len(view):
+            count = stream.readinto(view[filled:])
+            if not count:
+                break
+            filled += count
+        return filled // self.frame_bytes
+    
+    def score_batch(self, count):
+        """読み込んだ count フレームのシーンスコアを計算"""
+        if not self.has_previous:
+            # 最初のフレームは自分自身と比較（スコア0）
+            self.frames[0] = self.frames[1]
+            self.has_previous = True
         
-        # ファイル保存
-        filename = str(uuid.uuid4()) + os.path.splitext(file.filename)[1]
-        filepath = os.path.join(UPLOAD_FOLDER, filename)
-        file.save(filepath)
+        frames = self.frames[:count + 1]
         
-        # 処理モードを取得
-        mode = request.form.get('mode', 'interval')
-        interval = int(request.form.get('interval', 5))
-        sensitivity = float(request.form.get('sensitivity', 0.15))
+        # 画素差分：FFmpeg の scene と同じく平均絶対差(mafd)とその変化量の小さい方
+        diff = self.diff[:count]
+        np.subtract(frames[1:], frames[:-1], out=diff, dtype=np.int16)
+        np.abs(diff, out=diff)
+        mafd = diff.mean(axis=1) * (100.0 / 255.0)
+        previous = np.concatenate(([self.previous_mafd], mafd[:-1]))
+        pixel_scores = np.minimum(mafd, np.abs(mafd - previous)) / 100.0
+        self.previous_mafd = mafd[-1]
         
-        print(f"Processing mode: {mode}, interval: {interval}s, sensitivity: {sensitivity}")
+        # ヒストグラム差分：全フレーム分を1回の bincount で集計
+        bins = self.bins[:count + 1]
+        np.right_shift(frames, self.hist_shift, out=bins)
+        hist_index = self.hist_index[:count + 1]
+        np.add(bins, self.hist_offsets[:count + 1], out=hist_index)
+        hist = np.bincount(hist_index.ravel(), minlength=(count + 1) * DETECT_HIST_BINS)
+        hist = hist.reshape(count + 1, DETECT_HIST_BINS)
+        hist_scores = np.abs(hist[1:] - hist[:-1]).sum(axis=1) / (2.0 * self.frame_bytes)
         
-        # フレーム抽出
-        filename_no_ext = os.path.splitext(filename)[0]
-        scene_dir = os.path.join(SCENES_FOLDER, filename_no_ext)
+        # 次のバッチのために最終フレームを先頭へ
+        self.frames[0] = self.frames[count]
         
-        if mode == 'scene':
-            frames = extract_scenes_with_ffmpeg(filepath, scene_dir, sensitivity)
-            processing_method = 'scene detection'
-        else:
-            frames = extract_frames_simple(filepath, scene_dir, interval)
-            processing_method = f'interval extraction ({interval}s)'
-        
-        if frames:
-            return jsonify({
-                'message': f'Video processed successfully using {processing_method}',
-                'filename': file.filename,
-                'video_file': filename,
-                'frames': len(frames),
-                'preview_url': f'/static/scenes/{filename_no_ext}/{frames[0]}',
-                'processing_method': processing_method
-            })
-        else:
-            return jsonify({
-                'message': 'Video uploaded but processing failed',
-                'filename': file.filename,
-                'video_file': filename,
-                'note': 'Video processing is not available on this platform'
-            })
+        return np.clip((pixel_scores + hist_scores) / 2.0, 0.0, 1.0)
     
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+    def run(self, stream, on_progress=None):
+        """ストリームの終わりまで処理してスコア配列を返す（on_progress には処理済みフレーム数を渡す）"""
+        chunks = []
+        processed = 0
+        while True:
+            count = self.read_batch(stream)
+            if count == 0:
+                break
+            chunks.append(self.score_batch(count).astype(np.float32))
+            processed += count
+            if on_progress is not None:
+                on_progress(processed)
+        return np.concatenate(chunks) if chunks else np.empty(0, dtype=np.float32)
 
-def extract_frames_simple(video_path, output_dir, interval_sec=5):
-    """シンプルなフレーム抽出"""
+def extract_scenes_with_numpy(video_path, output_dir, sensitivity=0.15, score_track_path=None):
+    """NumPy検出器でシーンを検出し、選ばれたフレームだけをシークして書き出す"""
     os.makedirs(output_dir, exist_ok=True)
     
     try:
-        # FFmpegで定間隔フレーム抽出
-        output_pattern = os.path.join(output_dir, 'frame_%03d.jpg')
+        # 固定フレームレートで出力させ、pts はフレーム番号から求める
+        fps = probe_frame_rate(video_path) or 25.0
         cmd = [
-            'ffmpeg', '-i', video_path,
-            '-vf', f'fps=1/{interval_sec}',
-            '-q:v', '2',
-            '-y',  # overwrite
-            output_pattern
+            'ffmpeg', '-v', 'error', '-i', video_path,
+            '-vf', f'scale={DETECT_WIDTH}:{DETECT_HEIGHT}:flags=area,format=gray',
+            '-vsync', 'cfr', '-r', str(fps),
+            '-f', 'rawvideo', '-pix_fmt', 'gray',
+            'pipe:1'
         ]
         
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=120)
-        
-        if result.returncode == 0:
-            files = sorted([f for f in os.listdir(output_dir) if f.endswith('.jpg')])
-            print(f"Successfully extracted {len(files)} frames")
-            # 定間隔フレームの場合、タイムスタンプを計算
-            frame_data = []
-            for i, filename in enumerate(files):
-                timestamp = i * interval_sec
-                frame_data.append({
-                    'filename': filename,
-                    'timestamp': timestamp
-                })
-            return frame_data
-        else:
-            print(f"FFmpeg error: {result.stderr}")
+        ffmpeg = FFmpegProcess(cmd, stdout=subprocess.PIPE)
+        ffmpeg.drain_in_background()
+        try:
+            scores = NumpySceneDetector().run(ffmpeg.process.stdout,
+                                              lambda frames: report_progress(0.0, frames / fps))
+        finally:
+            ffmpeg.process.stdout.close()
+        
+        if ffmpeg.wait() != 0:
+            print(f"FFmpeg error: {ffmpeg.stderr_tail}")
             return []
         
+        track = make_score_track(np.arange(len(scores)) / fps, scores)
+        if len(track) == 0:
+            return []
+        if score_track_path:
+            save_score_track(score_track_path, track)
+        
+        return extract_scenes_from_score_track(video_path, output_dir, sensitivity, track)
+        
     except Exception as e:
-        print(f"Frame extraction error: {e}")
+        print(f"Scene detection error: {e}")
         return []
 
-def extract_scenes_with_ffmpeg(video_path, output_dir, sensitivity=0.15):
-    """FFmpegベースのシーン検出"""
-    os.makedirs(output_dir, exist_ok=True)
+# ---------------------------------------------------------------------------
+# 知覚ハッシュによる重複フレームの除去（講義や画面録画で同じ画面が続く場合）
+# ---------------------------------------------------------------------------
+
+# 直前に残したフレームと pHash のハミング距離がこれ以下なら重複とみなす
+# （既定は0で無効。アップロード時に dedupe で指定するか、この設定で既定にする）
+DEDUPE_THRESHOLD = int(os.environ.get('DEDUPE_THRESHOLD', 0))
+DEDUPE_MAX_THRESHOLD = 32
+# 重複除去を行うモード（シーン検出系は選んだ時点で変化のあるフレームのみ）
+DEDUPE_MODES = ('interval', 'fast')
+# pHash は32x32の縮小画像のDCTの低周波8x8、dHash は9x8の縮小画像の横方向の差分
+PHASH_IMAGE_SIZE = 32
+HASH_SIZE = 8
+HASH_BATCH_SIZE = 256
+
+# DCT-II の基底行列（全フレームを行列積でまとめて変換する）
+PHASH_DCT = np.cos(np.pi * np.outer(np.arange(PHASH_IMAGE_SIZE), 2 * np.arange(PHASH_IMAGE_SIZE) + 1)
+                   / (2 * PHASH_IMAGE_SIZE)).astype(np.float32)
+
+def dedupe_threshold_for(mode, threshold=None):
+    """モードに適用する重複除去のしきい値（対象外・無効なら None）"""
+    if threshold is None:
+        threshold = DEDUPE_THRESHOLD
+    if mode not in DEDUPE_MODES or threshold <= 0:
+        return None
+    return int(threshold)
+
+def load_hash_images(path):
+    """ハッシュ計算用に pHash 用と dHash 用の小さなグレースケール画像を読み込む"""
+    with Image.open(path) as img:
+        # JPEG は draft で DCT 段階の縮小デコードをする
+        img.draft('L', (PHASH_IMAGE_SIZE * 2, PHASH_IMAGE_SIZE * 2))
+        img = img.convert('L')
+        return (np.asarray(img.resize((PHASH_IMAGE_SIZE, PHASH_IMAGE_SIZE), Image.Resampling.BOX)),
+                np.asarray(img.resize((HASH_SIZE + 1, HASH_SIZE), Image.Resampling.BOX)))
+
+def pack_hash_bits(bits):
+    """(n, 64) の真偽値を64ビットのハッシュ値の配列にする"""
+    return np.packbits(bits, axis=1).view('>u8').ravel()
+
+def compute_image_hashes(phash_images, dhash_images):
+    """縮小画像のバッチから pHash と dHash を計算する"""
+    phash_images = np.asarray(phash_images, dtype=np.float32)
+    dct = PHASH_DCT @ phash_images @ PHASH_DCT.T
+    low = dct[:, :HASH_SIZE, :HASH_SIZE].reshape(len(dct), -1)
+    # 直流成分を除いた中央値より大きいか
+    median = np.median(low[:, 1:], axis=1, keepdims=True)
+    phashes = pack_hash_bits(low > median)
+    
+    dhash_images = np.asarray(dhash_images, dtype=np.int16)
+    dhashes = pack_hash_bits((dhash_images[:, :, 1:] > dhash_images[:, :, :-1]).reshape(len(dhash_images), -1))
+    return phashes, dhashes
+
+def hash_frames(output_dir, frame_data):
+    """全フレームのハッシュを計算し、再選択用の候補一覧を返す"""
+    candidates = []
+    with ThreadPoolExecutor(max_workers=THUMBNAIL_WORKERS) as pool:
+        for start in range(0, len(frame_data), HASH_BATCH_SIZE):
+            batch = frame_data[start:start + HASH_BATCH_SIZE]
+            images = list(pool.map(lambda frame_info: load_hash_images(
+                os.path.join(output_dir, frame_info['filename'])), batch))
+            phashes, dhashes = compute_image_hashes([image[0] for image in images],
+                                                    [image[1] for image in images])
+            for frame_info, phash, dhash in zip(batch, phashes.tolist(), dhashes.tolist()):
+                candidates.append({
+                    'filename': frame_info['filename'],
+                    'timestamp': frame_info['timestamp'],
+                    'phash': f'{phash:016x}',
+                    'dhash': f'{dhash:016x}'
+                })
+    return candidates
+
+def select_distinct_frames(candidates, threshold):
+    """直前に残したフレームとの pHash の距離がしきい値以下のフレームを畳み込む"""
+    kept = []
+    last_hash = None
+    for candidate in candidates:
+        phash = int(candidate['phash'], 16)
+        if last_hash is not None and (phash ^ last_hash).bit_count() <= threshold:
+            kept[-1]['duplicates'] += 1
+            continue
+        kept.append(dict(candidate, duplicates=0))
+        last_hash = phash
+    return kept
+
+def dedupe_frames(output_dir, frame_data, threshold):
+    """重複フレームを除いて残すフレームと、全フレームのハッシュ（候補一覧）を返す"""
+    candidates = hash_frames(output_dir, frame_data)
+    kept = select_distinct_frames(candidates, threshold)
+    
+    kept_files = {frame_info['filename'] for frame_info in kept}
+    for frame_info in frame_data:
+        if frame_info['filename'] not in kept_files:
+            os.remove(os.path.join(output_dir, frame_info['filename']))
+    
+    print(f"Deduplicated {len(frame_data)} frames to {len(kept)} (threshold {threshold})")
+    return kept, candidates
+
+@app.route('/results/<result_id>/dedupe', methods=['POST'])
+def rededupe(result_id):
+    """保存済みのハッシュから別のしきい値で重複除去をやり直すジョブを登録（ハッシュの再計算はしない）"""
+    manifest = load_cached_result(result_id)
+    if manifest is None:
+        return jsonify({'error': 'Result not found'}), 404
+    if not manifest.get('candidates'):
+        return jsonify({'error': 'Frame hashes are not available for this result'}), 404
     
     try:
-        # シーン検出でタイムスタンプを取得
-        scene_cmd = [
-            'ffmpeg', '-i', video_path,
-            '-vf', f'select=gt(scene\\,{sensitivity}),showinfo',
-            '-vsync', 'vfr',
-            '-f', 'null', '-'
-        ]
-        
-        result = subprocess.run(scene_cmd, capture_output=True, text=True, timeout=120)
-        
-        # タイムスタンプを抽出
-        timestamps = []
-        lines = result.stderr.split('\n')
-        
-        for line in lines:
-            if '[Parsed_showinfo_1' in line and 'pts_time:' in line:
-                try:
-                    pts_start = line.find('pts_time:') + 9
-                    pts_end = line.find(' ', pts_start)
-                    if pts_end == -1:
-                        pts_end = len(line)
-                    
-                    timestamp_str = line[pts_start:pts_end].strip()
-                    timestamp = float(timestamp_str)
-                    timestamps.append(timestamp)
-                except ValueError:
-                    continue
-        
-        if 0.0 not in timestamps:
-            timestamps.insert(0, 0.0)
-        
-        timestamps = sorted(list(set(timestamps)))
-        
-        if len(timestamps) <= 1:
-            # フォールバック：定間隔
-            return extract_frames_simple(video_path, output_dir, 5)
+        threshold = int(request.values.get('threshold', DEDUPE_THRESHOLD))
+    except ValueError:
+        return jsonify({'error': 'Invalid threshold'}), 400
+    threshold = max(0, min(threshold, DEDUPE_MAX_THRESHOLD))
+    
+    digest = result_id.split('_')[0]
+    mode = manifest['mode']
+    new_result_id = make_result_id(digest, mode, manifest['interval'], manifest['sensitivity'], threshold)
+    
+    # 除いていたフレームの書き出しはワーカープロセスで行う
+    job_id = submit_job(os.path.join(UPLOAD_FOLDER, manifest['video']), manifest['video'], digest,
+                        request.values.get('original_filename', manifest['video']),
+                        mode, manifest['interval'], manifest['sensitivity'], result_id=new_result_id,
+                        task=(rededupe_job_frames, (result_id, threshold)))
+    job = get_job(job_id)
+    
+    return jsonify({
+        'job_id': job_id,
+        'status': job['status'],
+        'cached': job['cached'],
+        'result_id': job['result_id'],
+        'threshold': threshold,
+        'status_url': url_for('job_status', job_id=job_id),
+        'result_url': url_for('job_result', job_id=job_id),
+        'scenes_url': url_for('result_scenes', result_id=job['result_id']),
+        'page_url': url_for('index', job=job_id)
+    }), 200 if job['status'] == 'done' else 202
+
+def rededupe_job_frames(work_dir, result_id, source_result_id, threshold):
+    """元の結果の候補一覧から重複除去をやり直して結果を保存する（ワーカープロセスで実行）"""
+    manifest = load_cached_result(source_result_id)
+    if manifest is None or not manifest.get('candidates'):
+        raise RuntimeError('Source result is no longer available')
+    
+    candidates = manifest['candidates']
+    kept = select_distinct_frames(candidates, threshold) if threshold else [dict(c) for c in candidates]
+    
+    source_dir = os.path.join(SCENES_FOLDER, source_result_id)
+    video_path = os.path.join(UPLOAD_FOLDER, manifest['video'])
+    os.makedirs(work_dir)
+    targets = []
+    for frame_info in kept:
+        existing = os.path.join(source_dir, frame_info['filename'])
+        if os.path.exists(existing):
+            # 元の結果に残っているフレームはリンク（不可ならコピー）で再利用
+            try:
+                os.link(existing, os.path.join(work_dir, frame_info['filename']))
+            except OSError:
+                shutil.copyfile(existing, os.path.join(work_dir, frame_info['filename']))
+        else:
+            targets.append((frame_info['timestamp'], frame_info['filename']))
+    
+    # 元の結果で除いたフレームだけをシークして書き出す
+    extract_frames_at(video_path, work_dir, targets)
+    print(f"Re-deduplicated {len(candidates)} frames to {len(kept)}, extracted {len(targets)} frames")
+    if job_cancel_requested():
+        raise JobCancelled('Job cancelled')
+    
+    frame_data = [frame_info for frame_info in kept
+                  if os.path.exists(os.path.join(work_dir, frame_info['filename']))]
+    if not frame_data:
+        return frame_data
+    
+    return store_result(work_dir, os.path.join(SCENES_FOLDER, result_id), {
+        'result_id': result_id,
+        'video': manifest['video'],
+        'mode': manifest['mode'],
+        'interval': manifest['interval'],
+        'sensitivity': manifest['sensitivity'],
+        'dedupe': threshold,
+        'candidates': candidates,
+        'frames': frame_data,
+        'created_at': time.time()
+    })['frames']
+
+# ---------------------------------------------------------------------------
+# サムネイル派生画像（初回リクエスト時に縮小版を生成してディスクにキャッシュ）
+# ---------------------------------------------------------------------------
+
+THUMBNAIL_FOLDER = os.path.join(static_folder, 'thumbnails')
+# 派生画像の種類と最大幅（full は元の解像度のまま再エンコード）
+THUMBNAIL_SIZES = {'small': 320, 'medium': 640, 'full': None}
+THUMBNAIL_FORMATS = {'webp': 'WEBP', 'jpg': 'JPEG'}
+THUMBNAIL_QUALITY = 80
+# 派生画像キャッシュの上限（バイト）。超えたら古いものから削除する
+THUMBNAIL_CACHE_BYTES = int(os.environ.get('THUMBNAIL_CACHE_BYTES', 512 * 1024 * 1024))
+THUMBNAIL_WORKERS = int(os.environ.get('THUMBNAIL_WORKERS', os.cpu_count() or 2))
+
+# Pillow が WebP 対応でビルドされていなければ JPEG のみ
+WEBP_AVAILABLE = features.check('webp')
+
+thumbnail_executor = ThreadPoolExecutor(max_workers=THUMBNAIL_WORKERS)
+thumbnail_lock = threading.Lock()
+# 生成中の派生画像（同じ画像への同時リクエストで重複して生成しない）
+thumbnail_futures = {}
+thumbnail_cache_bytes = None
+
+def thumbnail_path_for(result_id, size, filename):
+    return os.path.join(THUMBNAIL_FOLDER, result_id, size, filename)
+
+def thumbnail_widths(frame_info):
+    """派生画像ごとの実際の幅（srcset の w 記述子に使う）"""
+    width = frame_info.get('width')
+    return {size: min(max_width, width) if max_width and width else width
+            for size, max_width in THUMBNAIL_SIZES.items()}
+
+def make_thumbnail(source_path, output_path, max_width, image_format):
+    """縮小版を作成して書き出したファイルサイズを返す"""
+    with Image.open(source_path) as img:
+        if max_width and img.width > max_width:
+            max_height = max(1, round(img.height * max_width / img.width))
+            # JPEG は draft で DCT 段階の縮小デコードをしてからリサイズする
+            img.draft('RGB', (max_width, max_height))
+            img = img.convert('RGB')
+            img.thumbnail((max_width, max_height), Image.Resampling.LANCZOS)
+        else:
+            img = img.convert('RGB')
         
-        # フレーム抽出
-        frames = []
-        frame_data = []
-        for i, timestamp in enumerate(timestamps[:20]):  # 最大20フレーム
-            output_filename = f'scene_{i+1:03d}.jpg'
-            output_path = os.path.join(output_dir, output_filename)
-            
-            cmd = [
-                'ffmpeg', '-ss', str(timestamp), '-i', video_path,
-                '-frames:v', '1', '-q:v', '2', '-y',
-                output_path
-            ]
-            
-            frame_result = subprocess.run(cmd, capture_output=True, text=True, timeout=30)
-            
-            if frame_result.returncode == 0 and os.path.exists(output_path):
-                frames.append(output_filename)
-                frame_data.append({
-                    'filename': output_filename,
-                    'timestamp': timestamp
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        tmp_path = f'{output_path}.{uuid.uuid4().hex}.tmp'
+        if image_format == 'WEBP':
+            img.save(tmp_path, 'WEBP', quality=THUMBNAIL_QUALITY, method=4)
+        else:
+            img.save(tmp_path, 'JPEG', quality=THUMBNAIL_QUALITY, optimize=True, progressive=True)
+    
+    os.replace(tmp_path, output_path)
+    return os.path.getsize(output_path)
+
+def ensure_thumbnail(result_id, size, filename):
+    """派生画像がなければスレッドプールで生成し、完成を待つ"""
+    output_path = thumbnail_path_for(result_id, size, filename)
+    if os.path.exists(output_path):
+        inc_metric('cache_hits_total', cache='thumbnail')
+        return output_path
+    inc_metric('cache_misses_total', cache='thumbnail')
+    
+    stem, ext = os.path.splitext(filename)
+    source_path = os.path.join(SCENES_FOLDER, result_id, f'{stem}.jpg')
+    
+    with thumbnail_lock:
+        future = thumbnail_futures.get(output_path)
+        created = future is None
+        if created:
+            future = thumbnail_executor.submit(make_thumbnail, source_path, output_path,
+                                               THUMBNAIL_SIZES[size], THUMBNAIL_FORMATS[ext[1:]])
+            thumbnail_futures[output_path] = future
+    
+    if created:
+        # 完了済みならコールバックはこのスレッドで呼ばれるためロックの外で登録する
+        future.add_done_callback(lambda f: finish_thumbnail(output_path, f))
+    future.result()
+    return output_path
+
+def finish_thumbnail(output_path, future):
+    """生成完了時にキャッシュ容量を更新し、上限を超えていれば掃除する"""
+    global thumbnail_cache_bytes
+    
+    with thumbnail_lock:
+        thumbnail_futures.pop(output_path, None)
+        if future.exception() is not None or thumbnail_cache_bytes is None:
+            return
+        thumbnail_cache_bytes += future.result()
+        over_budget = thumbnail_cache_bytes > THUMBNAIL_CACHE_BYTES
+    
+    if over_budget:
+        thumbnail_executor.submit(sweep_thumbnails)
+
+def prune_disk_cache(folder, max_bytes):
+    """最近使われていないファイルから削除して上限の8割まで減らし、残りの容量を返す"""
+    entries = []
+    for root, _, files in os.walk(folder):
+        for name in files:
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+    
+    total = sum(size for _, size, _ in entries)
+    if total > max_bytes:
+        entries.sort()
+        for _, size, path in entries:
+            if total <= max_bytes * 0.8:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+    return total
+
+def sweep_thumbnails():
+    """派生画像のキャッシュを上限内に保つ"""
+    global thumbnail_cache_bytes
+    
+    total = prune_disk_cache(THUMBNAIL_FOLDER, THUMBNAIL_CACHE_BYTES)
+    with thumbnail_lock:
+        thumbnail_cache_bytes = total
+
+def evict_thumbnails(result_id):
+    """抽出結果の派生画像をまとめて削除"""
+    shutil.rmtree(os.path.join(THUMBNAIL_FOLDER, result_id), ignore_errors=True)
+
+@app.route('/thumbnails/<result_id>/<size>/<filename>')
+def serve_thumbnail(result_id, size, filename):
+    """サイズと形式を指定して抽出画像の派生画像を配信"""
+    stem, ext = os.path.splitext(filename)
+    image_format = ext[1:]
+    if size not in THUMBNAIL_SIZES or image_format not in THUMBNAIL_FORMATS:
+        return jsonify({'error': 'Unsupported thumbnail'}), 404
+    if image_format == 'webp' and not WEBP_AVAILABLE:
+        return jsonify({'error': 'WebP is not supported'}), 404
+    if load_result_frame(result_id, f'{stem}.jpg') is None:
+        return jsonify({'error': 'Image not found'}), 404
+    
+    if thumbnail_cache_bytes is None:
+        # 起動後最初の配信時に既存キャッシュの容量を数える
+        sweep_thumbnails()
+    
+    try:
+        path = ensure_thumbnail(result_id, size, filename)
+        # 最終利用時刻として更新時刻を使う（掃除は古いものから）
+        os.utime(path)
+    except OSError as e:
+        print(f"Thumbnail error: {e}")
+        return jsonify({'error': 'Image not found'}), 404
+    
+    return send_from_directory(os.path.dirname(path), filename, max_age=SCENE_IMAGE_MAX_AGE)
+
+# ---------------------------------------------------------------------------
+# スプライトシート（多数のフレームを数枚のタイル画像にまとめて配信する）
+# ---------------------------------------------------------------------------
+
+# 'auto': SPRITE_MIN_FRAMES 枚以上のとき抽出時に作成 / '1': 常に作成 / '0': 抽出時には作成しない
+SPRITE_SHEETS = os.environ.get('SPRITE_SHEETS', 'auto')
+SPRITE_MIN_FRAMES = int(os.environ.get('SPRITE_MIN_FRAMES', 40))
+SPRITE_TILE_WIDTH = 240
+# 1枚のシートに並べるタイル数
+SPRITE_COLUMNS = 10
+SPRITE_ROWS = 10
+SPRITE_QUALITY = 75
+SPRITE_DIRNAME = 'sprites'
+SPRITE_INDEX_FILENAME = 'index.json'
+SPRITE_SHEET_PATTERN = re.compile(r'^sheet_\d{3}\.jpg$')
+
+sprite_lock = threading.Lock()
+# バックグラウンドで作成中の結果ID（sprite_lock で保護）
+sprite_builds = set()
+
+def sprites_enabled(frame_count):
+    """抽出時にスプライトシートを作成するか"""
+    if SPRITE_SHEETS == 'auto':
+        return frame_count >= SPRITE_MIN_FRAMES
+    return SPRITE_SHEETS == '1'
+
+def load_sprite_tile(path, tile_width, tile_height):
+    """フレームをタイルの大きさに縮小して読み込む"""
+    with Image.open(path) as img:
+        img.draft('RGB', (tile_width, tile_height))
+        return img.convert('RGB').resize((tile_width, tile_height), Image.Resampling.LANCZOS)
+
+def build_sprite_sheets(result_dir, frames):
+    """フレームを並べたスプライトシートと、フレーム→シート・位置・時刻の索引を書き出す"""
+    if not frames:
+        return None
+    
+    width, height = frames[0].get('width'), frames[0].get('height')
+    if not width or not height:
+        with Image.open(os.path.join(result_dir, frames[0]['filename'])) as img:
+            width, height = img.size
+    tile_width = min(SPRITE_TILE_WIDTH, width)
+    tile_height = max(1, round(tile_width * height / width))
+    per_sheet = SPRITE_COLUMNS * SPRITE_ROWS
+    
+    # 途中のシートが見えないよう作業ディレクトリに書き出してから名前を変える
+    sprite_dir = os.path.join(result_dir, SPRITE_DIRNAME)
+    work_dir = f'{sprite_dir}.work-{uuid.uuid4().hex}'
+    # 作成中に結果が削除されたらディレクトリを作り直さずに失敗させる
+    os.mkdir(work_dir)
+    
+    try:
+        index = {
+            'tile_width': tile_width,
+            'tile_height': tile_height,
+            'columns': SPRITE_COLUMNS,
+            'sheets': [],
+            'tiles': []
+        }
+        with ThreadPoolExecutor(max_workers=THUMBNAIL_WORKERS) as pool:
+            for start in range(0, len(frames), per_sheet):
+                batch = frames[start:start + per_sheet]
+                columns = min(len(batch), SPRITE_COLUMNS)
+                rows = math.ceil(len(batch) / SPRITE_COLUMNS)
+                sheet_filename = f"sheet_{len(index['sheets']):03d}.jpg"
+                sheet = Image.new('RGB', (columns * tile_width, rows * tile_height))
+                
+                paths = [os.path.join(result_dir, frame_info['filename']) for frame_info in batch]
+                tiles = pool.map(lambda path: load_sprite_tile(path, tile_width, tile_height), paths)
+                for i, (frame_info, tile) in enumerate(zip(batch, tiles)):
+                    x, y = (i % SPRITE_COLUMNS) * tile_width, (i // SPRITE_COLUMNS) * tile_height
+                    sheet.paste(tile, (x, y))
+                    index['tiles'].append({
+                        'filename': frame_info['filename'],
+                        'timestamp': frame_info['timestamp'],
+                        'sheet': len(index['sheets']),
+                        'x': x,
+                        'y': y
+                    })
+                
+                sheet.save(os.path.join(work_dir, sheet_filename), 'JPEG',
+                           quality=SPRITE_QUALITY, optimize=True, progressive=True)
+                index['sheets'].append({
+                    'filename': sheet_filename,
+                    'width': sheet.width,
+                    'height': sheet.height,
+                    'columns': columns,
+                    'rows': rows
                 })
         
-        return frame_data
+        with open(os.path.join(work_dir, SPRITE_INDEX_FILENAME), 'w', encoding='utf-8') as f:
+            json.dump(index, f)
         
-    except Exception as e:
-        print(f"Scene detection error: {e}")
-        return []
+        try:
+            os.rename(work_dir, sprite_dir)
+        except OSError:
+            # 並行して作成済みの場合はそちらを使う
+            pass
+        return index
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def load_sprite_index(result_id):
+    """スプライトシートの索引を読み込む（なければNone）"""
+    if not is_valid_result_id(result_id):
+        return None
+    
+    index_path = os.path.join(SCENES_FOLDER, result_id, SPRITE_DIRNAME, SPRITE_INDEX_FILENAME)
+    try:
+        with open(index_path, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def schedule_sprite_build(result_id, frames):
+    """抽出時に作成されるはずだったスプライトシートをサムネイル用のスレッドで作成する"""
+    if not sprites_enabled(len(frames)):
+        return
+    with sprite_lock:
+        if result_id in sprite_builds:
+            return
+        sprite_builds.add(result_id)
+    
+    def build():
+        try:
+            if load_sprite_index(result_id) is None:
+                build_sprite_sheets(os.path.join(SCENES_FOLDER, result_id), frames)
+        except Exception as e:
+            print(f"Sprite sheet error: {e}")
+        finally:
+            with sprite_lock:
+                sprite_builds.discard(result_id)
+    
+    thumbnail_executor.submit(build)
+
+def add_sprite_urls(result_id, index):
+    for sheet in index['sheets']:
+        sheet['url'] = url_for('serve_sprite_sheet', result_id=result_id, filename=sheet['filename'])
+    return index
+
+@app.route('/results/<result_id>/sprites.json')
+def result_sprites(result_id):
+    """スプライトシートの索引を返す（まだ無ければ 404。画面はフレームごとのサムネイルを使う）"""
+    index = load_sprite_index(result_id)
+    if index is not None:
+        return jsonify(add_sprite_urls(result_id, index))
+    
+    manifest = load_cached_result(result_id)
+    if manifest is None:
+        return jsonify({'error': 'Result not found'}), 404
+    # 作成が有効な設定で抽出時に作られていなかった（古い結果など）分は後ろで作成する
+    schedule_sprite_build(result_id, manifest['frames'])
+    return jsonify({'error': 'Sprite sheets are not available'}), 404
+
+@app.route('/results/<result_id>/sprites/<filename>')
+def serve_sprite_sheet(result_id, filename):
+    """スプライトシート画像を配信"""
+    if not is_valid_result_id(result_id) or not SPRITE_SHEET_PATTERN.match(filename):
+        return jsonify({'error': 'Image not found'}), 404
+    return send_from_directory(os.path.join(SCENES_FOLDER, result_id, SPRITE_DIRNAME), filename,
+                               max_age=SCENE_IMAGE_MAX_AGE)
+
+# ---------------------------------------------------------------------------
+# 任意時刻のフレーム取得（キーフレーム索引でシークし、デコード結果をキャッシュ）
+# ---------------------------------------------------------------------------
+
+FRAME_FOLDER = os.path.join(static_folder, 'frames')
+# デコード済みフレームのディスクキャッシュ上限（バイト）
+FRAME_CACHE_BYTES = int(os.environ.get('FRAME_CACHE_BYTES', 256 * 1024 * 1024))
+# メモリに保持するデコード済みフレームの上限（バイト）
+FRAME_MEMORY_CACHE_BYTES = int(os.environ.get('FRAME_MEMORY_CACHE_BYTES', 32 * 1024 * 1024))
+# 同時に実行するフレームデコードの数
+FRAME_WORKERS = int(os.environ.get('FRAME_WORKERS', 4))
+VIDEO_FILENAME_PATTERN = re.compile(r'^[0-9a-f]{64}\.[A-Za-z0-9]{1,8}$')
+
+frame_executor = ThreadPoolExecutor(max_workers=FRAME_WORKERS)
+frame_lock = threading.Lock()
+# デコード中のフレーム（同じフレームへの同時リクエストで重複してデコードしない）
+frame_futures = {}
+frame_memory_cache = collections.OrderedDict()
+frame_memory_bytes = 0
+frame_cache_bytes = None
+
+def keyframe_index_path_for(digest):
+    """動画ごとのキーフレーム索引の保存先"""
+    return os.path.join(SCENES_FOLDER, f'{digest[:32]}_keyframes.npy')
+
+def load_keyframe_index(video_path):
+    """キーフレームの時刻一覧を読み込む（初回は ffprobe で1回だけ走査して保存）"""
+    digest = os.path.splitext(os.path.basename(video_path))[0]
+    path = keyframe_index_path_for(digest)
+    try:
+        return np.load(path).tolist()
+    except (OSError, ValueError):
+        pass
+    
+    keyframes = probe_keyframes(video_path)
+    if keyframes:
+        tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.save(f, np.asarray(keyframes, dtype='<f8'))
+        os.replace(tmp_path, path)
+    return keyframes
+
+def decode_frame(video_path, timestamp, size, output_path):
+    """直前のキーフレームへシークして1フレームだけデコードし、JPEGのバイト列を返す"""
+    keyframes = load_keyframe_index(video_path)
+    i = bisect.bisect_right(keyframes, timestamp) - 1
+    keyframe = keyframes[i] if i >= 0 else 0.0
+    
+    # 入力側はキーフレームへ直接シークし、出力側の -ss で目的の時刻までデコードを進める
+    tmp_path = f'{output_path}.{uuid.uuid4().hex}.tmp.jpg'
+    cmd = [
+        'ffmpeg', '-v', 'error',
+        '-ss', f'{keyframe:.6f}', '-noaccurate_seek', '-i', video_path,
+        '-ss', f'{timestamp - keyframe:.6f}',
+        '-frames:v', '1'
+    ]
+    max_width = THUMBNAIL_SIZES[size]
+    if max_width:
+        cmd += ['-vf', f"scale='min({max_width},iw)':-2"]
+    cmd += ['-q:v', '2', '-y', tmp_path]
+    
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    try:
+        # 表示待ちの1フレームなのでジョブの後ろに並ばせず、1スレッドで即座にデコードする
+        with MetricTimer('frame_extract_seconds'):
+            ffmpeg = run_ffmpeg(cmd, timeout=30, threads=1)
+        if ffmpeg.returncode != 0 or not os.path.exists(tmp_path):
+            # 動画の長さを超えた時刻などは出力なし
+            return None
+        
+        with open(tmp_path, 'rb') as f:
+            data = f.read()
+        os.replace(tmp_path, output_path)
+        return data
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def remember_frame(key, data):
+    """デコード済みフレームをメモリのLRUキャッシュに入れる"""
+    global frame_memory_bytes
+    
+    with frame_lock:
+        if key in frame_memory_cache:
+            return
+        frame_memory_cache[key] = data
+        frame_memory_bytes += len(data)
+        while frame_memory_bytes > FRAME_MEMORY_CACHE_BYTES and frame_memory_cache:
+            _, old = frame_memory_cache.popitem(last=False)
+            frame_memory_bytes -= len(old)
+
+def get_frame(video_path, timestamp, size='full'):
+    """指定時刻のフレームをメモリ→ディスク→デコードの順に探して返す（なければNone）"""
+    global frame_cache_bytes
+    
+    digest = os.path.splitext(os.path.basename(video_path))[0][:32]
+    touch_storage(digest)
+    # ミリ秒単位に丸めてキャッシュキーにする
+    millis = int(round(timestamp * 1000))
+    key = f'{digest}/{size}/{millis:09d}.jpg'
+    
+    with frame_lock:
+        data = frame_memory_cache.get(key)
+        if data is not None:
+            frame_memory_cache.move_to_end(key)
+    if data is not None:
+        inc_metric('cache_hits_total', cache='frame_memory')
+        return data
+    
+    path = os.path.join(FRAME_FOLDER, key)
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+        # 最終利用時刻として更新時刻を使う（掃除は古いものから）
+        os.utime(path)
+        remember_frame(key, data)
+        inc_metric('cache_hits_total', cache='frame')
+        return data
+    except OSError:
+        pass
+    inc_metric('cache_misses_total', cache='frame')
+    
+    with frame_lock:
+        future = frame_futures.get(key)
+        created = future is None
+        if created:
+            future = frame_executor.submit(decode_frame, video_path, millis / 1000, size, path)
+            frame_futures[key] = future
+    
+    try:
+        data = future.result()
+    finally:
+        if created:
+            with frame_lock:
+                frame_futures.pop(key, None)
+    
+    if data is None:
+        return None
+    remember_frame(key, data)
+    
+    if created:
+        with frame_lock:
+            if frame_cache_bytes is not None:
+                frame_cache_bytes += len(data)
+            sweep = frame_cache_bytes is None or frame_cache_bytes > FRAME_CACHE_BYTES
+        if sweep:
+            frame_executor.submit(sweep_frames)
+    return data
+
+def sweep_frames():
+    """デコード済みフレームのディスクキャッシュを上限内に保つ"""
+    global frame_cache_bytes
+    
+    total = prune_disk_cache(FRAME_FOLDER, FRAME_CACHE_BYTES)
+    with frame_lock:
+        frame_cache_bytes = total
+
+def frame_url(video, timestamp, size='full'):
+    return url_for('frame_at', video=video, t=f'{timestamp:.3f}', size=size)
+
+@app.route('/frame/<video>')
+def frame_at(video):
+    """動画の任意時刻のフレームを必要になった時点でデコードして返す"""
+    if not VIDEO_FILENAME_PATTERN.match(video):
+        return jsonify({'error': 'Video not found'}), 404
+    
+    video_path = os.path.join(UPLOAD_FOLDER, video)
+    if not os.path.exists(video_path):
+        return jsonify({'error': 'Video not found'}), 404
+    
+    try:
+        timestamp = float(request.args.get('t', 0))
+    except ValueError:
+        return jsonify({'error': 'Invalid time'}), 400
+    if not math.isfinite(timestamp) or timestamp < 0:
+        return jsonify({'error': 'Invalid time'}), 400
+    
+    size = request.args.get('size', 'full')
+    if size not in THUMBNAIL_SIZES:
+        return jsonify({'error': 'Unsupported size'}), 400
+    
+    data = get_frame(video_path, timestamp, size)
+    if data is None:
+        return jsonify({'error': 'Frame not found'}), 404
+    
+    millis = int(round(timestamp * 1000))
+    return send_file(io.BytesIO(data), mimetype='image/jpeg', max_age=SCENE_IMAGE_MAX_AGE,
+                     etag=f'{video}-{size}-{millis}')
 
 @app.route('/static/scenes/<path:filename>')
 def serve_scene_file(filename):
-    """抽出されたシーン画像を配信"""
-    return send_from_directory(SCENES_FOLDER, filename)
+    """抽出されたシーン画像を配信（マニフェストに記録された画像のみ）"""
+    result_id, _, frame_filename = filename.partition('/')
+    if load_result_frame(result_id, frame_filename) is None:
+        return jsonify({'error': 'Image not found'}), 404
+    
+    # 結果ディレクトリの内容は作成後に変わらない
+    return send_from_directory(os.path.join(SCENES_FOLDER, result_id), frame_filename,
+                               max_age=SCENE_IMAGE_MAX_AGE)
 
 @app.route('/uploads/<path:filename>')
 def serve_uploaded_file(filename):
     """アップロードされた動画ファイルを配信"""
+    if DIGEST_PREFIX_PATTERN.match(filename):
+        touch_storage(filename)
     return send_from_directory(UPLOAD_FOLDER, filename)
 
-@app.route('/export_pdf')
-def export_pdf():
-    """PDF形式で解析結果をエクスポート"""
-    try:
-        # クエリパラメータから情報を取得
-        video_filename = request.args.get('video')
-        original_filename = request.args.get('original_filename', video_filename)
-        mode = request.args.get('mode', 'interval')
-        interval = request.args.get('interval', '5')
-        
-        if not video_filename:
-            return "動画ファイル名が指定されていません", 400
-        
-        # ファイル名から拡張子を除いた部分を取得
-        filename_no_ext = os.path.splitext(video_filename)[0]
-        scene_dir = os.path.join(SCENES_FOLDER, filename_no_ext)
+# ---------------------------------------------------------------------------
+# PDFレポート（縮小画像で組版し、結果ごとにファイルとしてキャッシュ）
+# ---------------------------------------------------------------------------
+
+REPORT_DIRNAME = 'reports'
+# 組版や画像処理を変えたら上げて古いキャッシュを使わないようにする
+REPORT_VERSION = 3
+# 埋め込み画像の解像度（4.5インチ幅で675px）
+PDF_IMAGE_DPI = int(os.environ.get('PDF_IMAGE_DPI', 150))
+# レイアウトごとのシーン画像の表示枠と列数
+#   list: 1ページ3シーン程度の一覧、contact: 1ページ最大32シーンのコンタクトシート
+REPORT_LAYOUTS = {
+    'list': {'box': (4.5 * inch, 3 * inch), 'columns': 1},
+    'contact': {'box': (1.7 * inch, 1.1 * inch), 'columns': 4}
+}
+# 画像の縮小を並列に行うスレッド数（PILはデコード・リサイズ中にGILを解放する）
+REPORT_WORKERS = int(os.environ.get('REPORT_WORKERS', os.cpu_count() or 2))
+
+report_lock = threading.Lock()
+report_building = {}
+
+# 画像データを ASCII85 にせずバイナリのまま埋め込む（サイズが約25%減る）
+rl_config.useA85 = 0
+
+def report_path_for(result_id, layout='list'):
+    """レポートのキャッシュパス（レイアウト・画像設定ごと。ダウンロード名は含めない）"""
+    key = hashlib.sha1(f'{REPORT_VERSION}:{PDF_IMAGE_DPI}:{layout}'.encode()).hexdigest()[:16]
+    return os.path.join(SCENES_FOLDER, result_id, REPORT_DIRNAME, f'{layout}_{key}.pdf')
+
+def fit_image_box(width, height, box):
+    """比率を保ったまま枠に収まる表示サイズ"""
+    max_width, max_height = box
+    aspect_ratio = width / height
+    if aspect_ratio > max_width / max_height:
+        # 横長の場合
+        return max_width, max_width / aspect_ratio
+    # 縦長の場合
+    return max_height * aspect_ratio, max_height
+
+def read_image_size(frame_info, image_path):
+    """画像サイズをマニフェストから取得（旧形式はJPEGのヘッダーだけを読む）"""
+    width, height = frame_info.get('width'), frame_info.get('height')
+    if width and height:
+        return width, height
+    # Image.open はヘッダーの解析だけで画素はデコードしない
+    with Image.open(image_path) as img:
+        return img.size
+
+def prepare_report_image(image_path, embed_path, frame_info, box):
+    """埋め込み用に表示サイズまで縮小した画像を用意し、画像パスと表示サイズを返す"""
+    width, height = read_image_size(frame_info, image_path)
+    draw_width, draw_height = fit_image_box(width, height, box)
+    
+    # 表示幅に必要な画素数まで縮小したJPEGを埋め込む
+    pixel_width = math.ceil(draw_width / inch * PDF_IMAGE_DPI)
+    if pixel_width < width:
+        make_thumbnail(image_path, embed_path, pixel_width, 'JPEG')
+    else:
+        embed_path = image_path
+    return embed_path, draw_width, draw_height
+
+def prepare_report_images(scene_dir, frames, box, image_dir):
+    """全シーンの埋め込み画像をスレッドプールで用意する（読めない画像は除く）"""
+    def prepare(frame_info):
+        image_path = os.path.join(scene_dir, frame_info['filename'])
+        if not os.path.exists(image_path):
+            return None
+        try:
+            return prepare_report_image(image_path, os.path.join(image_dir, frame_info['filename']),
+                                        frame_info, box)
+        except Exception as e:
+            print(f"Error processing image {frame_info['filename']}: {e}")
+            return None
+    
+    with ThreadPoolExecutor(max_workers=REPORT_WORKERS) as pool:
+        prepared = list(pool.map(prepare, frames))
+    return [(i, frame_info, image) for i, (frame_info, image) in enumerate(zip(frames, prepared))
+            if image is not None]
+
+def report_image(image):
+    """用意した画像から表示サイズを指定した画像オブジェクトを作成"""
+    embed_path, draw_width, draw_height = image
+    img = RLImage(embed_path)
+    img.drawWidth = draw_width
+    img.drawHeight = draw_height
+    return img
+
+def build_scene_list_story(scenes, box):
+    """1シーンずつ表にする一覧レイアウト"""
+    story = []
+    for i, frame_info, image in scenes:
+        time_str = format_timestamp(frame_info['timestamp'])[:8]
         
-        if not os.path.exists(scene_dir):
-            return "解析結果が見つかりません", 404
+        # シーン情報テーブル
+        scene_data = [
+            [f"Scene {i+1}", f"Time: {time_str}"],
+            [report_image(image), ""]
+        ]
         
-        # 画像ファイルを取得
-        image_files = sorted([f for f in os.listdir(scene_dir) if f.endswith('.jpg')])
+        scene_table = Table(scene_data, colWidths=[box[0], 1.5*inch])
+        scene_table.setStyle(TableStyle([
+            ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+            ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
+            ('FONTNAME', (0, 0), (1, 0), 'Helvetica-Bold'),
+            ('FONTSIZE', (0, 0), (1, 0), 12),
+            ('GRID', (0, 0), (-1, -1), 1, colors.lightgrey),
+            ('BACKGROUND', (0, 0), (1, 0), colors.lightgreen),
+        ]))
         
-        if not image_files:
-            return "画像ファイルが見つかりません", 404
+        story.append(scene_table)
+        story.append(Spacer(1, 15))
+    return story
+
+def build_contact_sheet_story(scenes, box, columns):
+    """複数シーンを格子状に並べるコンタクトシートレイアウト"""
+    caption_style = ParagraphStyle(
+        'ContactCaption',
+        fontSize=8,
+        leading=10,
+        alignment=1,  # 中央揃え
+        fontName='Helvetica'
+    )
+    
+    cells = []
+    for i, frame_info, image in scenes:
+        time_str = format_timestamp(frame_info['timestamp'])[:8]
+        cells.append([report_image(image), Paragraph(f"#{i+1}  {time_str}", caption_style)])
+    
+    rows = [cells[start:start + columns] for start in range(0, len(cells), columns)]
+    rows[-1] += [''] * (columns - len(rows[-1]))
+    
+    # 行単位でページをまたいで分割される
+    sheet = Table(rows, colWidths=[box[0] + 0.1 * inch] * columns)
+    sheet.setStyle(TableStyle([
+        ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+        ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
+        ('GRID', (0, 0), (-1, -1), 0.5, colors.lightgrey),
+        ('TOPPADDING', (0, 0), (-1, -1), 3),
+        ('BOTTOMPADDING', (0, 0), (-1, -1), 3),
+    ]))
+    return [sheet]
+
+def build_pdf_report(result_id, manifest, output_path, layout='list'):
+    """レポートを組版してファイルに書き出す（画像は表示サイズまで縮小して埋め込む）"""
+    scene_dir = os.path.join(SCENES_FOLDER, result_id)
+    frames = manifest['frames']
+    mode = manifest['mode']
+    interval = manifest['interval']
+    box = REPORT_LAYOUTS[layout]['box']
+    
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    tmp_path = f'{output_path}.{uuid.uuid4().hex}.tmp'
+    image_dir = tempfile.mkdtemp(dir=os.path.dirname(output_path))
+    try:
+        # 組版の前に画像の縮小をまとめて並列に済ませる
+        scenes = prepare_report_images(scene_dir, frames, box, image_dir)
         
-        # PDF生成
-        buffer = BytesIO()
-        doc = SimpleDocTemplate(buffer, pagesize=A4, 
+        doc = SimpleDocTemplate(tmp_path, pagesize=A4, 
                               rightMargin=inch*0.5, leftMargin=inch*0.5,
                               topMargin=inch*0.5, bottomMargin=inch*0.5)
         
@@ -330,102 +4301,201 @@ def export_pdf():
         story.append(Paragraph("Video Analysis Report", title_style))
         
         # 基本情報
-        mode_text = "Scene Detection" if mode == 'scene' else f"Interval Extraction ({interval}s)"
+        if mode == 'scene':
+            mode_text = "Scene Detection"
+        elif mode in ('fast', 'fastscene'):
+            mode_text = "Keyframe Extraction"
+        elif mode == 'adaptive':
+            mode_text = f"Adaptive Sampling ({interval}s)"
+        else:
+            mode_text = f"Interval Extraction ({interval}s)"
         story.append(Paragraph(f"Analysis Method: {mode_text}", subtitle_style))
-        story.append(Paragraph(f"Video File: {original_filename}", subtitle_style))
-        story.append(Paragraph(f"Extracted Frames: {len(image_files)} frames", subtitle_style))
+        story.append(Paragraph(f"Video File: {manifest['video']}", subtitle_style))
+        story.append(Paragraph(f"Extracted Frames: {len(frames)} frames", subtitle_style))
         story.append(Spacer(1, 20))
         
         # 各シーンの情報
-        for i, image_file in enumerate(image_files):
-            try:
-                # より正確な時間計算
-                if mode == 'interval':
-                    # 定間隔の場合は正確に計算
-                    timestamp_seconds = i * int(interval)
-                else:
-                    # シーン検出の場合、ファイル名から推定（完璧ではないが改善）
-                    # scene_001.jpg, scene_002.jpg のようなファイル名の場合
-                    if 'scene_' in image_file:
-                        scene_num = int(image_file.split('_')[1].split('.')[0])
-                        # シーン検出は不規則だが、経験的に最初のシーンが多い
-                        timestamp_seconds = scene_num * 5  # 暫定的な計算
-                    else:
-                        timestamp_seconds = i * 10  # フォールバック
-                
-                hours = int(timestamp_seconds // 3600)
-                minutes = int((timestamp_seconds % 3600) // 60)
-                secs = int(timestamp_seconds % 60)
-                time_str = f"{hours:02d}:{minutes:02d}:{secs:02d}"
-                
-                # 画像パス
-                image_path = os.path.join(scene_dir, image_file)
-                
-                if os.path.exists(image_path):
-                    # 元画像のサイズを取得して比率を保持
-                    with Image.open(image_path) as pil_img:
-                        width, height = pil_img.size
-                        aspect_ratio = width / height
-                    
-                    # PDF用画像サイズを比率を保持して設定
-                    max_width = 4.5 * inch
-                    max_height = 3 * inch
-                    
-                    if aspect_ratio > max_width / max_height:
-                        # 横長の場合
-                        img_width = max_width
-                        img_height = max_width / aspect_ratio
-                    else:
-                        # 縦長の場合
-                        img_height = max_height
-                        img_width = max_height * aspect_ratio
-                    
-                    # 画像オブジェクト作成
-                    img = RLImage(image_path)
-                    img.drawWidth = img_width
-                    img.drawHeight = img_height
-                    
-                    # シーン情報テーブル
-                    scene_data = [
-                        [f"Scene {i+1}", f"Time: {time_str}"],
-                        [img, ""]
-                    ]
-                    
-                    scene_table = Table(scene_data, colWidths=[max_width, 1.5*inch])
-                    scene_table.setStyle(TableStyle([
-                        ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-                        ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
-                        ('FONTNAME', (0, 0), (1, 0), 'Helvetica-Bold'),
-                        ('FONTSIZE', (0, 0), (1, 0), 12),
-                        ('GRID', (0, 0), (-1, -1), 1, colors.lightgrey),
-                        ('BACKGROUND', (0, 0), (1, 0), colors.lightgreen),
-                    ]))
-                    
-                    story.append(scene_table)
-                    story.append(Spacer(1, 15))
-                    
-            except Exception as e:
-                print(f"Error processing image {image_file}: {e}")
-                continue
+        if layout == 'contact' and scenes:
+            story += build_contact_sheet_story(scenes, box, REPORT_LAYOUTS[layout]['columns'])
+        else:
+            story += build_scene_list_story(scenes, box)
         
-        # PDF生成
+        # PDF生成（書き出しはファイルへ直接行う）
         doc.build(story)
-        buffer.seek(0)
+        os.replace(tmp_path, output_path)
+    finally:
+        shutil.rmtree(image_dir, ignore_errors=True)
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return output_path
+
+def ensure_pdf_report(result_id, manifest, layout='list'):
+    """キャッシュ済みのレポートを返す（なければ作成、同時の要求は1回の作成を待つ）"""
+    output_path = report_path_for(result_id, layout)
+    if os.path.exists(output_path):
+        inc_metric('cache_hits_total', cache='report')
+        return output_path
+    inc_metric('cache_misses_total', cache='report')
+    
+    with report_lock:
+        building = report_building.get(output_path)
+        if building is None:
+            building = report_building[output_path] = threading.Lock()
+    
+    with building:
+        try:
+            if not os.path.exists(output_path):
+                with MetricTimer('pdf_build_seconds', layout=layout):
+                    build_pdf_report(result_id, manifest, output_path, layout)
+        finally:
+            with report_lock:
+                report_building.pop(output_path, None)
+    return output_path
+
+@app.route('/export_pdf')
+def export_pdf():
+    """PDF形式で解析結果をエクスポート"""
+    try:
+        # クエリパラメータから情報を取得
+        result_id = request.args.get('result')
+        if not result_id:
+            return "解析結果が指定されていません", 400
+        if not is_valid_result_id(result_id):
+            return "解析結果の指定が不正です", 400
+        layout = request.args.get('layout', 'list')
+        if layout not in REPORT_LAYOUTS:
+            return "レイアウトの指定が不正です", 400
         
-        # 元ファイル名からPDFファイル名を作成
-        pdf_filename = os.path.splitext(original_filename)[0] + "_analysis.pdf"
+        # 抽出時に記録したマニフェストからフレームと実際のタイムスタンプを取得
+        manifest = load_cached_result(result_id)
+        if manifest is None:
+            return "解析結果が見つかりません", 404
+        
+        if not manifest['frames']:
+            return "画像ファイルが見つかりません", 404
         
-        # レスポンス作成
-        response = make_response(buffer.getvalue())
-        response.headers['Content-Type'] = 'application/pdf'
-        response.headers['Content-Disposition'] = f'attachment; filename="{pdf_filename}"'
+        report_path = ensure_pdf_report(result_id, manifest, layout)
         
-        return response
+        # 元ファイル名はダウンロード時のファイル名にだけ使う（キャッシュは共有する）
+        original_filename = request.args.get('original_filename') or manifest['video']
+        suffix = '_contact_sheet' if layout == 'contact' else '_analysis'
+        pdf_filename = os.path.splitext(original_filename)[0] + suffix + ".pdf"
+        
+        # キャッシュしたファイルをそのまま分割して送る
+        return send_file(report_path, mimetype='application/pdf', as_attachment=True,
+                         download_name=pdf_filename, max_age=SCENE_IMAGE_MAX_AGE)
         
     except Exception as e:
         print(f"PDF export error: {e}")
         return f"PDF作成中にエラーが発生しました: {str(e)}", 500
 
+# ---------------------------------------------------------------------------
+# ZIPエクスポート（抽出画像とタイムスタンプ一覧をストリーミングで送る）
+# ---------------------------------------------------------------------------
+
+class ZipStreamBuffer:
+    """ZipFile の書き込み先。書かれたデータを溜めておき、取り出すたびに空にする"""
+    
+    def __init__(self):
+        self.chunks = []
+        self.offset = 0
+    
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.offset += len(data)
+        return len(data)
+    
+    def tell(self):
+        # シークできない出力として扱わせ、エントリごとにデータディスクリプタを使わせる
+        return self.offset
+    
+    def flush(self):
+        pass
+    
+    def pop(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+def build_timestamps_csv(frames):
+    """フレームのタイムスタンプ一覧をCSVにする"""
+    lines = ['index,filename,timestamp,time,score,width,height']
+    for i, frame_info in enumerate(frames):
+        score = frame_info.get('score')
+        lines.append(','.join([
+            str(i + 1),
+            frame_info['filename'],
+            f"{frame_info['timestamp']:.3f}",
+            format_timestamp(frame_info['timestamp']),
+            '' if score is None else str(score),
+            str(frame_info.get('width') or ''),
+            str(frame_info.get('height') or '')
+        ]))
+    return '\n'.join(lines) + '\n'
+
+def generate_result_zip(result_id, manifest):
+    """抽出画像（無圧縮で格納）とタイムスタンプ一覧のZIPを少しずつ生成する"""
+    scene_dir = os.path.join(SCENES_FOLDER, result_id)
+    buffer = ZipStreamBuffer()
+    
+    # JPEGは再圧縮しても縮まないため ZIP_STORED で格納する
+    with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_STORED) as archive:
+        archive.writestr('timestamps.csv', build_timestamps_csv(manifest['frames']))
+        archive.writestr('timestamps.json', json.dumps({
+            'result_id': result_id,
+            'video': manifest['video'],
+            'mode': manifest['mode'],
+            'interval': manifest['interval'],
+            'sensitivity': manifest['sensitivity'],
+            'frames': manifest['frames']
+        }, ensure_ascii=False, indent=2))
+        yield buffer.pop()
+        
+        for frame_info in manifest['frames']:
+            image_path = os.path.join(scene_dir, frame_info['filename'])
+            if not os.path.exists(image_path):
+                continue
+            # 1ファイル分ずつ送るので、メモリに載るのは常に画像1枚程度
+            archive.write(image_path, f"frames/{frame_info['filename']}")
+            yield buffer.pop()
+    
+    # 中央ディレクトリ
+    yield buffer.pop()
+
+@app.route('/export_zip')
+def export_zip():
+    """抽出画像とタイムスタンプ一覧をZIPでダウンロード"""
+    result_id = request.args.get('result')
+    if not result_id:
+        return "解析結果が指定されていません", 400
+    if not is_valid_result_id(result_id):
+        return "解析結果の指定が不正です", 400
+    
+    manifest = load_cached_result(result_id)
+    if manifest is None:
+        return "解析結果が見つかりません", 404
+    
+    original_filename = request.args.get('original_filename') or manifest['video']
+    zip_filename = os.path.splitext(original_filename)[0] + "_frames.zip"
+    
+    response = app.response_class(stream_with_context(generate_result_zip(result_id, manifest)),
+                                  mimetype='application/zip')
+    set_attachment_filename(response, zip_filename)
+    return response
+
+def set_attachment_filename(response, filename):
+    """ダウンロード名を設定（ASCII以外は send_file と同じく filename* で渡す）"""
+    try:
+        filename.encode('ascii')
+    except UnicodeEncodeError:
+        simple = unicodedata.normalize('NFKD', filename).encode('ascii', 'ignore').decode('ascii')
+        response.headers.set('Content-Disposition', 'attachment', filename=simple,
+                             **{'filename*': "UTF-8''" + quote(filename, safe="!#$&+^`|~")})
+    else:
+        response.headers.set('Content-Disposition', 'attachment', filename=filename)
+
 if __name__ == '__main__':
+    # PyInstaller でビルドした実行ファイルからワーカープロセスを起動するため
+    multiprocessing.freeze_support()
     port = int(os.environ.get('PORT', 5000))
     app.run(host='0.0.0.0', port=port, debug=False)
\ No newline at end of file
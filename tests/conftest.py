@@ -0,0 +1,63 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# 集計ファイルはテストごとの一時ディレクトリに書く（インポート前に設定する）
+os.environ.setdefault('METRICS_DIR', tempfile.mkdtemp(prefix='video-cut-viewer-test-metrics-'))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app_simple  # noqa: E402
+from PIL import Image  # noqa: E402
+
+DIGEST = 'ab' * 32
+
+
+@pytest.fixture
+def folders(tmp_path, monkeypatch):
+    """アップロード・抽出結果・派生画像の保存先を一時ディレクトリに差し替える"""
+    paths = {name: tmp_path / name for name in ('uploads', 'scenes', 'thumbnails', 'frames')}
+    for path in paths.values():
+        path.mkdir()
+    monkeypatch.setattr(app_simple, 'UPLOAD_FOLDER', str(paths['uploads']))
+    monkeypatch.setattr(app_simple, 'SCENES_FOLDER', str(paths['scenes']))
+    monkeypatch.setattr(app_simple, 'THUMBNAIL_FOLDER', str(paths['thumbnails']))
+    monkeypatch.setattr(app_simple, 'FRAME_FOLDER', str(paths['frames']))
+    monkeypatch.setattr(app_simple, 'thumbnail_cache_bytes', None)
+    app_simple.manifest_cache.clear()
+    app_simple.storage_touched.clear()
+    yield paths
+    app_simple.manifest_cache.clear()
+    app_simple.storage_touched.clear()
+
+
+@pytest.fixture
+def client():
+    app_simple.app.config['TESTING'] = True
+    return app_simple.app.test_client()
+
+
+@pytest.fixture
+def make_result(folders):
+    """JPEG を書き出した作業ディレクトリから抽出結果を作成する（FFmpeg は使わない）"""
+    def make(count=3, mode='interval', interval=5, sensitivity=0.15, size=(64, 36)):
+        result_id = app_simple.make_result_id(DIGEST, mode, interval, sensitivity)
+        work_dir = folders['scenes'] / '.work-test'
+        work_dir.mkdir()
+        frames = []
+        for i in range(count):
+            filename = f'frame_{i + 1:03d}.jpg'
+            Image.new('RGB', size, (i * 40 % 256, 80, 160)).save(work_dir / filename, 'JPEG')
+            frames.append({'filename': filename, 'timestamp': i * interval})
+        app_simple.store_result(str(work_dir), str(folders['scenes'] / result_id), {
+            'result_id': result_id,
+            'video': f'{DIGEST}.mp4',
+            'mode': mode,
+            'interval': interval,
+            'sensitivity': sensitivity,
+            'frames': frames,
+            'created_at': 0.0
+        })
+        return result_id
+    return make
@@ -0,0 +1,44 @@
+import pytest
+
+import app_simple
+
+
+def test_pick_nearest_keyframes():
+    keyframes = [0.0, 2.0, 4.9, 10.2, 15.0, 18.0]
+    assert app_simple.pick_nearest_keyframes(keyframes, 20, 5) == [0.0, 4.9, 10.2, 15.0]
+    # 同じキーフレームが最寄りになる時刻は1つにまとめる
+    assert app_simple.pick_nearest_keyframes([0.0, 12.0], 20, 5) == [0.0, 12.0]
+
+
+def test_plan_coarse_samples_without_keyframes():
+    times = app_simple.plan_coarse_samples([], 20, 5)
+    assert times[:4] == [0, 5, 10, 15]
+    # 最後の標本以降の変化も拾えるよう終端の直前を足す
+    assert times[4:] == [pytest.approx(20 - app_simple.ADAPTIVE_MIN_SPAN)]
+
+
+def test_plan_coarse_samples_on_keyframes():
+    keyframes = [0.0, 4.9, 10.2, 15.0]
+    times = app_simple.plan_coarse_samples(keyframes, 20, 5)
+    assert times[:4] == keyframes
+    assert times[4:] == [pytest.approx(20 - app_simple.ADAPTIVE_MIN_SPAN)]
+    # 最後の標本が終端に近ければ足さない
+    assert app_simple.plan_coarse_samples(keyframes, 17, 5) == keyframes
+
+
+def test_seek_cost():
+    assert app_simple.seek_cost([], 12.0) == 0.0
+    assert app_simple.seek_cost([0.0, 10.0], 12.0) == pytest.approx(2.0)
+    assert app_simple.seek_cost([0.0, 10.0], 10.0) == 0.0
+
+
+def test_should_scan_prefers_bisecting_with_dense_keyframes():
+    dense = [float(t) for t in range(21)]
+    assert not app_simple.should_scan(dense, 10.0, 20.0, 0.04)
+
+
+def test_should_scan_prefers_scanning_short_or_sparse_spans():
+    # 直前のキーフレームから短い区間は順にデコードする方が安い
+    assert app_simple.should_scan([0.0, 10.0], 10.0, 10.5, 0.04)
+    # キーフレームが疎ならシークのたびに長くデコードするので順に読む
+    assert app_simple.should_scan([0.0, 10.0], 10.0, 20.0, 0.04)
@@ -0,0 +1,57 @@
+import numpy as np
+
+import app_simple
+
+
+def candidate(timestamp, phash):
+    return {'filename': f'frame_{timestamp:03d}.jpg', 'timestamp': timestamp, 'phash': f'{phash:016x}',
+            'dhash': '0' * 16}
+
+
+def test_select_distinct_frames_folds_into_last_kept():
+    base = 0x0f0f0f0f0f0f0f0f
+    candidates = [
+        candidate(0, base),
+        candidate(5, base ^ 0b1),          # 距離1: 重複
+        candidate(10, base ^ 0b111),       # 直前に残した base からの距離3: 重複
+        candidate(15, base ^ 0xffff),      # 距離16: 残す
+        candidate(20, base ^ 0xfffe),      # 残したフレームから距離1: 重複
+    ]
+    kept = app_simple.select_distinct_frames(candidates, 4)
+    assert [(frame['timestamp'], frame['duplicates']) for frame in kept] == [(0, 2), (15, 1)]
+    # 候補一覧は書き換えない
+    assert 'duplicates' not in candidates[0]
+
+
+def test_select_distinct_frames_threshold_zero_keeps_distinct():
+    candidates = [candidate(0, 1), candidate(5, 1), candidate(10, 3)]
+    kept = app_simple.select_distinct_frames(candidates, 0)
+    assert [(frame['timestamp'], frame['duplicates']) for frame in kept] == [(0, 1), (10, 0)]
+
+
+def test_select_distinct_frames_compares_with_kept_frame_not_previous():
+    # 少しずつ変わる画面は、直前との差が小さくても残したフレームから離れたら残す
+    candidates = [candidate(i * 5, (1 << i) - 1) for i in range(8)]
+    kept = app_simple.select_distinct_frames(candidates, 2)
+    assert [frame['timestamp'] for frame in kept] == [0, 15, 30]
+
+
+def test_compute_image_hashes_matches_similar_images():
+    rng = np.random.default_rng(0)
+    image = rng.integers(0, 256, (32, 32)).astype(np.float32)
+    small = rng.integers(0, 256, (8, 9)).astype(np.float32)
+    phashes, dhashes = app_simple.compute_image_hashes([image, image + 3, 255 - image],
+                                                       [small, small + 3, 255 - small])
+    assert phashes[0] == phashes[1]
+    assert dhashes[0] == dhashes[1]
+    assert int(phashes[0] ^ phashes[2]).bit_count() > 32
+
+
+def test_dedupe_threshold_for(monkeypatch):
+    monkeypatch.setattr(app_simple, 'DEDUPE_THRESHOLD', 0)
+    assert app_simple.dedupe_threshold_for('interval') is None
+    assert app_simple.dedupe_threshold_for('interval', 6) == 6
+    assert app_simple.dedupe_threshold_for('scene', 6) is None
+    monkeypatch.setattr(app_simple, 'DEDUPE_THRESHOLD', 5)
+    assert app_simple.dedupe_threshold_for('fast') == 5
+    assert app_simple.dedupe_threshold_for('fast', 0) is None
@@ -0,0 +1,84 @@
+import io
+import json
+import os
+import zipfile
+
+import pytest
+
+import app_simple
+
+
+@pytest.fixture
+def pdf_result(make_result):
+    return make_result(count=2)
+
+
+def report_files(folders, result_id):
+    return sorted(os.listdir(folders['scenes'] / result_id / app_simple.REPORT_DIRNAME))
+
+
+def test_pdf_download_name(client, pdf_result):
+    response = client.get(f'/export_pdf?result={pdf_result}&original_filename=clip.mov')
+    assert response.status_code == 200
+    assert response.mimetype == 'application/pdf'
+    assert response.data.startswith(b'%PDF')
+    assert response.headers['Content-Disposition'] == 'attachment; filename=clip_analysis.pdf'
+
+    response = client.get(f'/export_pdf?result={pdf_result}&original_filename=clip.mov&layout=contact')
+    assert response.headers['Content-Disposition'] == 'attachment; filename=clip_contact_sheet.pdf'
+
+
+def test_pdf_download_name_defaults_to_video(client, pdf_result):
+    response = client.get(f'/export_pdf?result={pdf_result}')
+    video_stem = os.path.splitext(app_simple.load_cached_result(pdf_result)['video'])[0]
+    assert response.headers['Content-Disposition'] == f'attachment; filename={video_stem}_analysis.pdf'
+
+
+def test_pdf_cache_is_shared_across_download_names(client, pdf_result, folders):
+    first = client.get(f'/export_pdf?result={pdf_result}&original_filename=a.mp4')
+    second = client.get(f'/export_pdf?result={pdf_result}&original_filename=b.mp4')
+    assert first.data == second.data
+    assert report_files(folders, pdf_result) == [os.path.basename(app_simple.report_path_for(pdf_result))]
+
+    client.get(f'/export_pdf?result={pdf_result}&layout=contact')
+    assert len(report_files(folders, pdf_result)) == 2
+
+
+def test_pdf_errors(client, folders):
+    assert client.get('/export_pdf').status_code == 400
+    assert client.get('/export_pdf?result=../x').status_code == 400
+    assert client.get(f"/export_pdf?result={'0' * 32}_interval_i5").status_code == 404
+    assert client.get(f"/export_pdf?result={'0' * 32}_interval_i5&layout=poster").status_code == 400
+
+
+def test_zip_contents_and_name(client, make_result):
+    result_id = make_result(count=3)
+    response = client.get(f'/export_zip?result={result_id}&original_filename=clip.mov')
+    assert response.status_code == 200
+    assert response.mimetype == 'application/zip'
+    assert response.headers['Content-Disposition'] == 'attachment; filename=clip_frames.zip'
+
+    with zipfile.ZipFile(io.BytesIO(response.data)) as archive:
+        assert archive.testzip() is None
+        assert archive.namelist() == ['timestamps.csv', 'timestamps.json',
+                                      'frames/frame_001.jpg', 'frames/frame_002.jpg', 'frames/frame_003.jpg']
+        # JPEG は再圧縮せずに格納する
+        assert all(info.compress_type == zipfile.ZIP_STORED for info in archive.infolist())
+        rows = archive.read('timestamps.csv').decode().splitlines()
+        assert rows[0] == 'index,filename,timestamp,time,score,width,height'
+        assert rows[2].startswith('2,frame_002.jpg,5.000,00:00:05.000,')
+        assert json.loads(archive.read('timestamps.json'))['result_id'] == result_id
+
+
+def test_zip_non_ascii_name(client, make_result):
+    result_id = make_result(count=1)
+    response = client.get(f'/export_zip?result={result_id}&original_filename=会議.mp4')
+    disposition = response.headers['Content-Disposition']
+    assert "filename*=UTF-8''%E4%BC%9A%E8%AD%B0_frames.zip" in disposition
+    assert disposition.encode('latin-1')
+
+
+def test_zip_errors(client, folders):
+    assert client.get('/export_zip').status_code == 400
+    assert client.get('/export_zip?result=../x').status_code == 400
+    assert client.get(f"/export_zip?result={'0' * 32}_interval_i5").status_code == 404
@@ -0,0 +1,45 @@
+import app_simple
+
+
+def test_with_thread_options_single_output():
+    cmd = ['ffmpeg', '-ss', '3', '-i', 'in.mp4', '-vf', 'fps=1/5', '-q:v', '2', '-y', 'out_%03d.jpg']
+    assert app_simple.with_thread_options(cmd, 2) == [
+        'ffmpeg', '-filter_threads', '2', '-filter_complex_threads', '2',
+        '-ss', '3', '-threads', '2', '-i', 'in.mp4',
+        '-vf', 'fps=1/5', '-q:v', '2', '-y',
+        '-threads', '2', 'out_%03d.jpg'
+    ]
+
+
+def test_with_thread_options_every_output_and_input():
+    cmd = ['ffmpeg', '-hide_banner', '-i', 'a.mp4', '-i', 'b.mp4',
+           '-map', '0:v', '-an', 'first.jpg', '-map', '1:v', 'pipe:1']
+    result = app_simple.with_thread_options(cmd, 4)
+    # 入力ごとのデコーダーと出力ごとのエンコーダーの前に -threads
+    assert result[result.index('a.mp4') - 3:result.index('a.mp4') + 1] == ['-threads', '4', '-i', 'a.mp4']
+    assert result[result.index('b.mp4') - 3:result.index('b.mp4') + 1] == ['-threads', '4', '-i', 'b.mp4']
+    assert result[result.index('first.jpg') - 2:result.index('first.jpg') + 1] == ['-threads', '4', 'first.jpg']
+    assert result[-3:] == ['-threads', '4', 'pipe:1']
+    # 値を取らないフラグの次の引数は出力先と取り違えない
+    assert result[result.index('-an') + 1:result.index('-an') + 4] == ['-threads', '4', 'first.jpg']
+    assert result.count('-threads') == 4
+
+
+def test_with_thread_options_keeps_option_values():
+    cmd = ['ffmpeg', '-i', 'in.mp4', '-filter_script:v', 'graph.txt', '-vsync', 'vfr', 'key_%03d.jpg']
+    # オプションの値（graph.txt, vfr）は出力先として扱わない
+    assert app_simple.with_thread_options(cmd, 1)[5:] == [
+        '-threads', '1', '-i', 'in.mp4', '-filter_script:v', 'graph.txt', '-vsync', 'vfr',
+        '-threads', '1', 'key_%03d.jpg'
+    ]
+
+
+def test_ffmpeg_thread_share(monkeypatch):
+    monkeypatch.setattr(app_simple, 'FFMPEG_THREAD_BUDGET', 8)
+    monkeypatch.setattr(app_simple, 'FFMPEG_MAX_THREADS', 16)
+    monkeypatch.setattr(app_simple, 'active_job_count', lambda: 2)
+    assert app_simple.ffmpeg_thread_share() == 4
+    assert app_simple.ffmpeg_thread_share(parallel=3) == 1
+    assert app_simple.ffmpeg_thread_share(parallel=16) == 1
+    monkeypatch.setattr(app_simple, 'FFMPEG_MAX_THREADS', 3)
+    assert app_simple.ffmpeg_thread_share() == 3
@@ -0,0 +1,114 @@
+import json
+
+import pytest
+
+import app_simple
+from conftest import DIGEST
+
+FRAMES = [{'filename': f'frame_{i + 1:03d}.jpg', 'timestamp': i * 5.0} for i in range(3)]
+
+
+@pytest.fixture
+def done_job(folders):
+    """シーンと完了までのイベントを書き終えたジョブ"""
+    result_id = app_simple.make_result_id(DIGEST, 'interval', 5, 0.15)
+    job_id = app_simple.add_job(f'{DIGEST}.mp4', 'clip.mp4', result_id, 'interval', 5, 0.15,
+                                frames=FRAMES, cached=True)
+    yield job_id
+    with app_simple.jobs_lock:
+        app_simple.jobs.pop(job_id, None)
+
+
+def line_offsets(path):
+    """各行の終わりの位置"""
+    offsets = []
+    with open(path, 'rb') as f:
+        for line in f:
+            offsets.append((offsets[-1] if offsets else 0) + len(line))
+    return offsets
+
+
+def parse_sse(body):
+    """SSE の本文を (id, event, data) の並びにする"""
+    events = []
+    for block in body.split('\n\n'):
+        fields = dict(line.split(': ', 1) for line in block.splitlines() if ': ' in line)
+        if 'event' in fields:
+            events.append((int(fields['id']), fields['event'], json.loads(fields['data'])))
+    return events
+
+
+def test_previous_job_event(done_job):
+    path = app_simple.job_events_path(done_job)
+    offsets = line_offsets(path)
+    assert app_simple.previous_job_event(path, 0) is None
+    assert app_simple.previous_job_event(path, offsets[0])['type'] == 'job'
+    assert app_simple.previous_job_event(path, offsets[1]) == {'type': 'scene', 'timestamp': 0.0}
+    assert app_simple.previous_job_event(path, offsets[-1])['type'] == 'done'
+
+
+def test_previous_job_event_rejects_mid_line(done_job):
+    path = app_simple.job_events_path(done_job)
+    offsets = line_offsets(path)
+    for offset in (offsets[1] - 3, offsets[-1] + 10):
+        with pytest.raises(ValueError):
+            app_simple.previous_job_event(path, offset)
+
+
+def test_previous_job_event_lookback(tmp_path, monkeypatch):
+    monkeypatch.setattr(app_simple, 'EVENT_LOOKBACK_BYTES', 32)
+    path = tmp_path / 'events.ndjson'
+    long_line = json.dumps({'type': 'progress', 'note': 'x' * 64}) + '\n'
+    short_line = json.dumps({'type': 'done'}) + '\n'
+    path.write_text(long_line + short_line)
+    # 読み戻す範囲に収まらない行は分からないものとして扱う
+    assert app_simple.previous_job_event(str(path), len(long_line)) is None
+    assert app_simple.previous_job_event(str(path), len(long_line) + len(short_line)) == {'type': 'done'}
+
+
+def test_events_stream(client, done_job):
+    response = client.get(f'/jobs/{done_job}/events')
+    assert response.status_code == 200
+    assert response.mimetype == 'text/event-stream'
+    body = response.get_data(as_text=True)
+    assert body.startswith(f'retry: {app_simple.EVENT_RETRY_MILLISECONDS}\n\n')
+
+    events = parse_sse(body)
+    assert [event for _, event, _ in events] == ['scene', 'scene', 'scene', 'done']
+    assert [data['timestamp'] for _, event, data in events if event == 'scene'] == [0.0, 5.0, 10.0]
+    assert events[-1][2]['percent'] == 100
+    # id はイベントファイル内で次に読む位置
+    assert [event_id for event_id, _, _ in events] == line_offsets(app_simple.job_events_path(done_job))[1:]
+
+
+def test_events_resume_from_last_event_id(client, done_job):
+    offsets = line_offsets(app_simple.job_events_path(done_job))
+    response = client.get(f'/jobs/{done_job}/events', headers={'Last-Event-ID': str(offsets[2])})
+    events = parse_sse(response.get_data(as_text=True))
+    assert [(event_id, event) for event_id, event, _ in events] == [(offsets[3], 'scene'), (offsets[4], 'done')]
+
+
+def test_events_resume_after_done(client, done_job):
+    # 終わりのイベントまで受け取ったあとの再接続には終わりのイベントだけを返す
+    end = line_offsets(app_simple.job_events_path(done_job))[-1]
+    response = client.get(f'/jobs/{done_job}/events?offset={end}')
+    events = parse_sse(response.get_data(as_text=True))
+    assert [(event_id, event) for event_id, event, _ in events] == [(end, 'done')]
+
+
+def test_events_ndjson(client, done_job):
+    offsets = line_offsets(app_simple.job_events_path(done_job))
+    response = client.get(f'/jobs/{done_job}/events?format=ndjson&offset={offsets[3]}')
+    assert response.mimetype == 'application/x-ndjson'
+    events = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert [(event['offset'], event['type']) for event in events] == [(offsets[4], 'done')]
+
+
+@pytest.mark.parametrize('offset', ['3', '-x', '999999'])
+def test_events_reject_bad_offset(client, done_job, offset):
+    response = client.get(f'/jobs/{done_job}/events', headers={'Last-Event-ID': offset})
+    assert response.status_code == 400
+
+
+def test_events_unknown_job(client, folders):
+    assert client.get(f"/jobs/{'0' * 32}/events").status_code == 404
@@ -0,0 +1,48 @@
+import json
+import os
+
+import pytest
+
+import app_simple
+
+DEAD_PID = 2 ** 22 + 1
+
+
+@pytest.fixture
+def metrics_folder(tmp_path, monkeypatch):
+    monkeypatch.setattr(app_simple, 'METRICS_FOLDER', str(tmp_path))
+    monkeypatch.setattr(app_simple, 'queue_status', lambda: {'depth': 0})
+    # このプロセスの集計は書き出さない（他のテストで数えた分が混ざらないように）
+    monkeypatch.setattr(app_simple, 'flush_metrics', lambda: None)
+    return tmp_path
+
+
+def write_metrics(folder, filename, entries):
+    (folder / filename).write_text(json.dumps(entries))
+
+
+def test_collect_merges_files_of_exited_processes(metrics_folder):
+    histogram = {'buckets': [1] + [0] * (len(app_simple.METRICS_BUCKETS) - 1), 'sum': 0.001, 'count': 1}
+    write_metrics(metrics_folder, f'{DEAD_PID}-0000000a.json',
+                  [['frames_produced_total', [['mode', 'scene']], 5], ['probe_seconds', [], histogram]])
+    write_metrics(metrics_folder, f'{DEAD_PID}-0000000b.json', [['frames_produced_total', [['mode', 'scene']], 2]])
+    write_metrics(metrics_folder, f'{os.getpid()}-0000000c.json', [['frames_produced_total', [['mode', 'scene']], 1]])
+
+    for _ in range(2):
+        totals = app_simple.collect_metrics()
+        assert totals[('frames_produced_total', (('mode', 'scene'),))] == 8
+        assert totals[('probe_seconds', ())]['count'] == 1
+    # 終了したプロセスのファイルは1つにまとめて消す（カウンターは減らない）
+    assert sorted(name for name in os.listdir(metrics_folder) if name.endswith('.json')) == [
+        f'{os.getpid()}-0000000c.json', app_simple.METRICS_MERGED_FILENAME]
+
+
+def test_collect_keeps_files_of_running_processes(metrics_folder):
+    write_metrics(metrics_folder, f'{os.getppid()}-0000000d.json', [['cache_hits_total', [], 3]])
+    assert app_simple.collect_metrics()[('cache_hits_total', ())] == 3
+    assert (metrics_folder / f'{os.getppid()}-0000000d.json').exists()
+
+
+def test_process_alive():
+    assert app_simple.process_alive(os.getpid())
+    assert not app_simple.process_alive(DEAD_PID)
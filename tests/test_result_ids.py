@@ -0,0 +1,76 @@
+import io
+
+import pytest
+from werkzeug.datastructures import MultiDict
+
+import app_simple
+from conftest import DIGEST
+
+
+def test_make_result_id_per_mode():
+    assert app_simple.make_result_id(DIGEST, 'scene', 5, 0.3) == f'{DIGEST[:32]}_scene_s0.3'
+    assert app_simple.make_result_id(DIGEST, 'fastscene', 5, 0.3) == f'{DIGEST[:32]}_fastscene_s0.3'
+    assert app_simple.make_result_id(DIGEST, 'interval', 7, 0.3) == f'{DIGEST[:32]}_interval_i7'
+    assert app_simple.make_result_id(DIGEST, 'fast', 7, 0.3) == f'{DIGEST[:32]}_fast_i7'
+    assert app_simple.make_result_id(DIGEST, 'adaptive', 7, 0.3) == f'{DIGEST[:32]}_adaptive_i7s0.3'
+
+
+def test_make_result_id_uses_fixed_point():
+    # 指数表記（1e-05 など）にならず、結果IDの形式に収まる
+    result_id = app_simple.make_result_id(DIGEST, 'scene', 5, 0.00001)
+    assert result_id.endswith('_s0.00001')
+    assert app_simple.is_valid_result_id(result_id)
+    assert app_simple.make_result_id(DIGEST, 'scene', 5, 0.1) == app_simple.make_result_id(DIGEST, 'scene', 5, 0.10)
+
+
+def test_make_result_id_dedupe_suffix(monkeypatch):
+    monkeypatch.setattr(app_simple, 'DEDUPE_THRESHOLD', 0)
+    assert app_simple.make_result_id(DIGEST, 'interval', 5, 0.15).endswith('_i5')
+    assert app_simple.make_result_id(DIGEST, 'interval', 5, 0.15, 6).endswith('_i5d6')
+    # 無効にした結果は既定値の設定によらず同じID
+    assert app_simple.make_result_id(DIGEST, 'interval', 5, 0.15, 0).endswith('_i5')
+    # シーン検出系には付けない
+    assert app_simple.make_result_id(DIGEST, 'scene', 5, 0.15, 6).endswith('_s0.15')
+
+    monkeypatch.setattr(app_simple, 'DEDUPE_THRESHOLD', 4)
+    assert app_simple.make_result_id(DIGEST, 'fast', 5, 0.15).endswith('_i5d4')
+    assert app_simple.make_result_id(DIGEST, 'fast', 5, 0.15, 0).endswith('_i5')
+
+
+def test_make_result_id_rejects_unknown_mode():
+    with pytest.raises(ValueError):
+        app_simple.make_result_id(DIGEST, 'bogus', 5, 0.15)
+
+
+def test_parse_extraction_params_defaults():
+    assert app_simple.parse_extraction_params(MultiDict()) == ('interval', 5, 0.15)
+    assert app_simple.parse_extraction_params(
+        MultiDict({'mode': 'scene', 'interval': '10', 'sensitivity': '0.3'})) == ('scene', 10, 0.3)
+
+
+@pytest.mark.parametrize('values', [
+    {'mode': 'bogus'},
+    {'interval': 'x'},
+    {'interval': '0'},
+    {'interval': '61'},
+    {'sensitivity': 'nan'},
+    {'sensitivity': '0'},
+    {'sensitivity': '0.95'},
+])
+def test_parse_extraction_params_rejects(values):
+    with pytest.raises(ValueError):
+        app_simple.parse_extraction_params(MultiDict(values))
+
+
+def test_parse_dedupe_param():
+    assert app_simple.parse_dedupe_param(MultiDict()) is None
+    assert app_simple.parse_dedupe_param(MultiDict({'dedupe': ''})) is None
+    assert app_simple.parse_dedupe_param(MultiDict({'dedupe': '6'})) == 6
+    for value in ('x', '-1', '33'):
+        with pytest.raises(ValueError):
+            app_simple.parse_dedupe_param(MultiDict({'dedupe': value}))
+
+
+def test_upload_rejects_unknown_mode(client, folders):
+    response = client.post('/upload', data={'video': (io.BytesIO(b'x'), 'a.mp4'), 'mode': 'bogus'})
+    assert response.status_code == 400
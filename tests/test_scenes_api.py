@@ -0,0 +1,72 @@
+import json
+
+import pytest
+
+import app_simple
+
+
+def test_cursor_round_trip():
+    for offset in (0, 1, 50, 123456):
+        cursor = app_simple.encode_cursor(offset)
+        assert '=' not in cursor
+        assert app_simple.decode_cursor(cursor) == offset
+    assert app_simple.decode_cursor(None) == 0
+    assert app_simple.decode_cursor('') == 0
+
+
+@pytest.mark.parametrize('cursor', ['!!!', 'eDEw', app_simple.encode_cursor(5)[:-1] + '*'])
+def test_decode_cursor_rejects(cursor):
+    with pytest.raises(ValueError):
+        app_simple.decode_cursor(cursor)
+
+
+def test_scenes_pages_with_link_header(client, make_result):
+    result_id = make_result(count=5)
+    response = client.get(f'/results/{result_id}/scenes?limit=2')
+    assert response.status_code == 200
+    assert response.headers['X-Total-Count'] == '5'
+    data = response.get_json()
+    assert [scene['index'] for scene in data['scenes']] == [0, 1]
+    assert response.headers['Link'] == f'<{data["next_url"]}>; rel="next"'
+
+    # Link をたどると最後のページには次がない
+    seen = [scene['timestamp'] for scene in data['scenes']]
+    while 'Link' in response.headers:
+        response = client.get(response.headers['Link'][1:].split('>')[0])
+        seen += [scene['timestamp'] for scene in response.get_json()['scenes']]
+    assert seen == [0, 5, 10, 15, 20]
+    assert response.get_json()['next_cursor'] is None
+
+
+def test_scenes_etag_and_not_modified(client, make_result):
+    result_id = make_result(count=3)
+    response = client.get(f'/results/{result_id}/scenes')
+    etag = response.headers['ETag']
+    assert response.headers['Cache-Control'] == 'no-cache'
+
+    cached = client.get(f'/results/{result_id}/scenes', headers={'If-None-Match': etag})
+    assert cached.status_code == 304
+    assert cached.headers['ETag'] == etag
+    assert cached.data == b''
+
+    # ページ指定や形式が違えば別の ETag
+    other = client.get(f'/results/{result_id}/scenes?limit=1')
+    assert other.headers['ETag'] != etag
+    assert client.get(f'/results/{result_id}/scenes?limit=1', headers={'If-None-Match': etag}).status_code == 200
+
+
+def test_scenes_ndjson(client, make_result):
+    result_id = make_result(count=3)
+    response = client.get(f'/results/{result_id}/scenes?format=ndjson&limit=2')
+    assert response.mimetype == 'application/x-ndjson'
+    scenes = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert [scene['index'] for scene in scenes] == [0, 1]
+    assert 'format=ndjson' in response.headers['Link']
+
+
+def test_scenes_errors(client, make_result):
+    result_id = make_result(count=1)
+    assert client.get(f'/results/{result_id}/scenes?cursor=!!!').status_code == 400
+    assert client.get(f'/results/{result_id}/scenes?limit=x').status_code == 400
+    assert client.get(f"/results/{'0' * 32}_interval_i5/scenes").status_code == 404
+    assert client.get('/results/..%2Fetc/scenes').status_code == 404
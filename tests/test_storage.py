@@ -0,0 +1,73 @@
+import os
+import time
+
+import pytest
+
+import app_simple
+
+HOUR = 3600
+
+
+@pytest.fixture
+def videos(folders, monkeypatch):
+    """最終アクセスが古い順に並んだ3本の動画（各1000バイト）と、その抽出結果"""
+    monkeypatch.setattr(app_simple, 'STORAGE_TTL_SECONDS', 0)
+    digests = [f'{i}' * 64 for i in range(1, 4)]
+    now = time.time()
+    for age, digest in zip((3, 2, 1), digests):
+        video = folders['uploads'] / f'{digest}.mp4'
+        video.write_bytes(b'v' * 600)
+        result_dir = folders['scenes'] / f'{digest[:32]}_interval_i5'
+        result_dir.mkdir()
+        (result_dir / 'frame_001.jpg').write_bytes(b'f' * 400)
+        marker = app_simple.access_marker_path(digest)
+        os.makedirs(os.path.dirname(marker), exist_ok=True)
+        open(marker, 'w').close()
+        # 作成時刻も最終アクセスとみなされるため、すべて同じ時刻にする
+        for path in (video, result_dir, marker):
+            os.utime(path, (now - age * HOUR, now - age * HOUR))
+    return digests
+
+
+def remaining(folders, digests):
+    return [digest for digest in digests if (folders['uploads'] / f'{digest}.mp4').exists()]
+
+
+def test_collect_storage_groups(videos):
+    groups = app_simple.collect_storage_groups()
+    assert sorted(groups) == sorted(digest[:32] for digest in videos)
+    group = groups[videos[0][:32]]
+    assert group['size'] == 1000
+    assert group['results'] == [f'{videos[0][:32]}_interval_i5']
+    assert group['accessed'] < groups[videos[2][:32]]['accessed']
+
+
+def test_sweep_evicts_least_recently_accessed_first(videos, folders, monkeypatch):
+    monkeypatch.setattr(app_simple, 'STORAGE_QUOTA_BYTES', 2500)
+    assert app_simple.sweep_storage() == {'total_bytes': 2000, 'evicted': 1}
+    assert remaining(folders, videos) == videos[1:]
+    assert not (folders['scenes'] / f'{videos[0][:32]}_interval_i5').exists()
+    assert not os.path.exists(app_simple.access_marker_path(videos[0]))
+
+
+def test_sweep_reduces_below_ninety_percent(videos, folders, monkeypatch):
+    # 上限をわずかに超えた分だけでなく、上限の9割まで減らす
+    monkeypatch.setattr(app_simple, 'STORAGE_QUOTA_BYTES', 2100)
+    assert app_simple.sweep_storage()['evicted'] == 2
+    assert remaining(folders, videos) == videos[2:]
+
+
+def test_sweep_skips_pinned_and_recent(videos, folders, monkeypatch):
+    monkeypatch.setattr(app_simple, 'STORAGE_QUOTA_BYTES', 1000)
+    # 最も古い動画は処理中、最も新しい動画はアクセスしたばかり
+    open(app_simple.inflight_marker_path(f'{videos[0][:32]}_interval_i5', 'job'), 'w').close()
+    os.utime(app_simple.access_marker_path(videos[2]))
+    assert app_simple.sweep_storage() == {'total_bytes': 2000, 'evicted': 1}
+    assert remaining(folders, videos) == [videos[0], videos[2]]
+
+
+def test_sweep_expires_by_ttl(videos, folders, monkeypatch):
+    monkeypatch.setattr(app_simple, 'STORAGE_QUOTA_BYTES', 0)
+    monkeypatch.setattr(app_simple, 'STORAGE_TTL_SECONDS', int(1.5 * HOUR))
+    assert app_simple.sweep_storage()['evicted'] == 2
+    assert remaining(folders, videos) == videos[2:]
@@ -0,0 +1,52 @@
+import io
+
+import pytest
+from PIL import Image
+
+import app_simple
+
+
+def test_thumbnail_is_resized_and_cached(client, make_result, folders):
+    result_id = make_result(count=1, size=(800, 450))
+    response = client.get(f'/thumbnails/{result_id}/small/frame_001.jpg')
+    assert response.status_code == 200
+    assert response.mimetype == 'image/jpeg'
+    assert 'max-age' in response.headers['Cache-Control']
+    with Image.open(io.BytesIO(response.data)) as img:
+        assert img.size == (320, 180)
+    assert (folders['thumbnails'] / result_id / 'small' / 'frame_001.jpg').exists()
+
+
+def test_thumbnail_keeps_small_images(client, make_result):
+    result_id = make_result(count=1, size=(64, 36))
+    response = client.get(f'/thumbnails/{result_id}/medium/frame_001.jpg')
+    with Image.open(io.BytesIO(response.data)) as img:
+        assert img.size == (64, 36)
+
+
+@pytest.mark.skipif(not app_simple.WEBP_AVAILABLE, reason='Pillow built without WebP')
+def test_thumbnail_webp(client, make_result):
+    result_id = make_result(count=1)
+    response = client.get(f'/thumbnails/{result_id}/small/frame_001.webp')
+    assert response.status_code == 200
+    with Image.open(io.BytesIO(response.data)) as img:
+        assert img.format == 'WEBP'
+
+
+@pytest.mark.parametrize('path', [
+    'huge/frame_001.jpg',
+    'small/frame_001.gif',
+    'small/frame_999.jpg',
+])
+def test_thumbnail_not_found(client, make_result, path):
+    result_id = make_result(count=1)
+    assert client.get(f'/thumbnails/{result_id}/{path}').status_code == 404
+
+
+def test_thumbnail_unknown_result(client, folders):
+    assert client.get(f"/thumbnails/{'0' * 32}_interval_i5/small/frame_001.jpg").status_code == 404
+
+
+def test_srcset_widths_skip_duplicates():
+    assert app_simple.srcset_widths({'width': 1920}) == {'small': 320, 'medium': 640, 'full': 1920}
+    assert app_simple.srcset_widths({'width': 300}) == {'small': 300}